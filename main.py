@@ -1,8 +1,15 @@
-from esp32_remote import Handler, get_config
+from boot_profile import profiler
+from ringlog import log
 
+profiler.mark("main")
+
+from esp32_remote import Handler, get_config  # noqa: E402
+
+profiler.mark("import")
 config = get_config()
 handler = Handler(config)
-print("STARTING IR MQTT Handler")
+profiler.mark("handler")
+log.info("Starting IR MQTT Handler")
 
 if not config.get("no_run", False):
     handler.run_forever()
@@ -0,0 +1,51 @@
+# Records ticks_ms and free heap at the phase boundaries of a boot. Kept outside of esp32_remote so
+# main.py can start recording before the package is imported.
+import gc
+import time
+
+RESET_CAUSES = ("PWRON_RESET", "HARD_RESET", "WDT_RESET", "DEEPSLEEP_RESET", "SOFT_RESET")
+
+
+class BootProfiler:
+    def __init__(self):
+        self.marks = []
+        self.finished = False
+
+    def mark(self, name: str) -> None:
+        # Only the first boot is profiled. Phases of later reconnects are ignored.
+        if not self.finished:
+            self.marks.append((name, time.ticks_ms(), gc.mem_free()))
+
+    def reset_cause(self) -> str:
+        try:
+            import machine
+
+            cause = machine.reset_cause()
+        except (ImportError, AttributeError):
+            return None
+        for name in RESET_CAUSES:
+            if getattr(machine, name, None) == cause:
+                return name.lower()
+        return str(cause)
+
+    def build(self) -> str:
+        try:
+            import os
+
+            return os.uname().version
+        except (ImportError, AttributeError):
+            return None
+
+    def finish(self) -> None:
+        self.finished = True
+
+    def report(self) -> dict:
+        # [phase, ticks_ms since power on, free heap] for every boundary, in order.
+        return {
+            "reset_cause": self.reset_cause(),
+            "build": self.build(),
+            "phases": [list(mark) for mark in self.marks],
+        }
+
+
+profiler = BootProfiler()
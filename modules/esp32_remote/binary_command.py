@@ -0,0 +1,120 @@
+# Compact binary encoding of commands, accepted on the ir/command/bin topic.
+#
+# A payload starts with the format version byte followed by exactly one step. All integers are little endian.
+#
+#   NEC     0x01 <device_id:u8> <command:u8>
+#   RC6     0x02 <mode:u8> <control:u8> <information:u8>
+#   ISCP    0x03 <len:u8> <identifier> <len:u8> <command> <len:u8> <argument>
+#   WAIT    0x04 <ms:u32>
+#   REPEAT  0x05 <count:u16> <step>
+#   SCENE   0x06 <count:u16> <step> * count
+#   ISCP_BATCH  0x07 <len:u8> <identifier> <count:u8> (<flags:u8> <len:u8> <command> <len:u8> <argument>) * count
+#               flags bit 0: expect a response
+#   EMITTER 0x08 <len:u8> <emitter> <step>
+#           sends the NEC or RC6 step which follows on the named emitter
+#   START_AT    0x09 <unix_ms:u64> <step>
+#               starts the SCENE step which follows at the given time
+from struct import unpack_from
+
+from micropython import const
+
+from .commands import (
+    ISCPBatchCommand,
+    ISCPBatchItem,
+    ISCPCommand,
+    NECCommand,
+    RC6Command,
+    RepeatCommand,
+    SceneCommand,
+    WaitCommand,
+)
+
+VERSION = const(1)
+
+STEP_NEC = const(0x01)
+STEP_RC6 = const(0x02)
+STEP_ISCP = const(0x03)
+STEP_WAIT = const(0x04)
+STEP_REPEAT = const(0x05)
+STEP_SCENE = const(0x06)
+STEP_ISCP_BATCH = const(0x07)
+STEP_EMITTER = const(0x08)
+STEP_START_AT = const(0x09)
+
+FLAG_EXPECT_RESPONSE = const(0x01)
+
+
+def decode(buffer: bytes):
+    if not buffer:
+        raise ValueError("Empty binary command")
+    if buffer[0] != VERSION:
+        raise ValueError("Unsupported binary command version {}".format(buffer[0]))
+    command, offset = _decode_step(buffer, 1)
+    if offset != len(buffer):
+        raise ValueError("Trailing data after binary command")
+    return command
+
+
+def _decode_string(buffer: bytes, offset: int) -> "Tuple[str, int]":
+    length = buffer[offset]
+    offset += 1
+    end = offset + length
+    if end > len(buffer):
+        raise ValueError("Truncated binary command")
+    return buffer[offset:end].decode(), end
+
+
+def _decode_step(buffer: bytes, offset: int) -> "Tuple[Command, int]":
+    step_type = buffer[offset]
+    offset += 1
+    if step_type == STEP_NEC:
+        device_id, command = unpack_from("<BB", buffer, offset)
+        return NECCommand(device_id, command, None), offset + 2
+    elif step_type == STEP_RC6:
+        mode, control, information = unpack_from("<BBB", buffer, offset)
+        return RC6Command(mode, control, information, None), offset + 3
+    elif step_type == STEP_ISCP:
+        identifier, offset = _decode_string(buffer, offset)
+        command, offset = _decode_string(buffer, offset)
+        argument, offset = _decode_string(buffer, offset)
+        return ISCPCommand(identifier, command, argument, None), offset
+    elif step_type == STEP_WAIT:
+        return WaitCommand(unpack_from("<I", buffer, offset)[0]), offset + 4
+    elif step_type == STEP_REPEAT:
+        count = unpack_from("<H", buffer, offset)[0]
+        item, offset = _decode_step(buffer, offset + 2)
+        return RepeatCommand(count, item), offset
+    elif step_type == STEP_SCENE:
+        count = unpack_from("<H", buffer, offset)[0]
+        offset += 2
+        steps = []
+        for _ in range(count):
+            step, offset = _decode_step(buffer, offset)
+            steps.append(step)
+        return SceneCommand(steps, None), offset
+    elif step_type == STEP_ISCP_BATCH:
+        identifier, offset = _decode_string(buffer, offset)
+        count = buffer[offset]
+        offset += 1
+        items = []
+        for _ in range(count):
+            flags = buffer[offset]
+            command, offset = _decode_string(buffer, offset + 1)
+            argument, offset = _decode_string(buffer, offset)
+            items.append(ISCPBatchItem(command, argument, bool(flags & FLAG_EXPECT_RESPONSE)))
+        return ISCPBatchCommand(identifier, items), offset
+    elif step_type == STEP_EMITTER:
+        emitter, offset = _decode_string(buffer, offset)
+        step, offset = _decode_step(buffer, offset)
+        if isinstance(step, NECCommand):
+            return NECCommand(step.device_id, step.command, emitter), offset
+        elif isinstance(step, RC6Command):
+            return RC6Command(step.mode, step.control, step.information, emitter), offset
+        raise ValueError("An emitter can only be set for NEC and RC6 steps")
+    elif step_type == STEP_START_AT:
+        start_at = unpack_from("<Q", buffer, offset)[0]
+        step, offset = _decode_step(buffer, offset + 8)
+        if not isinstance(step, SceneCommand):
+            raise ValueError("A start time can only be set for SCENE steps")
+        return SceneCommand(step.steps, start_at), offset
+    raise ValueError("Unknown binary step type {}".format(step_type))
@@ -0,0 +1,122 @@
+import json
+from collections import namedtuple
+
+
+def with_emitter(data: dict, emitter: "Optional[str]") -> dict:
+    if emitter is not None:
+        data["emitter"] = emitter
+    return data
+
+
+# emitter is None for the first configured emitter.
+class NECCommand(namedtuple("NECCommand", ("device_id", "command", "emitter"))):
+    def as_dict(self) -> dict:
+        return with_emitter({"type": "NEC", "device_id": self.device_id, "command": self.command}, self.emitter)
+
+
+class RC6Command(namedtuple("RC6Command", ("mode", "control", "information", "emitter"))):
+    def as_dict(self) -> dict:
+        return with_emitter(
+            {"type": "RC6", "mode": self.mode, "control": self.control, "information": self.information},
+            self.emitter,
+        )
+
+
+class ISCPCommand(namedtuple("ISCPCommand", ("identifier", "command", "argument", "skip_unchanged"))):
+    # skip_unchanged is None to use the configured default.
+    @property
+    def expect_response(self) -> bool:
+        return True
+
+    def as_dict(self) -> dict:
+        data = {"type": "ISCP", "identifier": self.identifier, "command": self.command, "argument": self.argument}
+        if self.skip_unchanged is not None:
+            data["skip_unchanged"] = self.skip_unchanged
+        return data
+
+
+class ISCPBatchItem(namedtuple("ISCPBatchItem", ("command", "argument", "expect_response"))):
+    def as_dict(self) -> dict:
+        return {"command": self.command, "argument": self.argument, "expect_response": self.expect_response}
+
+
+class ISCPBatchCommand(namedtuple("ISCPBatchCommand", ("identifier", "commands"))):
+    def as_dict(self) -> dict:
+        return {"type": "ISCP_BATCH", "identifier": self.identifier, "commands": [c.as_dict() for c in self.commands]}
+
+
+class WaitCommand(namedtuple("WaitCommand", ("ms",))):
+    def as_dict(self) -> dict:
+        return {"type": "WAIT", "ms": self.ms}
+
+
+class RepeatCommand(namedtuple("RepeatCommand", ("count", "item"))):
+    def as_dict(self) -> dict:
+        return {"type": "REPEAT", "count": self.count, "item": as_dict(self.item)}
+
+
+class SceneCommand(namedtuple("SceneCommand", ("steps", "start_at"))):
+    # Steps can be commands or not yet parsed dicts. They are converted one at a time while the scene plays.
+    # Steps streamed from a payload buffer can only be iterated once and are left out of the dict.
+    # start_at is an optional Unix timestamp in ms at which the first step is sent.
+    def as_dict(self) -> dict:
+        data = {"type": "SCENE"}
+        if self.start_at is not None:
+            data["start_at"] = self.start_at
+        if isinstance(self.steps, (list, tuple)):
+            data["scene"] = [as_dict(step) for step in self.steps]
+        return data
+
+
+def as_dict(command) -> dict:
+    if isinstance(command, dict):
+        return command
+    return command.as_dict()
+
+
+def stored_payload(data: dict) -> bytes:
+    # Commands kept for later (schedule, triggers) are parsed once to reject malformed ones and stored as their JSON
+    # payload, which is parsed again with scene streaming every time they run.
+    from_dict(data)
+    return json.dumps(data).encode()
+
+
+def from_dict(data: dict):
+    if not isinstance(data, dict):
+        raise ValueError("Command has to be a JSON object")
+    data_type = data.get("type", "").upper()
+    if data_type == "NEC":
+        if "command" not in data or "device_id" not in data:
+            raise ValueError("No command or device_id added in nec command")
+        return NECCommand(data["device_id"], data["command"], data.get("emitter", None))
+    elif data_type == "RC6":
+        if "control" not in data or "information" not in data:
+            raise ValueError("No control or information added in rc6 command")
+        return RC6Command(data.get("mode", 0), data["control"], data["information"], data.get("emitter", None))
+    elif data_type == "ISCP":
+        if "identifier" not in data or "command" not in data or "argument" not in data:
+            raise ValueError("No identifier, command or argument provided in iscp payload")
+        return ISCPCommand(data["identifier"], data["command"], data["argument"], data.get("skip_unchanged", None))
+    elif data_type == "ISCP_BATCH":
+        if "identifier" not in data or not isinstance(data.get("commands", None), list):
+            raise ValueError("No identifier or commands provided in iscp batch payload")
+        items = []
+        for item in data["commands"]:
+            if "command" not in item or "argument" not in item:
+                raise ValueError("No command or argument provided in iscp batch item")
+            items.append(ISCPBatchItem(item["command"], item["argument"], item.get("expect_response", True)))
+        return ISCPBatchCommand(data["identifier"], items)
+    elif data_type == "SCENE":
+        if "scene" not in data or not isinstance(data["scene"], list):
+            raise ValueError("No scene in payload")
+        start_at = data.get("start_at", None)
+        if start_at is not None and not isinstance(start_at, int):
+            raise ValueError("start_at has to be a Unix timestamp in ms")
+        return SceneCommand(data["scene"], start_at)
+    elif data_type == "WAIT":
+        return WaitCommand(data.get("ms", data.get("s", 1) * 1000))
+    elif data_type == "REPEAT":
+        if "item" not in data:
+            raise ValueError("No item in repeat configuration")
+        return RepeatCommand(data.get("count", 1), from_dict(data["item"]))
+    raise ValueError("Unknown command type")
@@ -1,18 +1,64 @@
 import gc
 import json
 
+from boot_profile import profiler
 from mqtt_as import config
 
 
 def get_config(with_ssl: bool = True, config_path: str = "/config.json"):
     with open(config_path, "r") as handle:
         data = json.load(handle)
+    profiler.mark("config_parsed")
 
     for key in ("topic_prefix", "client_id", "server", "port", "user", "password", "ssl", "ssid", "wifi_pw", "no_run"):
         config[key] = data.get(key, None)
 
     config["tx_pin"] = config.get("tx_pin", 17)
     config["rx_pin"] = config.get("rx_pin", 26)
+    config["net_cache"] = data.get("net_cache", "/net_cache.json")
+    config["dedup_size"] = data.get("dedup_size", 16)
+    config["iscp_idle_timeout"] = data.get("iscp_idle_timeout", 300)
+    config["iscp_probe_after"] = data.get("iscp_probe_after", 30)
+    config["iscp_cache"] = data.get("iscp_cache", "/iscp_cache.json")
+    config["iscp_cache_ttl"] = data.get("iscp_cache_ttl", 86400)
+    config["iscp_negative_ttl"] = data.get("iscp_negative_ttl", 30)
+    config["iscp_discovery_interval"] = data.get("iscp_discovery_interval", 10)
+    config["iscp_skip_unchanged"] = data.get("iscp_skip_unchanged", False)
+    config["iscp_state_ttl"] = data.get("iscp_state_ttl", 60)
+    config["iscp_retries"] = data.get("iscp_retries", 4)
+    config["iscp_retry_base_ms"] = data.get("iscp_retry_base_ms", 100)
+    config["iscp_retry_max_ms"] = data.get("iscp_retry_max_ms", 2000)
+    config["iscp_breaker_threshold"] = data.get("iscp_breaker_threshold", 3)
+    config["iscp_breaker_reset"] = data.get("iscp_breaker_reset", 30)
+    config["trace_size"] = data.get("trace_size", 32)
+    config["metrics_interval"] = data.get("metrics_interval", 60)
+    config["loop_monitor_interval"] = data.get("loop_monitor_interval", 50)
+    config["loop_lag_threshold"] = data.get("loop_lag_threshold", 50)
+    config["ntp_host"] = data.get("ntp_host", "pool.ntp.org")
+    config["ntp_port"] = data.get("ntp_port", 123)
+    config["ntp_timeout_ms"] = data.get("ntp_timeout_ms", 1000)
+    config["ntp_max_error_ms"] = data.get("ntp_max_error_ms", 100)
+    config["ntp_min_interval"] = data.get("ntp_min_interval", 60)
+    config["ntp_max_interval"] = data.get("ntp_max_interval", 86400)
+    config["scene_max_wait"] = data.get("scene_max_wait", 3600)
+    config["schedule_path"] = data.get("schedule_path", "/schedule.json")
+    config["schedule_size"] = data.get("schedule_size", 32)
+    config["schedule_grace"] = data.get("schedule_grace", 300)
+    config["schedule_utc_offset"] = data.get("schedule_utc_offset", 0)
+    config["trigger_path"] = data.get("trigger_path", "/triggers.json")
+    config["trigger_size"] = data.get("trigger_size", 32)
+    config["trigger_cooldown_ms"] = data.get("trigger_cooldown_ms", 500)
+    config["log_size"] = data.get("log_size", 64)
+    config["log_level"] = data.get("log_level", "info")
+    config["log_console"] = data.get("log_console", "warning")
+    config["ir_queue_size"] = data.get("ir_queue_size", 8)
+    config["emitters"] = data.get("emitters", None)
+    config["receivers"] = data.get("receivers", None)
+    config["rx_dedup_ms"] = data.get("rx_dedup_ms", 150)
+    config["gc_threshold"] = data.get("gc_threshold", 25)
+    config["gc_idle_ms"] = data.get("gc_idle_ms", 200)
+    config["gc_min_alloc"] = data.get("gc_min_alloc", 4096)
+    config["gc_max_interval"] = data.get("gc_max_interval", 60)
 
     del data
     gc.collect()
@@ -31,4 +77,6 @@ def get_config(with_ssl: bool = True, config_path: str = "/config.json"):
     else:
         config["ssl"] = False
 
+    config["profiler"] = profiler
+    profiler.mark("config")
     return config
@@ -0,0 +1,44 @@
+from .scene_stream import top_level_items
+
+REQUEST_ID_KEY = b"request_id"
+
+
+class RecentIds:
+    # The size most recently used keys. A hit refreshes the key, so an ID which keeps being retried stays known
+    # while newer ones come in. The use counter makes eviction a scan over size entries, which is cheaper than
+    # keeping an order on the few entries this holds.
+    def __init__(self, size: int = 16):
+        self.size = size
+        self._used: "Dict[object, int]" = {}
+        self._clock = 0
+
+    def seen(self, key) -> bool:
+        if not self.size:
+            return False
+        self._clock += 1
+        used = self._used
+        if key in used:
+            used[key] = self._clock
+            return True
+        if len(used) >= self.size:
+            del used[min(used, key=used.get)]
+        used[key] = self._clock
+        return False
+
+    def __len__(self) -> int:
+        return len(self._used)
+
+
+def request_id(message: bytes) -> "Optional[bytes]":
+    # Extract the value of the top level "request_id" key without parsing the JSON payload. A request_id
+    # nested in a scene step or an action doesn't count. Malformed payloads are left to the decoder.
+    try:
+        for key, start, end in top_level_items(message):
+            if key == REQUEST_ID_KEY:
+                if message[start] == 0x22:  # '"'
+                    start += 1
+                    end -= 1
+                return message[start:end] or None
+    except (ValueError, IndexError):
+        pass
+    return None
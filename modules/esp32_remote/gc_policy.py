@@ -0,0 +1,100 @@
+import gc
+import time
+
+import uasyncio
+from micropython import const
+
+from .loop_monitor import NO_PHASES
+
+CHECK_INTERVAL_MS = const(100)
+
+
+class GCPolicy:
+    # Keeps garbage collections out of command execution. The allocation threshold turns the automatic
+    # collection into a safety net, the regular collections happen once no command ran for idle_ms.
+    def __init__(
+        self,
+        metrics,
+        threshold_percent: int = 25,
+        idle_ms: int = 200,
+        min_alloc: int = 4096,
+        max_interval_ms: int = 60000,
+        phases=NO_PHASES,
+    ):
+        self.metrics = metrics
+        self.threshold_percent = threshold_percent
+        self.idle_ms = idle_ms
+        self.min_alloc = min_alloc
+        self.max_interval_ms = max_interval_ms
+        self.phases = phases
+        self.busy = 0
+        self.commands = 0
+        self.last_busy = time.ticks_ms()
+        self.last_collect = time.ticks_ms()
+        self.alloc_after_collect = gc.mem_alloc()
+        self.last_alloc = self.alloc_after_collect
+        self.stopped = False
+        self.idle_collections = metrics.counter("gc_idle")
+        self.auto_collections = metrics.counter("gc_auto")
+        self.alloc_per_command = metrics.gauge("gc_alloc_per_cmd")
+
+    def apply_threshold(self) -> None:
+        # 0 keeps MicroPython's default of only collecting when an allocation fails.
+        if self.threshold_percent:
+            gc.threshold((gc.mem_free() + gc.mem_alloc()) * self.threshold_percent // 100)
+
+    def begin(self) -> None:
+        self.busy += 1
+
+    def end(self) -> None:
+        self.busy -= 1
+        self.commands += 1
+        self.last_busy = time.ticks_ms()
+
+    def pause(self) -> None:
+        # A command which is only waiting, like a scene for its start time, doesn't hold collections back.
+        self.busy -= 1
+
+    def resume(self) -> None:
+        self.busy += 1
+
+    def collect(self) -> None:
+        allocated = gc.mem_alloc() - self.alloc_after_collect
+        if self.commands:
+            self.alloc_per_command.set(allocated // self.commands)
+        self.phases.enter("gc")
+        self.metrics.collect_garbage()
+        self.phases.leave()
+        self.idle_collections.inc()
+        self.commands = 0
+        self.last_collect = time.ticks_ms()
+        self.alloc_after_collect = self.last_alloc = gc.mem_alloc()
+
+    def collect_due(self) -> bool:
+        now = time.ticks_ms()
+        if self.busy or time.ticks_diff(now, self.last_busy) < self.idle_ms:
+            return False
+        if time.ticks_diff(now, self.last_collect) >= self.max_interval_ms:
+            return True
+        return gc.mem_alloc() - self.alloc_after_collect >= self.min_alloc
+
+    def _sample(self) -> None:
+        # The allocated heap only shrinks through a collection. If it shrank without one of ours, the
+        # threshold (or a failed allocation) triggered an automatic collection.
+        allocated = gc.mem_alloc()
+        if allocated < self.last_alloc:
+            self.auto_collections.inc()
+            self.alloc_after_collect = allocated
+            self.commands = 0
+        self.last_alloc = allocated
+
+    def stop(self) -> None:
+        self.stopped = True
+
+    async def start(self) -> None:
+        self.apply_threshold()
+        while not self.stopped:
+            await uasyncio.sleep_ms(CHECK_INTERVAL_MS)
+            self._sample()
+            if self.collect_due():
+                self.collect()
@@ -1,16 +1,52 @@
-import gc
 import json
 import time
 
 import uasyncio
+from boot_profile import profiler
+from micropython import const
 from mqtt_as import MQTTClient
-from ntptime import settime
-
+from ringlog import DEBUG, WARNING, log, parse_level
+
+from .binary_command import decode as decode_binary_command
+from .commands import (
+    ISCPBatchCommand,
+    ISCPCommand,
+    NECCommand,
+    RC6Command,
+    RepeatCommand,
+    SceneCommand,
+    WaitCommand,
+    as_dict,
+    from_dict,
+)
+from .dedup import RecentIds, request_id
+from .gc_policy import GCPolicy
 from .ir_handler import IRHandler
-from .iscp_handler import ISCPHandler
+from .loop_monitor import LoopMonitor, PhaseTracker
+from .metrics import Metrics
+from .retry import CircuitBreaker, RetriesExhausted, RetryPolicy
+from .router import DEDUP_JSON, DEDUP_PID, DEDUP_REQUEST_ID, PAYLOAD_JSON, PAYLOAD_RAW, PAYLOAD_TEXT, TopicRouter
+from .scene_stream import parse_command
+from .tracing import (
+    NO_TRACE,
+    STAGE_CAPTURED,
+    STAGE_PARSED,
+    STAGE_PUBLISHED,
+    STAGE_RECEIVED,
+    STAGE_SOCKET_READ,
+    STAGE_TX_DONE,
+    STAGE_TX_START,
+    Tracer,
+)
 
 loop = uasyncio.get_event_loop()
 
+SENT_PAYLOAD_CACHE_SIZE = const(16)
+# Scenes with a start time are woken up this long before it, for a garbage collection and the final sleep.
+SCENE_APPROACH_MS = const(200)
+SCENE_RECHECK_MS = const(1000)
+SCENE_GC_MARGIN_MS = const(50)
+
 
 def current_isotime():
     current_time = time.localtime()
@@ -18,203 +54,721 @@ def current_isotime():
 
 
 async def wifi_han(state: bool) -> None:
-    print("Wifi is", "up" if state else "down")
-    if state:
-        try:
-            settime()
-        except Exception:
-            pass
+    log.info("Wifi is %s", "up" if state else "down")
     await uasyncio.sleep_ms(1000)
 
 
 class Handler:
     def __init__(self, config: dict):
+        # Time since power on when the firmware got to the handler. The first livesign reports it together
+        # with the time it was published.
+        self.created_ms = time.ticks_ms()
         config["subs_cb"] = self.sub_cb
         config["connect_coro"] = self.subscribe_topics
         config["wifi_coro"] = self.on_wifi
+        self.phases = config["phases"] = PhaseTracker()
+        log.configure(
+            config.get("log_size", 64),
+            parse_level(config.get("log_level", "info")),
+            parse_level(config.get("log_console", "warning"), default=WARNING),
+        )
+        config["logger"] = log
+        # Collections are scheduled by the GC policy instead of every second by mqtt_as.
+        config["gc_collect"] = False
         self.config = config
         self.client = MQTTClient(config)
         self.stopped = False
         self.ir_handler = IRHandler(config)
         self.last_lifesign = None
-        self.iscp_handler = ISCPHandler()
+        self._iscp_handler = None
+        self._iscp_state_changed = set()
+        self.iscp_retry_policy = RetryPolicy(
+            attempts=config.get("iscp_retries", 4),
+            base_ms=config.get("iscp_retry_base_ms", 100),
+            max_ms=config.get("iscp_retry_max_ms", 2000),
+        )
+        self.iscp_breakers: "Dict[str, CircuitBreaker]" = {}
+        self.recent_request_ids = RecentIds(config.get("dedup_size", 16))
+        self.recent_pids = RecentIds(config.get("dedup_size", 16))
+        self.tracer = Tracer(config.get("trace_size", 32))
+        self.last_metrics = None
+        self.metrics = Metrics()
+        self.duplicates_request_id = self.metrics.counter("dup_request_id")
+        self.duplicates_pid = self.metrics.counter("dup_pid")
+        self.metrics.counter("trace_skipped", lambda: self.tracer.skipped)
+        self.command_counters = {
+            command_type: self.metrics.counter("cmd_" + name)
+            for command_type, name in (
+                (NECCommand, "nec"),
+                (RC6Command, "rc6"),
+                (ISCPCommand, "iscp"),
+                (ISCPBatchCommand, "iscp_batch"),
+                (SceneCommand, "scene"),
+                (WaitCommand, "wait"),
+                (RepeatCommand, "repeat"),
+            )
+        }
+        self.command_errors = self.metrics.counter("cmd_errors")
+        self.errors = self.metrics.counter("errors")
+        self.mqtt_connects = self.metrics.counter("mqtt_connects")
+        self.wifi_drops = self.metrics.counter("wifi_drops")
+        self.metrics.counter("mqtt_republished", lambda: self.client.REPUB_COUNT)
+        self.metrics.counter("ir_tx_frames", lambda: self.ir_handler.tx_frames)
+        self.metrics.gauge(
+            "ir_emitter_frames", lambda: {name: emitter.tx_frames for name, emitter in self.ir_handler.emitters.items()}
+        )
+        self.metrics.counter("ir_decode_failures", lambda: self.ir_handler.decode_failures)
+        self.metrics.counter("ir_rx_duplicates", lambda: self.ir_handler.rx_duplicates)
+        self.loop_monitor = LoopMonitor(
+            self.phases,
+            self.metrics.histogram("loop_lag_ms", (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)),
+            interval_ms=config.get("loop_monitor_interval", 50),
+            threshold_ms=config.get("loop_lag_threshold", 50),
+        )
+        self.metrics.gauge("loop_offenders", self.loop_monitor.worst_offenders)
+        self.gc_policy = GCPolicy(
+            self.metrics,
+            threshold_percent=config.get("gc_threshold", 25),
+            idle_ms=config.get("gc_idle_ms", 200),
+            min_alloc=config.get("gc_min_alloc", 4096),
+            max_interval_ms=config.get("gc_max_interval", 60) * 1000,
+            phases=self.phases,
+        )
+        self._topics: "Dict[str, str]" = {}
+        # Serialized ir/last-sent-command payloads of recently sent IR commands, keyed on the command.
+        self._sent_payloads: "Dict[Union[NECCommand, RC6Command], str]" = {}
+        # The NTP client, the schedule and the triggers are set up by start() after the MQTT connect, so their imports
+        # and the flash reads of the tables stay off the critical path.
+        self.ntp = None
+        self.scheduler = None
+        self.triggers = None
+        self.metrics.counter("ntp_syncs", lambda: self.ntp.syncs)
+        self.metrics.counter("ntp_failures", lambda: self.ntp.failures)
+        self.metrics.gauge("ntp_drift_ppm", lambda: self.ntp.drift_ppm)
+        self.metrics.gauge("ntp_error_ms", lambda: self.ntp.error_ms())
+        self.scene_max_wait_ms = config.get("scene_max_wait", 3600) * 1000
+        self.scene_late = self.metrics.histogram("scene_late_ms", (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000))
+        self.scene_unsynced = self.metrics.counter("scene_unsynced")
+        self.metrics.counter("schedule_runs", lambda: self.scheduler.runs)
+        self.metrics.counter("schedule_missed", lambda: self.scheduler.missed)
+        self.metrics.gauge("schedule_entries", lambda: len(self.scheduler.entries))
+        self.schedule_late = self.metrics.histogram("schedule_late_ms", (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000))
+        self.metrics.counter("trigger_runs", lambda: self.triggers.fired)
+        self.metrics.counter("trigger_suppressed", lambda: self.triggers.suppressed)
+        self.metrics.gauge("trigger_entries", lambda: len(self.triggers.by_name))
+        # Protocol whose captures are published on ir/last-captured-command, set by ir/listening-mode. The receivers
+        # also run for the protocols of the stored triggers, which don't publish anything on their own.
+        self.listening_mode = None
+        self.router = TopicRouter(config["topic_prefix"])
+        self.router.add("ir/listening-mode", self.start_listening_mode, PAYLOAD_TEXT)
+        self.router.add("ir/command", self.send_json_command, PAYLOAD_RAW, deduplicate=DEDUP_JSON)
+        self.router.add("ir/command/bin", self.send_binary_command, PAYLOAD_RAW, deduplicate=DEDUP_PID)
+        self.router.add("iscp/discover", self.iscp_discover, PAYLOAD_RAW)
+        self.router.add("iscp/command", self.on_iscp_command, PAYLOAD_JSON, deduplicate=DEDUP_JSON)
+        self.router.add("trace/dump", self.dump_traces, PAYLOAD_TEXT)
+        self.router.add("log/dump", self.dump_log, PAYLOAD_TEXT)
+        self._add_table("schedule", lambda: self.scheduler)
+        self._add_table("trigger", lambda: self.triggers, self.update_receivers)
+
+    def _setup(self) -> None:
+        from .ntp import NTPClient
+        from .scheduler import Scheduler
+        from .triggers import TriggerTable
+
+        config = self.config
+        self.ntp = NTPClient(
+            host=config.get("ntp_host", "pool.ntp.org"),
+            port=config.get("ntp_port", 123),
+            timeout_ms=config.get("ntp_timeout_ms", 1000),
+            max_error_ms=config.get("ntp_max_error_ms", 100),
+            min_interval_ms=config.get("ntp_min_interval", 60) * 1000,
+            max_interval_ms=config.get("ntp_max_interval", 86400) * 1000,
+            on_sync=self._on_ntp_sync,
+            phases=self.phases,
+        )
+        self.scheduler = Scheduler(
+            self.ntp.now_ms,
+            self._on_schedule_due,
+            path=config.get("schedule_path", "/schedule.json"),
+            size=config.get("schedule_size", 32),
+            grace_ms=config.get("schedule_grace", 300) * 1000,
+            utc_offset_min=config.get("schedule_utc_offset", 0),
+        )
+        self.triggers = TriggerTable(
+            path=config.get("trigger_path", "/triggers.json"),
+            size=config.get("trigger_size", 32),
+            cooldown_ms=config.get("trigger_cooldown_ms", 500),
+        )
+
+    @property
+    def iscp_handler(self):
+        # Built on the first ISCP message. Units without ISCP devices never import the ISCP stack.
+        if self._iscp_handler is None:
+            from .iscp_handler import ISCPHandler
+
+            config = self.config
+            self._iscp_handler = ISCPHandler(
+                idle_timeout_ms=config.get("iscp_idle_timeout", 300) * 1000,
+                probe_after_ms=config.get("iscp_probe_after", 30) * 1000,
+                cache_path=config.get("iscp_cache", "/iscp_cache.json"),
+                cache_ttl_s=config.get("iscp_cache_ttl", 86400),
+                negative_ttl_ms=config.get("iscp_negative_ttl", 30) * 1000,
+                discovery_interval_ms=config.get("iscp_discovery_interval", 10) * 1000,
+                skip_unchanged=config.get("iscp_skip_unchanged", False),
+                state_ttl_ms=config.get("iscp_state_ttl", 60) * 1000,
+                on_state_change=self._on_iscp_state_change,
+                clock=self.ntp.now_ms,
+            )
+            loop.create_task(self._iscp_handler.start())
+        return self._iscp_handler
 
     def stop(self):
         self.ir_handler.stop()
+        if self._iscp_handler is not None:
+            self._iscp_handler.stop()
+        self.loop_monitor.stop()
+        if self.ntp is not None:
+            self.ntp.stop()
+            self.scheduler.stop()
+        self.gc_policy.stop()
         self.stopped = True
 
     async def start(self):
         await self.client.connect()
+        # Nothing received runs before this returns: connect() only created the tasks which subscribe and read.
+        self._setup()
         loop.create_task(self.ir_handler.start())
+        loop.create_task(self.ntp.start())
+        loop.create_task(self.scheduler.start())
+        loop.create_task(self.gc_policy.start())
+        if self.loop_monitor.interval_ms:
+            loop.create_task(self.loop_monitor.start())
+        # Stored triggers work right after boot, without waiting for the backend to turn on listening mode.
+        self.update_receivers()
         while not self.stopped:
-            if self.ir_handler.is_listening:
-                sleep_ms = 1
-            else:
-                sleep_ms = 1000
-            await uasyncio.sleep_ms(sleep_ms)
+            # The receivers have their own decode task, nothing here has to run more often.
+            await uasyncio.sleep_ms(1000)
             await self.send_lifesign_if_necessary()
+            await self.send_metrics_if_necessary()
+
+    async def send_command(self, data: "Union[dict, Command]", trace=NO_TRACE) -> None:
+        trace.mark(STAGE_PARSED)
+        self.gc_policy.begin()
+        try:
+            await self._send_command(data, trace)
+        except RetriesExhausted:
+            self.command_errors.inc()
+        except Exception as e:
+            log.error("Command failed: %s", e)
+            self.command_errors.inc()
+            await self.send_error(str(e), as_dict(data))
+        finally:
+            self.gc_policy.end()
+
+    async def send_json_command(self, payload: bytes, trace=NO_TRACE) -> None:
+        try:
+            command = parse_command(payload)
+        except Exception as e:
+            await self.send_error("Could not parse command: {}".format(e))
+            return
+        await self.send_command(command, trace)
 
-    async def send_command(self, data: dict) -> None:
+    async def send_binary_command(self, payload: bytes, trace=NO_TRACE) -> None:
         try:
-            await self._send_command(data)
+            command = decode_binary_command(payload)
         except Exception as e:
-            print(e)
+            await self.send_error("Could not decode binary command: {}".format(e))
+            return
+        await self.send_command(command, trace)
+
+    async def _as_command(self, data: "Union[dict, Command]") -> "Optional[Command]":
+        if not isinstance(data, dict):
+            return data
+        try:
+            return from_dict(data)
+        except ValueError as e:
             await self.send_error(str(e), data)
+            return None
 
-    async def _send_command(self, data: dict) -> None:
-        data_type = data.get("type", "").upper()
-        if data_type == "NEC":
-            await self.send_nec_command(data)
-        if data_type == "RC6":
-            await self.send_rc6_command(data)
-        elif data_type == "ISCP":
-            await self.send_iscp_command(data)
-        elif data_type == "SCENE":
-            await self.play_scene(data)
-        elif data_type == "WAIT":
-            await uasyncio.sleep_ms(data.get("ms", data.get("s", 1) * 1000))
-        elif data_type == "REPEAT":
-            await self.play_repeat(data)
+    async def _send_command(self, data: "Union[dict, Command]", trace=NO_TRACE) -> None:
+        command = await self._as_command(data)
+        if command is None:
+            return
+        counter = self.command_counters.get(type(command), None)
+        if counter is not None:
+            counter.inc()
+        if isinstance(command, NECCommand):
+            await self.send_nec_command(command, trace)
+        elif isinstance(command, RC6Command):
+            await self.send_rc6_command(command, trace)
+        elif isinstance(command, ISCPCommand):
+            await self.send_iscp_command(command, trace)
+        elif isinstance(command, ISCPBatchCommand):
+            await self.send_iscp_batch_command(command, trace)
+        elif isinstance(command, SceneCommand):
+            await self.play_scene(command, trace)
+        elif isinstance(command, WaitCommand):
+            await uasyncio.sleep_ms(command.ms)
+        elif isinstance(command, RepeatCommand):
+            await self.play_repeat(command, trace)
         else:
-            await self.send_error("Unknown command type", data)
+            await self.send_error("Unknown command type", {"command": str(command)})
 
-    async def iscp_discover(self) -> None:
+    async def iscp_discover(self, _payload: bytes = None, trace=NO_TRACE) -> None:
         try:
-            print("Searching for ISCP devices on network")
+            log.info("Searching for ISCP devices on network")
             result = await self.iscp_handler.discover()
-            print("ISCP devices found: {}".format(result))
+            log.info("ISCP devices found: %s", result)
             await self.client.publish(self.topic_name("iscp/discover/result"), json.dumps(result), False, 0)
         except Exception as error:
-            print("Failed Discovering ISCP devices with error {}".format(error))
+            log.error("Failed discovering ISCP devices with error %s", error)
             await self.send_error("Failed discovering iscp devices with error {}".format(error))
 
-    async def send_iscp_command(self, data: dict) -> None:
-        if "identifier" not in data or "command" not in data or "argument" not in data:
-            await self.send_error("No identifier, command or argument provided in iscp payload", data)
-        identifier: str = data["identifier"]
-        command: str = data["command"]
-        argument: str = data["argument"]
-
-        retries = 0
-
-        check = False
-        result = None
-        while not check:
+    async def _retry_iscp(self, command: "Union[ISCPCommand, ISCPBatchCommand]", description: str, send):
+        breaker = self.iscp_breakers.get(command.identifier, None)
+        if breaker is None:
+            breaker = self.iscp_breakers[command.identifier] = CircuitBreaker(
+                self.config.get("iscp_breaker_threshold", 3), self.config.get("iscp_breaker_reset", 30) * 1000
+            )
+        if not breaker.allow():
+            await self.send_error(
+                "Could not send ISCP command {}. Device is down".format(description),
+                command.as_dict(),
+                {"attempts": 0, "failures": breaker.failures},
+            )
+            raise RetriesExhausted()
+
+        policy = self.iscp_retry_policy
+        started = time.ticks_ms()
+        attempt_ms = []
+        errors = []
+        for attempt in range(policy.attempts):
+            attempt_started = time.ticks_ms()
             try:
-                result = await self.iscp_handler.send(identifier, command, argument)
-                check = True
+                result = await send()
+                breaker.success()
+                return result
             except Exception as error:
-                await self.send_error(
-                    "Could not send ISCP command ({}, {}={}). Error: {}. Retry: {}".format(
-                        identifier, command, argument, error, retries
-                    ),
-                    data,
-                )
-                retries += 1
-                if retries > 3:
-                    raise error
-
-        if result is None:
-            await self.send_error("Could not send ISCP command ({}, {}={})".format(identifier, command, argument), data)
+                attempt_ms.append(time.ticks_diff(time.ticks_ms(), attempt_started))
+                errors.append(str(error))
+            if attempt + 1 >= policy.attempts:
+                break
+            await uasyncio.sleep_ms(policy.delay_ms(attempt))
+
+        # The breaker counts commands which failed all attempts, not single attempts.
+        breaker.failure()
+
+        await self.send_error(
+            "Could not send ISCP command {} after {} attempts".format(description, len(attempt_ms)),
+            command.as_dict(),
+            {
+                "attempts": len(attempt_ms),
+                "elapsed_ms": time.ticks_diff(time.ticks_ms(), started),
+                "attempt_ms": attempt_ms,
+                "errors": errors,
+            },
+        )
+        raise RetriesExhausted()
 
-        data["result"] = result
+    async def on_iscp_command(self, data: dict, trace=NO_TRACE) -> None:
+        if not isinstance(data, dict):
+            await self.send_error("ISCP command has to be a JSON object", {"command": str(data)})
+            return
         data["type"] = "ISCP"
-        await self._record_send_command(data)
+        await self.send_command(data, trace)
 
-    async def send_nec_command(self, data: dict) -> None:
-        if "command" not in data and "device_id" not in data:
-            await self.send_error("No command or device_id added in nec command", data)
+    async def send_iscp_command(self, data: "Union[dict, ISCPCommand]", trace=NO_TRACE) -> None:
+        command = await self._as_command(data)
+        if command is None:
             return
-        await self.ir_handler.send_nec(data["device_id"], data["command"])
-        await self._record_send_command(data)
+        identifier, iscp_command, argument, skip_unchanged = command
 
-    async def send_rc6_command(self, data: dict) -> None:
-        if "control" not in data or "information" not in data:
-            await self.send_error("No control or information added in rc9 command", data)
-        await self.ir_handler.send_rc6(
-            mode=data.get("mode", 0), control=data["control"], information=data["information"]
+        trace.mark(STAGE_TX_START)
+        result = await self._retry_iscp(
+            command,
+            "({}, {}={})".format(identifier, iscp_command, argument),
+            lambda: self.iscp_handler.send(identifier, iscp_command, argument, skip_unchanged),
+        )
+        trace.mark(STAGE_TX_DONE)
+
+        if result is None:
+            await self.send_error(
+                "Could not send ISCP command ({}, {}={})".format(identifier, iscp_command, argument), command.as_dict()
+            )
+
+        data = command.as_dict()
+        data["result"] = result
+        await self._record_send_command(data, trace)
+
+    async def send_iscp_batch_command(self, command: ISCPBatchCommand, trace=NO_TRACE) -> None:
+        trace.mark(STAGE_TX_START)
+        results = await self._retry_iscp(
+            command,
+            "batch to {}".format(command.identifier),
+            lambda: self.iscp_handler.send_batch(command.identifier, command.commands),
         )
-        await self._record_send_command(data)
+        trace.mark(STAGE_TX_DONE)
 
-    async def _record_send_command(self, data: dict) -> None:
-        await self.client.publish(self.topic_name("ir/last-sent-command"), json.dumps(data), False, 0)
+        data = command.as_dict()
+        data["results"] = results
+        await self._record_send_command(data, trace)
 
-    async def play_scene(self, data: dict) -> None:
-        if "scene" not in data or not isinstance(data["scene"], list):
-            await self.send_error("No scene in payload")
+    def _on_iscp_state_change(self, identifier: str) -> None:
+        # Changes often come in bursts (e.g. volume ramps). Publish them at most every 200ms per device.
+        if identifier in self._iscp_state_changed:
             return
+        self._iscp_state_changed.add(identifier)
+        loop.create_task(self._publish_iscp_state(identifier))
 
-        for item in data["scene"]:
-            await self._send_command(item)
+    async def _publish_iscp_state(self, identifier: str) -> None:
+        await uasyncio.sleep_ms(200)
+        self._iscp_state_changed.discard(identifier)
+        await self.client.publish(
+            self.topic_name("iscp/state/{}".format(identifier)),
+            json.dumps(self.iscp_handler.state.as_dict(identifier)),
+            True,
+            0,
+        )
 
-    async def play_repeat(self, data: dict) -> None:
-        repeats = data.get("count", 1)
-        if "item" not in data:
-            await self.send_error("No item in repeat configuration {}".format(data))
-        for _ in range(repeats):
-            await self._send_command(data["item"])
+    async def send_nec_command(self, command: NECCommand, trace=NO_TRACE) -> None:
+        await self.ir_handler.send_nec(command.device_id, command.command, trace, command.emitter)
+        await self._publish_sent_command(self._sent_payload(command), trace)
 
-    async def send_error(self, error_message: str, context: dict = None) -> None:
-        context = context or {}
+    async def send_rc6_command(self, command: RC6Command, trace=NO_TRACE) -> None:
+        await self.ir_handler.send_rc6(
+            mode=command.mode,
+            control=command.control,
+            information=command.information,
+            trace=trace,
+            emitter=command.emitter,
+        )
+        await self._publish_sent_command(self._sent_payload(command), trace)
+
+    def _sent_payload(self, command: "Union[NECCommand, RC6Command]") -> str:
+        # Remotes send the same few commands over and over. Serialize each of them once.
+        payload = self._sent_payloads.get(command, None)
+        if payload is None:
+            if len(self._sent_payloads) >= SENT_PAYLOAD_CACHE_SIZE:
+                self._sent_payloads.clear()
+            payload = self._sent_payloads[command] = json.dumps(command.as_dict())
+        return payload
+
+    async def _record_send_command(self, data: dict, trace=NO_TRACE) -> None:
+        await self._publish_sent_command(json.dumps(data), trace)
+
+    async def _publish_sent_command(self, payload: str, trace=NO_TRACE) -> None:
+        await self.client.publish(self.topic_name("ir/last-sent-command"), payload, False, 0)
+        trace.mark(STAGE_PUBLISHED)
+
+    async def play_scene(self, command: SceneCommand, trace=NO_TRACE) -> None:
+        if command.start_at is not None:
+            late_ms = await self._wait_for_start(command.start_at)
+            if late_ms is not None:
+                # Published while the first step is sent, not before it.
+                loop.create_task(self._publish_scene_start(command.start_at, late_ms))
+        for item in command.steps:
+            await self._send_command(item, trace)
+
+    async def _wait_for_start(self, start_at: int) -> "Optional[int]":
+        # Waits on the NTP clock, which is ticks_ms() plus the offset and drift of the last sync, and reports how
+        # late the scene started. The remaining time is checked again every second, so a sync during the wait
+        # moves the start with it. Without a synchronised clock the scene plays right away.
+        now = self.ntp.now_ms()
+        if now is None:
+            self.scene_unsynced.inc()
+            await self.send_error("Clock not synchronised, scene started immediately", {"start_at": start_at})
+            return None
+        remaining = start_at - now
+        if remaining > self.scene_max_wait_ms:
+            raise ValueError("start_at is more than {} s ahead".format(self.scene_max_wait_ms // 1000))
+        if remaining > SCENE_APPROACH_MS:
+            self.gc_policy.pause()
+            try:
+                while remaining > SCENE_APPROACH_MS:
+                    await uasyncio.sleep_ms(min(remaining - SCENE_APPROACH_MS, SCENE_RECHECK_MS))
+                    remaining = start_at - self.ntp.now_ms()
+            finally:
+                self.gc_policy.resume()
+        if remaining > SCENE_GC_MARGIN_MS:
+            # Collect now rather than during the scene.
+            self.gc_policy.collect()
+            remaining = start_at - self.ntp.now_ms()
+        if remaining > 0:
+            await uasyncio.sleep_ms(remaining)
+        late_ms = self.ntp.now_ms() - start_at
+        self.scene_late.observe(late_ms)
+        if log.level <= DEBUG:
+            log.debug("Scene due at %s started %s ms late", start_at, late_ms)
+        return late_ms
+
+    async def _publish_scene_start(self, start_at: int, late_ms: int) -> None:
         await self.client.publish(
-            self.topic_name("error"), json.dumps({"message": error_message, "context": context}), False, 0
+            self.topic_name("scene/started"),
+            json.dumps({"start_at": start_at, "late_ms": late_ms, "clock_error_ms": self.ntp.error_ms()}),
+            False,
+            0,
         )
-        gc.collect()
+
+    async def play_repeat(self, command: RepeatCommand, trace=NO_TRACE) -> None:
+        for _ in range(command.count):
+            await self._send_command(command.item, trace)
+
+    async def send_error(self, error_message: str, context: dict = None, details: dict = None) -> None:
+        context = context or {}
+        error = {"message": error_message, "context": context}
+        if details is not None:
+            error.update(details)
+        self.errors.inc()
+        await self.client.publish(self.topic_name("error"), json.dumps(error), False, 0)
+
+    def is_duplicate(self, message: bytes, deduplicate: int) -> bool:
+        # QoS 1 messages are redelivered after a reconnect. Drop them before parsing or transmitting anything.
+        pid = self.client.rx_pid
+        if pid is not None and deduplicate & DEDUP_PID:
+            if self.recent_pids.seen(pid) and self.client.rx_dup:
+                self.duplicates_pid.inc()
+                return True
+        if not deduplicate & DEDUP_REQUEST_ID:
+            return False
+        identifier = request_id(message)
+        if identifier is not None and self.recent_request_ids.seen(identifier):
+            self.duplicates_request_id.inc()
+            return True
+        return False
 
     def sub_cb(self, topic: bytes, message: bytes, retained: bool) -> None:
+        received = time.ticks_us()
+        self.phases.enter("sub_cb")
         try:
-            topic = topic.decode()
-            message = message.decode()
-            print("Topic = {} Payload = {} Retained = {}".format(topic, message, retained))
-            if topic.endswith("ir/command"):
-                loop.create_task(self.send_command(json.loads(message)))
-            elif topic.endswith("ir/listening-mode"):
-                loop.create_task(self.start_listening_mode(message))
-            elif topic.endswith("iscp/command"):
-                loop.create_task(self.send_iscp_command(json.loads(message)))
-            elif topic.endswith("iscp/discover"):
-                loop.create_task(self.iscp_discover())
-            else:
-                print("Unknown MQTT topic for subscription {}".format(topic))
+            if log.level <= DEBUG:
+                # Only log the start of the payload. Keeping a whole scene in the ring would pin it in memory.
+                log.debug("Topic = %s Payload = %s (%sB) Retained = %s", topic, message[:64], len(message), retained)
+            route = self.router.match(topic)
+            if route is None:
+                log.warning("Unknown MQTT topic for subscription %s", topic)
+                return
+            if route.deduplicate and self.is_duplicate(message, route.deduplicate):
+                log.info("Dropped duplicate message on topic %s", topic)
+                return
+            trace = self.tracer.begin(route.name)
+            trace.mark(STAGE_SOCKET_READ, self.client.rx_us)
+            trace.mark(STAGE_RECEIVED, received)
+            loop.create_task(self._dispatch(route, message, trace))
         except Exception as e:
-            print(e)
-            raise
+            # mqtt_as only handles OSError from the callback. Anything else would end its receive task.
+            log.error("Message on %s failed: %s", topic, e)
+            loop.create_task(self.send_error("Message on {} failed: {}".format(topic, e)))
+        finally:
+            self.phases.leave()
+
+    async def _dispatch(self, route, message: bytes, trace=NO_TRACE) -> None:
+        # Payloads are decoded in the task, so a malformed one only fails its own message.
+        try:
+            try:
+                payload = route.decode(message)
+            except ValueError as e:
+                await self.send_error("Could not decode message on {}: {}".format(route.name, e))
+                return
+            try:
+                await route.handler(payload, trace)
+            except (ValueError, TypeError, KeyError) as e:
+                # A payload of the wrong shape. Without this it would only end the task, unreported.
+                log.error("Message on %s failed: %s", route.name, e)
+                await self.send_error("Message on {} failed: {}".format(route.name, e))
+        finally:
+            trace.close()
 
     async def on_wifi(self, state: bool):
+        iscp_handler = self._iscp_handler
+        ntp = self.ntp
+        if state:
+            if ntp is not None:
+                ntp.network_available()
+            if iscp_handler is not None:
+                iscp_handler.network_available()
+        else:
+            self.wifi_drops.inc()
+            if ntp is not None:
+                ntp.network_lost()
+            if iscp_handler is not None:
+                iscp_handler.reset()
         await wifi_han(state)
-        self.iscp_handler.reset()
-
 
     async def subscribe_topics(self, client: MQTTClient):
-        await client.subscribe(self.topic_name("ir/listening-mode"), 1)
-        await client.subscribe(self.topic_name("ir/command"), 1)
-        await client.subscribe(self.topic_name("iscp/discover"), 1)
-        await client.subscribe(self.topic_name("iscp/command"), 1)
-        await self.send_lifesign()
-        print("Subscribed to topics and published livesign to {}".format(self.topic_name("livesign")))
+        start = time.ticks_ms()
+        self.mqtt_connects.inc()
+        await client.subscribe_many(self.router.subscriptions())
+        profiler.mark("subscribed")
+        timings = client.timings
+        timings["subscribe"] = time.ticks_diff(time.ticks_ms(), start)
+        if client.down_at is not None:
+            timings["ready"] = time.ticks_diff(time.ticks_ms(), client.down_at)
+        if self.mqtt_connects.value == 1:
+            timings["handler_ms"] = self.created_ms
+            timings["boot_ms"] = time.ticks_ms()
+        await self.send_lifesign(timings)
+        if not profiler.finished:
+            await self.send_boot_profile()
+        log.info("Subscribed to topics and published livesign. Connect timings: %s", timings)
+
+    def _on_ntp_sync(self, client: "NTPClient") -> None:
+        log.info(
+            "NTP sync: time %s ms, round trip %s ms, drift %s ppm", client.base_ms, client.rtt_ms, client.drift_ppm
+        )
+        profiler.mark("ntp")
+        self.scheduler.clock_changed()
+
+    async def send_boot_profile(self) -> None:
+        # Once per boot, retained, so the breakdown of the last boot of every unit can be collected.
+        profiler.mark("livesign")
+        await self.client.publish(self.topic_name("boot"), json.dumps(profiler.report()), True, 1)
+        profiler.finish()
 
     async def send_lifesign_if_necessary(self) -> None:
         if self.last_lifesign is None or self.last_lifesign + 5 * 1000 < time.ticks_ms():
             await self.send_lifesign()
 
-    async def send_lifesign(self) -> None:
-        await self.client.publish(
-            self.topic_name("livesign"), json.dumps({"ticks": time.ticks_ms(), "datetime": current_isotime()}), True, 0
-        )
+    async def send_lifesign(self, connect_timings: dict = None) -> None:
+        lifesign = {
+            "ticks": time.ticks_ms(),
+            "datetime": current_isotime(),
+            "suppressed_duplicates": {"request_id": self.duplicates_request_id.value, "pid": self.duplicates_pid.value},
+        }
+        if connect_timings is not None:
+            lifesign["connect"] = connect_timings
+        if not self.config.get("metrics_interval", 60):
+            lifesign["metrics"] = self.metrics.snapshot()
+        await self.client.publish(self.topic_name("livesign"), json.dumps(lifesign), True, 0)
         self.last_lifesign = time.ticks_ms()
 
+    async def send_metrics_if_necessary(self) -> None:
+        # With a metrics_interval of 0 the metrics are part of every livesign instead.
+        interval_ms = self.config.get("metrics_interval", 60) * 1000
+        if not interval_ms:
+            return
+        if self.last_metrics is None or time.ticks_diff(time.ticks_ms(), self.last_metrics) >= interval_ms:
+            self.last_metrics = time.ticks_ms()
+            await self.client.publish(self.topic_name("metrics"), json.dumps(self.metrics.snapshot()), False, 0)
+
     def topic_name(self, name: str) -> str:
-        return topic_name(self.config, name)
+        topic = self._topics.get(name, None)
+        if topic is None:
+            topic = self._topics[name] = topic_name(self.config, name)
+        return topic
+
+    async def dump_traces(self, request: str, trace=NO_TRACE) -> None:
+        # "stats" returns p50/p95 per stage over the ring, optionally followed by a label ("stats trigger") to only
+        # include those traces. Anything else returns the most recent traces.
+        parts = request.split()
+        if parts and parts[0] == "stats":
+            result = self.tracer.stats(parts[1] if len(parts) > 1 else None)
+        else:
+            result = self.tracer.recent()
+        await self.client.publish(self.topic_name("trace/result"), json.dumps(result), False, 0)
+
+    async def dump_log(self, request: str, trace=NO_TRACE) -> None:
+        # An optional level name ("warning") to filter on, followed by the maximum number of records.
+        level, limit = DEBUG, None
+        for part in request.split():
+            if part.isdigit():
+                limit = int(part)
+            else:
+                level = parse_level(part, default=DEBUG)
+        await self.client.publish(self.topic_name("log/result"), json.dumps(log.dump(level, limit)), False, 0)
 
-    async def start_listening_mode(self, mode: str) -> None:
+    def _add_table(self, name: str, get_table, on_change=None) -> None:
+        # Tables changed at runtime (schedule, triggers) share their topics: <name>/set with a JSON entry,
+        # <name>/remove with the name of an entry and <name>/list, all answered with the table on <name>/result.
+        # get_table returns the table, which only exists after start(). on_change is called after every change.
+        async def publish(request: str = "", trace=NO_TRACE) -> None:
+            await self.client.publish(self.topic_name(name + "/result"), json.dumps(get_table().as_dict()), False, 0)
+
+        async def set_entry(data: dict, trace=NO_TRACE) -> None:
+            try:
+                get_table().set(data)
+            except (TypeError, ValueError) as e:
+                await self.send_error("Could not set {} entry: {}".format(name, e), data)
+                return
+            if on_change is not None:
+                on_change()
+            await publish()
+
+        async def remove_entry(entry: str, trace=NO_TRACE) -> None:
+            if not get_table().remove(entry.strip()):
+                await self.send_error("Unknown {} entry {}".format(name, entry.strip()))
+                return
+            if on_change is not None:
+                on_change()
+            await publish()
+
+        self.router.add(name + "/set", set_entry, PAYLOAD_JSON, deduplicate=DEDUP_JSON)
+        self.router.add(name + "/remove", remove_entry, PAYLOAD_TEXT)
+        self.router.add(name + "/list", publish, PAYLOAD_TEXT)
+
+    async def _run_stored(self, name: str, payload: bytes, trace=NO_TRACE) -> None:
+        # Commands of the schedule and of triggers.
+        log.info("Running %s", name)
+        try:
+            try:
+                command = parse_command(payload)
+            except Exception as e:
+                await self.send_error("Could not parse stored command of {}: {}".format(name, e))
+                return
+            await self.send_command(command, trace)
+        finally:
+            trace.close()
+
+    def _on_schedule_due(self, entry, late_ms: int) -> None:
+        self.schedule_late.observe(late_ms)
+        trace = self.tracer.begin("schedule")
+        trace.mark(STAGE_RECEIVED)
+        loop.create_task(self._run_stored(entry.name, entry.command, trace))
+
+    async def _run_trigger(self, trigger, trace=NO_TRACE) -> None:
+        trigger.running = True
+        try:
+            await self._run_stored(trigger.name, trigger.action, trace)
+        finally:
+            trigger.running = False
+
+    async def start_listening_mode(self, mode: str, trace=NO_TRACE) -> None:
         self.record_mode(mode)
 
     def record_mode(self, mode: str) -> None:
-        self.ir_handler.record_mode(mode, self._on_message_callback)
+        mode = mode.strip().upper() if isinstance(mode, str) else None
+        if mode is not None and mode not in ("NEC", "RC6"):
+            if mode:
+                log.warning('Unknown mode requested for listening to IR signals "%s"', mode)
+            mode = None
+        self.listening_mode = mode
+        self.update_receivers()
+
+    def update_receivers(self) -> None:
+        protocols = self.triggers.protocols()
+        if self.listening_mode is not None:
+            protocols.add(self.listening_mode)
+        self.ir_handler.receive(protocols, self._on_message_callback)
+
+    def _on_message_callback(self, message, receiver: str, frame_us: "Optional[int]" = None):
+        # Triggers run before anything else happens with the message, the capture is published afterwards.
+        trigger = self.triggers.match(message)
+        if trigger is not None:
+            trace = self.tracer.begin("trigger")
+            if frame_us is not None:
+                trace.mark(STAGE_CAPTURED, frame_us)
+            trace.mark(STAGE_RECEIVED)
+            loop.create_task(self._run_trigger(trigger, trace))
+        if self.listening_mode is None:
+            return
+        from .triggers import message_protocol
 
-    def _on_message_callback(self, message):
-        print("Captured IR Command", message)
+        if message_protocol(message) != self.listening_mode:
+            return
+        log.info("Captured IR Command %s on %s", message, receiver)
         message_dict = message.as_dict()
+        message_dict["receiver"] = receiver
+        if trigger is not None:
+            message_dict["trigger"] = trigger.name
         message_dict["ticks"] = time.ticks_ms()
         loop.create_task(
             self.client.publish(self.topic_name("ir/last-captured-command"), json.dumps(message_dict), False, 1)
@@ -1,74 +1,236 @@
 import uasyncio
-from ir.ir_rx import NEC as NECRx
-from ir.ir_rx import RC6 as RC6Rx
-from ir.ir_rx import NECMessage, RC6Message
-from ir.ir_tx import NEC as NECTx
-from ir.ir_tx import RC6 as RC6Tx
 from machine import Pin
+from micropython import const
+from ringlog import DEBUG, log
 
+from .loop_monitor import NO_PHASES
+from .tracing import NO_TRACE, STAGE_QUEUED, STAGE_TX_DONE, STAGE_TX_START
 
-class IRHandler:
-    def __init__(self, config):
-        self.tx_pin = Pin(config["tx_pin"], Pin.OUT)
-        self.rx_pin = Pin(config["rx_pin"], Pin.IN)
-        self.nec_tx = NECTx(self.tx_pin)
-        self.rc6_tx = RC6Tx(self.tx_pin, rmt=self.nec_tx.rmt)
-        self.receiver = None
-        self.buffer = []
+PROTOCOL_NEC = const(0)
+PROTOCOL_RC6 = const(1)
+
+SLOT_FREE = const(0)
+SLOT_QUEUED = const(1)
+SLOT_DONE = const(2)
+SLOT_FAILED = const(3)
+
+TX_POLL_MS = const(2)
+
+
+class QueuedMessage:
+    # Slot of the send queue. The slots are allocated once and reused, so queueing a frame doesn't allocate.
+    # NEC uses address/command, RC6 mode/address (control)/command (information).
+    def __init__(self):
+        self.protocol = PROTOCOL_NEC
+        self.mode = 0
+        self.address = 0
+        self.command = 0
+        self.trace = NO_TRACE
+        self.state = SLOT_FREE
+
+
+class Emitter:
+    # One IR LED with its own pin, RMT channel and send queue. The RMT transmits in the background, so the
+    # emitters wait for their frames asynchronously and frames for different emitters go out in parallel.
+    def __init__(self, name: str, pin: int, rmt_number: int = 0, queue_size: int = 8, phases=NO_PHASES):
+        self.name = name
+        self.pin = Pin(pin, Pin.OUT)
+        self.rmt_number = rmt_number
+        self.phases = phases
+        self._nec_tx = None
+        self._rc6_tx = None
+        self.slots = [QueuedMessage() for _ in range(queue_size)]
+        self.head = 0
+        self.tail = 0
+        self.tx_frames = 0
         self.stopped = False
-        self.callback = None
+        # Set when a frame is queued, so a frame goes out right away instead of on the next poll.
+        self.wakeup = uasyncio.Event()
 
     @property
-    def is_listening(self) -> bool:
-        return self.receiver is not None
+    def nec_tx(self):
+        if self._nec_tx is None:
+            from ir.ir_tx import NEC
 
-    def record_mode(self, mode: str, callback) -> None:
-        if self.receiver is not None:
-            self.receiver.close()
-            self.receiver = None
-        self.callback = callback
+            self._nec_tx = NEC(self.pin, rmt_number=self.rmt_number)
+        return self._nec_tx
 
-        if isinstance(mode, str) and mode.upper() == "NEC":
-            self.receiver = NECRx(self.rx_pin, callback)
-            return
-        elif isinstance(mode, str) and mode.upper() == "RC6":
-            self.receiver = RC6Rx(self.rx_pin, callback)
-            return
-        elif mode is not None:
-            print('Unknown mode requested for listening to IR signals "{}"'.format(mode))
-
-    async def send_nec(self, device_id: int, command: int) -> None:
-        print("Adding NECMessage({}, {}) to send buffer".format(device_id, command))
-        nec_message = NECMessage(device_id, command)
-        self.buffer.append(nec_message)
-        while nec_message in self.buffer:
-            await uasyncio.sleep_ms(1)
+    @property
+    def rc6_tx(self):
+        if self._rc6_tx is None:
+            from ir.ir_tx import RC6
+
+            self._rc6_tx = RC6(self.pin, rmt=self.nec_tx.rmt)
+        return self._rc6_tx
 
-    async def send_rc6(self, control: int, information: int, mode: int = 0) -> None:
-        print("Adding RC6Message({}, {}, {}) to send buffer".format(mode, control, information))
-        rc6_message = RC6Message(mode, control, information)
-        self.buffer.append(rc6_message)
-        while rc6_message in self.buffer:
+    async def enqueue(self, protocol: int, mode: int, address: int, command: int, trace) -> None:
+        # The sender waits on its own slot, so two identical messages in flight are waited on separately.
+        # A slot is only released by its sender, so a full queue holds further senders back.
+        slot = self.slots[self.tail]
+        while slot.state != SLOT_FREE:
             await uasyncio.sleep_ms(1)
+            slot = self.slots[self.tail]
+        self.tail = (self.tail + 1) % len(self.slots)
+        slot.protocol = protocol
+        slot.mode = mode
+        slot.address = address
+        slot.command = command
+        slot.trace = trace
+        slot.state = SLOT_QUEUED
+        self.wakeup.set()
+        trace.mark(STAGE_QUEUED)
+        while slot.state != SLOT_DONE and slot.state != SLOT_FAILED:
+            await uasyncio.sleep_ms(1)
+        failed = slot.state == SLOT_FAILED
+        slot.trace = NO_TRACE
+        slot.state = SLOT_FREE
+        if failed:
+            raise OSError("IR transmission on {} failed".format(self.name))
 
     def stop(self) -> None:
         self.stopped = True
+        self.wakeup.set()
+
+    async def _transmit(self, queued: QueuedMessage) -> None:
+        queued.trace.mark(STAGE_TX_START)
+        self.phases.enter("ir_tx")
+        try:
+            if queued.protocol == PROTOCOL_NEC:
+                transmitter = self.nec_tx
+                transmitter.send(queued.address, queued.command)
+            else:
+                transmitter = self.rc6_tx
+                transmitter.send(header=queued.mode, control=queued.address, information=queued.command)
+        finally:
+            self.phases.leave()
+        while not transmitter.rmt.wait_done():
+            await uasyncio.sleep_ms(TX_POLL_MS)
+        queued.trace.mark(STAGE_TX_DONE)
 
     async def start(self) -> None:
         while not self.stopped:
-            await uasyncio.sleep_ms(100)
-            if len(self.buffer) > 0:
+            queued = self.slots[self.head]
+            if queued.state != SLOT_QUEUED:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+            else:
                 try:
-                    item = self.buffer[0]
-                    if isinstance(item, NECMessage):
-                        print("SENDING ", item)
-                        self.nec_tx.send(item.device_id, item.command)
-                        await uasyncio.sleep_ms(100)
-                    if isinstance(item, RC6Message):
-                        print("SENDING", item)
-                        self.rc6_tx.send(header=item.header, control=item.control, information=item.information)
-                        await uasyncio.sleep_ms(100)
-                    self.buffer.remove(item)
+                    await self._transmit(queued)
+                    await uasyncio.sleep_ms(100)
+                    self.tx_frames += 1
+                    queued.state = SLOT_DONE
                 except Exception as e:
-                    print(e)
-                    raise
+                    # The sender gets the error and the queue goes on with the next frame.
+                    log.error("IR transmission on %s failed: %s", self.name, e)
+                    queued.state = SLOT_FAILED
+                self.head = (self.head + 1) % len(self.slots)
+
+
+class IRHandler:
+    # The IR stacks are imported and the RMT is set up on first use, so they don't delay the MQTT connect
+    # and units which never listen don't keep the decoders in memory.
+    def __init__(self, config):
+        self.phases = config.get("phases", None) or NO_PHASES
+        emitters = config.get("emitters", None) or [{"name": "default", "pin": config["tx_pin"], "rmt_number": 0}]
+        # Commands without an emitter go to the first one.
+        self.emitters: "Dict[str, Emitter]" = {}
+        self.default_emitter = None
+        channels = set()
+        for settings in emitters:
+            name = settings.get("name", "default")
+            rmt_number = settings.get("rmt_number", len(self.emitters))
+            if name in self.emitters or rmt_number in channels:
+                raise ValueError("Emitter {} reuses a name or the RMT channel {}".format(name, rmt_number))
+            channels.add(rmt_number)
+            emitter = self.emitters[name] = Emitter(
+                name, settings["pin"], rmt_number, config.get("ir_queue_size", 8), self.phases
+            )
+            if self.default_emitter is None:
+                self.default_emitter = emitter
+        self.receivers = config.get("receivers", None) or [{"name": "default", "pin": config["rx_pin"]}]
+        self.rx_pins: "Dict[str, Pin]" = {}
+        self.worker = None
+        self.protocols: "Tuple[str]" = ()
+        self._decode_failures = 0
+        self._duplicates = 0
+        self.rx_dedup_ms = config.get("rx_dedup_ms", 150)
+
+    @property
+    def tx_frames(self) -> int:
+        return sum(emitter.tx_frames for emitter in self.emitters.values())
+
+    @property
+    def decode_failures(self) -> int:
+        current = self.worker.decode_failures if self.worker is not None else 0
+        return self._decode_failures + current
+
+    @property
+    def rx_duplicates(self) -> int:
+        current = self.worker.duplicates if self.worker is not None else 0
+        return self._duplicates + current
+
+    def emitter(self, name: "Optional[str]" = None) -> Emitter:
+        if name is None:
+            return self.default_emitter
+        emitter = self.emitters.get(name, None)
+        if emitter is None:
+            raise ValueError("Unknown emitter {}".format(name))
+        return emitter
+
+    def _rx_pin(self, name: str, pin: int) -> Pin:
+        rx_pin = self.rx_pins.get(name, None)
+        if rx_pin is None:
+            rx_pin = self.rx_pins[name] = Pin(pin, Pin.IN)
+        return rx_pin
+
+    def receive(self, protocols: "Tuple[str]", callback) -> None:
+        # Captures the given protocols ("NEC", "RC6") on every receiver, nothing for an empty tuple. callback is
+        # called with the decoded message, the name of the receiver which captured it and the ticks_us() of the end
+        # of the frame. The receivers are only rebuilt if the protocols change.
+        protocols = tuple(sorted(protocols))
+        if protocols == self.protocols:
+            return
+        if self.worker is not None:
+            self._decode_failures += self.worker.decode_failures
+            self._duplicates += self.worker.duplicates
+            self.worker.close()
+            self.worker = None
+        self.protocols = protocols
+        if not protocols:
+            return
+
+        from ir.ir_rx import NEC, RC6, DecodeWorker, MultiProtocol
+
+        receiver_types = tuple(NEC if protocol == "NEC" else RC6 for protocol in protocols)
+        self.worker = DecodeWorker(callback, dedup_ms=self.rx_dedup_ms)
+        for settings in self.receivers:
+            name = settings.get("name", "default")
+            pin = self._rx_pin(name, settings["pin"])
+            if len(receiver_types) == 1:
+                self.worker.add(receiver_types[0](pin, name))
+            else:
+                self.worker.add(MultiProtocol(pin, receiver_types, name))
+        uasyncio.create_task(self.worker.start())
+
+    async def send_nec(self, device_id: int, command: int, trace=NO_TRACE, emitter: str = None) -> None:
+        target = self.emitter(emitter)
+        if log.level <= DEBUG:
+            log.debug("Adding NECMessage(%s, %s) to send buffer of %s", device_id, command, target.name)
+        await target.enqueue(PROTOCOL_NEC, 0, device_id, command, trace)
+
+    async def send_rc6(
+        self, control: int, information: int, mode: int = 0, trace=NO_TRACE, emitter: str = None
+    ) -> None:
+        target = self.emitter(emitter)
+        if log.level <= DEBUG:
+            log.debug("Adding RC6Message(%s, %s, %s) to send buffer of %s", mode, control, information, target.name)
+        await target.enqueue(PROTOCOL_RC6, mode, control, information, trace)
+
+    def stop(self) -> None:
+        for emitter in self.emitters.values():
+            emitter.stop()
+        if self.worker is not None:
+            self.worker.close()
+
+    async def start(self) -> None:
+        await uasyncio.gather(*(emitter.start() for emitter in self.emitters.values()))
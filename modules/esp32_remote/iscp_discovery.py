@@ -0,0 +1,125 @@
+import time
+from collections import namedtuple
+
+import uasyncio
+from eiscp import discover
+from ringlog import log
+
+from . import store
+
+ISCP_DEFAULT_PORT = 60128
+
+
+class ISCPDevice(namedtuple("ISCPDevice", ("identifier", "host", "port", "info", "seen"))):
+    def as_dict(self) -> dict:
+        return {"host": self.host, "port": self.port, "info": self.info, "seen": self.seen}
+
+
+class ISCPDirectory:
+    # Known ISCP devices persisted on flash, so commands after a reboot go straight to the
+    # cached address. Identifiers which weren't found are cached negatively for a short time
+    # and lookups share a single rate limited discovery broadcast.
+    # clock returns Unix ms or None before it is synchronized, the system time is used without one. Devices
+    # discovered before the clock was synchronized are stored without a seen time.
+    def __init__(
+        self,
+        path: str = "/iscp_cache.json",
+        ttl_s: int = 86400,
+        negative_ttl_ms: int = 30000,
+        min_interval_ms: int = 10000,
+        clock=None,
+    ):
+        self.path = path
+        self.clock = clock
+        self.ttl_s = ttl_s
+        self.negative_ttl_ms = negative_ttl_ms
+        self.min_interval_ms = min_interval_ms
+        self.devices: "Dict[str, ISCPDevice]" = {}
+        self.negative: "Dict[str, int]" = {}
+        # Devices whose address failed. They are kept, but the next lookup discovers them again first.
+        self.stale: "Set[str]" = set()
+        self._in_flight = None
+        self._last_discovery = None
+        self.load()
+
+    def load(self) -> None:
+        data = store.load(self.path)
+        if not isinstance(data, dict):
+            return
+        for identifier, item in data.items():
+            try:
+                self.devices[identifier] = ISCPDevice(
+                    identifier,
+                    item["host"],
+                    item.get("port", ISCP_DEFAULT_PORT),
+                    item.get("info", {}),
+                    item.get("seen", None),
+                )
+            except (KeyError, TypeError, AttributeError):
+                log.warning("Dropped ISCP cache entry %s", identifier)
+
+    def save(self) -> None:
+        store.save(self.path, dict((identifier, device.as_dict()) for identifier, device in self.devices.items()))
+
+    def _now_s(self) -> "Optional[int]":
+        if self.clock is None:
+            return int(time.time())
+        now = self.clock()
+        return None if now is None else now // 1000
+
+    def is_expired(self, device: ISCPDevice) -> bool:
+        now = self._now_s()
+        if now is None:
+            # The age is unknown until the clock is synchronized. Keep using the entry.
+            return False
+        # Entries seen without a synchronized clock are discovered again once it is.
+        return device.seen is None or now - device.seen > self.ttl_s
+
+    def invalidate(self, identifier: str) -> None:
+        # Called on every failed connect, which is often transient. The device keeps its last address until a
+        # discovery finds a new one, and nothing is written to flash.
+        if identifier in self.devices:
+            self.stale.add(identifier)
+
+    async def discover(self, force: bool = False) -> "List[ISCPDevice]":
+        if self._in_flight is not None:
+            await self._in_flight.wait()
+            return list(self.devices.values())
+        last = self._last_discovery
+        if not force and last is not None and time.ticks_diff(time.ticks_ms(), last) < self.min_interval_ms:
+            return list(self.devices.values())
+
+        event = self._in_flight = uasyncio.Event()
+        try:
+            now = self._now_s()
+            for item in await discover():
+                self.devices[item.identifier] = ISCPDevice(item.identifier, item.host, item.port, item.info, now)
+                self.negative.pop(item.identifier, None)
+                self.stale.discard(item.identifier)
+            self.save()
+        finally:
+            self._in_flight = None
+            self._last_discovery = time.ticks_ms()
+            event.set()
+        return list(self.devices.values())
+
+    async def lookup(self, identifier: str) -> "Optional[ISCPDevice]":
+        device = self.devices.get(identifier, None)
+        stale = identifier in self.stale
+        if device is not None and not stale and not self.is_expired(device):
+            return device
+
+        expires = self.negative.get(identifier, None)
+        if expires is not None and device is None:
+            if time.ticks_diff(expires, time.ticks_ms()) > 0:
+                return None
+            del self.negative[identifier]
+
+        # A failed address is discovered again right away, once. If the device doesn't answer the broadcast, its
+        # last address is still used and it isn't cached negatively.
+        self.stale.discard(identifier)
+        await self.discover(force=stale)
+        device = self.devices.get(identifier, None)
+        if device is None:
+            self.negative[identifier] = time.ticks_add(time.ticks_ms(), self.negative_ttl_ms)
+        return device
@@ -1,55 +1,137 @@
-from collections import namedtuple
+from ringlog import log
 from uasyncio import Lock
 
-from eiscp import discover, eISCP
-
-
-class ISCPCommand(namedtuple("ISCPCommand", ("identifier", "command", "argument"))):
-    @property
-    def expect_response(self) -> bool:
-        return True
+from .commands import ISCPCommand
+from .iscp_discovery import ISCPDirectory
+from .iscp_pool import ISCPPool
+from .iscp_state import ISCPStateMirror
 
 
 class ISCPHandler:
-    def __init__(self):
-        self.known_iscps: "Dict[str, eISCP]" = {}
+    def __init__(
+        self,
+        idle_timeout_ms: int = 300000,
+        probe_after_ms: int = 30000,
+        cache_path: str = "/iscp_cache.json",
+        cache_ttl_s: int = 86400,
+        negative_ttl_ms: int = 30000,
+        discovery_interval_ms: int = 10000,
+        skip_unchanged: bool = False,
+        state_ttl_ms: int = 60000,
+        on_state_change=None,
+        clock=None,
+    ):
+        self.directory = ISCPDirectory(
+            path=cache_path,
+            ttl_s=cache_ttl_s,
+            negative_ttl_ms=negative_ttl_ms,
+            min_interval_ms=discovery_interval_ms,
+            clock=clock,
+        )
         self.known_iscps_lock: "Dict[str, Lock]" = {}
+        self.skip_unchanged = skip_unchanged
+        self.state = ISCPStateMirror(freshness_ms=state_ttl_ms, on_change=on_state_change)
+        self.pool = ISCPPool(
+            idle_timeout_ms=idle_timeout_ms, probe_after_ms=probe_after_ms, on_message=self.state.update
+        )
 
     def reset(self) -> None:
-        self.known_iscps = {}
-        self.known_iscps_lock = {}
+        # Called when WiFi goes down. Known devices and the pool entries are kept and the
+        # connections are reopened in the background once the network is back.
+        self.pool.disconnect_all()
+
+    def network_available(self) -> None:
+        self.pool.network_available()
+
+    async def start(self) -> None:
+        await self.pool.start()
 
-    async def _update_known_iscps(self) -> None:
-        self.known_iscps.update(dict((item.identifier, item) for item in await discover()))
+    def stop(self) -> None:
+        self.pool.stop()
 
     async def discover(self) -> "List[Dict[str, str]]":
-        await self._update_known_iscps()
-        return list(iscp.info for iscp in self.known_iscps.values())
+        return list(device.info for device in await self.directory.discover(force=True))
+
+    def _from_state(self, identifier: str, command: str, argument: str, skip_unchanged: bool) -> "Optional[str]":
+        # Values are trusted while the connection is open as the receiver pushes every change on it.
+        # Otherwise only within the freshness window.
+        max_age_ms = None if self.pool.is_connected(identifier) else self.state.freshness_ms
+        if argument == "QSTN":
+            return self.state.get(identifier, command, self.state.freshness_ms)
+        if skip_unchanged and self.state.get(identifier, command, max_age_ms) == argument:
+            return argument
+        return None
+
+    async def _lookup(self, identifier: str):
+        # An unknown device is an error like a failed connect, so the caller retries it and counts it for the breaker.
+        iscp = await self.directory.lookup(identifier)
+        if iscp is None:
+            log.warning("Didn't find ISCP target with identifier %s", identifier)
+            raise OSError("Didn't find ISCP target with identifier {}".format(identifier))
+        return iscp
+
+    async def send(
+        self, identifier: str, command: str, argument: str, skip_unchanged: bool = None
+    ) -> "Optional[Tuple[str, str]]":
+        if skip_unchanged is None:
+            skip_unchanged = self.skip_unchanged
+        known = self._from_state(identifier, command, argument, skip_unchanged)
+        if known is not None:
+            log.debug("ISCP command(%s, %s=%s) answered from state mirror", identifier, command, argument)
+            return command, known
 
-    async def send(self, identifier: str, command: str, argument: str) -> "Optional[Tuple[str, str]]":
-        print("Sending ISCP command({}, {}={}) to send buffer".format(identifier, command, argument))
-        iscp_command = ISCPCommand(identifier, command, argument)
+        log.debug("Sending ISCP command(%s, %s=%s) to send buffer", identifier, command, argument)
+        iscp_command = ISCPCommand(identifier, command, argument, skip_unchanged)
 
         lock = self.known_iscps_lock.setdefault(identifier, Lock())
 
         async with lock:
-            iscp = await self._get_or_query(identifier)
-            if iscp is None:
-                print("Didn't find ISCP target with identifier {}".format(identifier))
-                return None
-            print("Found ISCP device for sending to {} ({})".format(identifier, iscp.info))
+            iscp = await self._lookup(identifier)
+            log.debug("Found ISCP device for sending to %s (%s)", identifier, iscp.info)
 
             try:
-                result = await iscp.command(iscp_command.command, iscp_command.argument, iscp_command.expect_response)
-            except ValueError:
-                print("ISCP timeout for ISCP command {}".format(iscp_command))
-                result = None
+                connection = await self.pool.get(identifier, iscp.host, iscp.port)
+            except OSError:
+                # The device might have a new address. Look it up again on the next attempt.
+                self.directory.invalidate(identifier)
+                raise
+            try:
+                result = await connection.command(
+                    iscp_command.command, iscp_command.argument, iscp_command.expect_response
+                )
+            except OSError:
+                self.pool.evict(identifier)
+                raise
+            if result is None and iscp_command.expect_response:
+                log.warning("ISCP timeout for ISCP command %s", iscp_command)
 
         return result
 
-    async def _get_or_query(self, identifier: str) -> "Optional[eISCP]":
-        if identifier in self.known_iscps:
-            return self.known_iscps[identifier]
+    async def send_batch(
+        self, identifier: str, commands: "Sequence[ISCPBatchItem]"
+    ) -> "List[Optional[Tuple[str, str]]]":
+        known = [self._from_state(identifier, item.command, item.argument, self.skip_unchanged) for item in commands]
+        pending = [item for item, value in zip(commands, known) if value is None]
+        results = iter(await self._send_batch(identifier, pending) if pending else ())
+        return [(item.command, value) if value is not None else next(results) for item, value in zip(commands, known)]
+
+    async def _send_batch(
+        self, identifier: str, commands: "Sequence[ISCPBatchItem]"
+    ) -> "List[Optional[Tuple[str, str]]]":
+        # Pipelines all commands to the device: one write and about one round trip for the whole batch.
+        log.debug("Sending batch of %s ISCP commands to %s", len(commands), identifier)
+        lock = self.known_iscps_lock.setdefault(identifier, Lock())
 
-        await self._update_known_iscps()
-        return self.known_iscps.get(identifier, None)
+        async with lock:
+            iscp = await self._lookup(identifier)
+
+            try:
+                connection = await self.pool.get(identifier, iscp.host, iscp.port)
+            except OSError:
+                self.directory.invalidate(identifier)
+                raise
+            try:
+                return await connection.send_batch(commands)
+            except OSError:
+                self.pool.evict(identifier)
+                raise
@@ -0,0 +1,230 @@
+import struct
+import time
+
+import uasyncio
+import usocket as socket
+from micropython import const
+from ringlog import log
+
+ISCP_HEADER_SIZE = const(16)
+ISCP_VERSION = const(1)
+ISCP_TIMEOUT_MS = const(2000)
+PROBE_TIMEOUT_MS = const(500)
+PROBE_COMMAND = "PWR"
+RECONNECT_INTERVAL_MS = const(5000)
+# lwIP values as fallback where the socket module doesn't export them.
+SOL_SOCKET = getattr(socket, "SOL_SOCKET", 0xFFF)
+SO_KEEPALIVE = getattr(socket, "SO_KEEPALIVE", 0x0008)
+
+
+def encode_frame(command: str, argument: str) -> bytes:
+    data = "!1{}{}\r".format(command, argument).encode()
+    return b"ISCP" + struct.pack(">IIB3x", ISCP_HEADER_SIZE, len(data), ISCP_VERSION) + data
+
+
+def decode_message(data: bytes) -> "Tuple[str, str]":
+    message = data.decode().rstrip("\x1a\r\n")
+    if message.startswith("!"):
+        message = message[2:]
+    return message[:3], message[3:]
+
+
+class _Pending:
+    def __init__(self):
+        self.event = uasyncio.Event()
+        self.result = None
+
+
+class ISCPConnection:
+    def __init__(self, identifier: str, host: str, port: int, on_message=None):
+        self.identifier = identifier
+        self.on_message = on_message
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+        self.last_used = time.ticks_ms()
+        self.last_rx = time.ticks_ms()
+        self.last_attempt = None
+        self.pending: "Dict[str, List[_Pending]]" = {}
+        self.lock = uasyncio.Lock()
+
+    @property
+    def connected(self) -> bool:
+        return self.writer is not None
+
+    def retry_due(self) -> bool:
+        return self.last_attempt is None or time.ticks_diff(time.ticks_ms(), self.last_attempt) > RECONNECT_INTERVAL_MS
+
+    def idle_ms(self) -> int:
+        return time.ticks_diff(time.ticks_ms(), self.last_used)
+
+    async def open(self) -> None:
+        self.last_attempt = time.ticks_ms()
+        self.reader, self.writer = await uasyncio.open_connection(self.host, self.port)
+        self._set_keepalive()
+        self.last_rx = time.ticks_ms()
+        uasyncio.create_task(self._read_loop(self.reader))
+
+    def _set_keepalive(self) -> None:
+        sock = getattr(self.writer, "s", None) or self.writer.get_extra_info("socket")
+        try:
+            sock.setsockopt(SOL_SOCKET, SO_KEEPALIVE, 1)
+        except Exception:
+            pass
+
+    def close(self) -> None:
+        writer = self.writer
+        self.reader = self.writer = None
+        if writer is not None:
+            try:
+                writer.close()
+            except Exception:
+                pass
+        for waiters in self.pending.values():
+            for pending in waiters:
+                pending.event.set()
+        self.pending = {}
+
+    async def _read_frame(self, reader) -> "Tuple[str, str]":
+        header = await reader.readexactly(ISCP_HEADER_SIZE)
+        if header[0:4] != b"ISCP":
+            raise OSError("Invalid eISCP header")
+        header_size, data_size = struct.unpack_from(">II", header, 4)
+        if header_size > ISCP_HEADER_SIZE:
+            await reader.readexactly(header_size - ISCP_HEADER_SIZE)
+        return decode_message(await reader.readexactly(data_size))
+
+    async def _read_loop(self, reader) -> None:
+        try:
+            while reader is self.reader:
+                command, argument = await self._read_frame(reader)
+                self.last_rx = time.ticks_ms()
+                self._on_message(command, argument)
+        except Exception as e:
+            if reader is self.reader:
+                log.warning("ISCP connection to %s lost: %s", self.identifier, e)
+                self.close()
+
+    def _on_message(self, command: str, argument: str) -> None:
+        if self.on_message is not None:
+            self.on_message(self.identifier, command, argument)
+        waiters = self.pending.get(command, None)
+        if waiters:
+            pending = waiters.pop(0)
+            pending.result = (command, argument)
+            pending.event.set()
+
+    async def probe(self) -> bool:
+        # Cheap liveness check for a connection which has been idle for a while. A half open socket
+        # (receiver lost power) is only noticed when a query stays unanswered.
+        try:
+            return await self.command(PROBE_COMMAND, "QSTN", True, PROBE_TIMEOUT_MS) is not None
+        except OSError:
+            return False
+
+    async def command(
+        self, command: str, argument: str, expect_response: bool = True, timeout_ms: int = ISCP_TIMEOUT_MS
+    ) -> "Optional[Tuple[str, str]]":
+        return (await self.send_batch(((command, argument, expect_response),), timeout_ms))[0]
+
+    async def send_batch(
+        self, commands: "Sequence[Tuple[str, str, bool]]", timeout_ms: int = ISCP_TIMEOUT_MS
+    ) -> "List[Optional[Tuple[str, str]]]":
+        # Writes all frames with a single write and waits for the responses, which are matched on
+        # their command code. Commands which don't expect a response are fire and forget.
+        if self.writer is None:
+            raise OSError("ISCP connection to {} is closed".format(self.identifier))
+        waiting = []
+        for command, _, expect_response in commands:
+            pending = None
+            if expect_response:
+                pending = _Pending()
+                self.pending.setdefault(command, []).append(pending)
+            waiting.append(pending)
+        self.last_used = time.ticks_ms()
+        self.writer.write(b"".join(encode_frame(command, argument) for command, argument, _ in commands))
+        await self.writer.drain()
+
+        deadline = time.ticks_add(time.ticks_ms(), timeout_ms)
+        results = []
+        for (command, _, _), pending in zip(commands, waiting):
+            if pending is None:
+                results.append(None)
+                continue
+            try:
+                await uasyncio.wait_for_ms(pending.event.wait(), max(0, time.ticks_diff(deadline, time.ticks_ms())))
+            except uasyncio.TimeoutError:
+                waiters = self.pending.get(command, [])
+                if pending in waiters:
+                    waiters.remove(pending)
+            if pending.result is None and self.writer is None:
+                raise OSError("ISCP connection to {} lost".format(self.identifier))
+            results.append(pending.result)
+        return results
+
+
+class ISCPPool:
+    def __init__(self, idle_timeout_ms: int = 300000, probe_after_ms: int = 30000, on_message=None):
+        self.on_message = on_message
+        self.idle_timeout_ms = idle_timeout_ms
+        self.probe_after_ms = probe_after_ms
+        self.connections: "Dict[str, ISCPConnection]" = {}
+        self.stopped = False
+        self.network_up = True
+
+    async def get(self, identifier: str, host: str, port: int) -> ISCPConnection:
+        connection = self.connections.get(identifier, None)
+        if connection is not None and (connection.host != host or connection.port != port):
+            self.evict(identifier)
+            connection = None
+        if connection is None:
+            connection = self.connections[identifier] = ISCPConnection(identifier, host, port, self.on_message)
+        async with connection.lock:
+            if connection.connected and connection.idle_ms() > self.probe_after_ms:
+                if not await connection.probe():
+                    log.info("ISCP connection to %s failed health check. Reconnecting.", identifier)
+                    connection.close()
+            if not connection.connected:
+                await connection.open()
+        return connection
+
+    def is_connected(self, identifier: str) -> bool:
+        connection = self.connections.get(identifier, None)
+        return connection is not None and connection.connected
+
+    def evict(self, identifier: str) -> None:
+        connection = self.connections.pop(identifier, None)
+        if connection is not None:
+            connection.close()
+
+    def disconnect_all(self) -> None:
+        # Sockets don't survive a WiFi drop. Keep the entries so they are reopened once the network is back.
+        self.network_up = False
+        for connection in self.connections.values():
+            connection.close()
+
+    def network_available(self) -> None:
+        self.network_up = True
+
+    def stop(self) -> None:
+        self.stopped = True
+        for identifier in list(self.connections):
+            self.evict(identifier)
+
+    async def start(self) -> None:
+        # Evict idle connections and reopen dropped connections which are still in use in the background,
+        # so the next command doesn't pay for the TCP handshake.
+        while not self.stopped:
+            await uasyncio.sleep_ms(1000)
+            for identifier, connection in list(self.connections.items()):
+                if connection.idle_ms() > self.idle_timeout_ms:
+                    log.info("Evicting idle ISCP connection to %s", identifier)
+                    self.evict(identifier)
+                elif not connection.connected and self.network_up and connection.retry_due():
+                    try:
+                        async with connection.lock:
+                            if not connection.connected:
+                                await connection.open()
+                    except Exception as e:
+                        log.warning("Reconnecting ISCP connection to %s failed: %s", identifier, e)
@@ -0,0 +1,42 @@
+import time
+
+IGNORED_ARGUMENTS = ("QSTN", "N/A")
+
+
+class ISCPStateMirror:
+    # Last known value per device and command code, filled from command responses and the status
+    # frames receivers push on their open connection.
+    def __init__(self, freshness_ms: int = 60000, on_change=None):
+        self.freshness_ms = freshness_ms
+        self.on_change = on_change
+        self.devices: "Dict[str, Dict[str, List]]" = {}
+
+    def update(self, identifier: str, command: str, argument: str) -> None:
+        if argument in IGNORED_ARGUMENTS:
+            return
+        state = self.devices.setdefault(identifier, {})
+        entry = state.get(command, None)
+        if entry is None:
+            state[command] = [argument, time.ticks_ms()]
+        else:
+            changed = entry[0] != argument
+            entry[0] = argument
+            entry[1] = time.ticks_ms()
+            if not changed:
+                return
+        if self.on_change is not None:
+            self.on_change(identifier)
+
+    def get(self, identifier: str, command: str, max_age_ms: int = None) -> "Optional[str]":
+        entry = self.devices.get(identifier, {}).get(command, None)
+        if entry is None:
+            return None
+        if max_age_ms is not None and time.ticks_diff(time.ticks_ms(), entry[1]) > max_age_ms:
+            return None
+        return entry[0]
+
+    def forget(self, identifier: str) -> None:
+        self.devices.pop(identifier, None)
+
+    def as_dict(self, identifier: str) -> "Dict[str, str]":
+        return dict((command, entry[0]) for command, entry in self.devices.get(identifier, {}).items())
@@ -0,0 +1,84 @@
+import time
+
+import uasyncio
+
+
+class PhaseTracker:
+    # Code which might block the event loop tags itself with enter()/leave(). The monitor can't run while
+    # the loop is blocked, so the longest phase since its last wakeup is kept for it to pick up.
+    def __init__(self):
+        self.name = None
+        self.started = 0
+        self.longest_name = None
+        self.longest_ms = -1
+
+    def enter(self, name: str) -> None:
+        self.name = name
+        self.started = time.ticks_ms()
+
+    def leave(self) -> None:
+        if self.name is None:
+            return
+        duration = time.ticks_diff(time.ticks_ms(), self.started)
+        if duration > self.longest_ms:
+            self.longest_name = self.name
+            self.longest_ms = duration
+        self.name = None
+
+    def take(self) -> "Optional[str]":
+        # The longest phase since the last call, or the phase still running.
+        name = self.longest_name if self.name is None else self.name
+        self.longest_name = None
+        self.longest_ms = -1
+        return name
+
+
+class _NoPhases:
+    def enter(self, name: str) -> None:
+        pass
+
+    def leave(self) -> None:
+        pass
+
+
+NO_PHASES = _NoPhases()
+
+
+class LoopMonitor:
+    def __init__(self, phases: PhaseTracker, histogram, interval_ms: int = 50, threshold_ms: int = 50):
+        self.phases = phases
+        self.histogram = histogram
+        self.interval_ms = interval_ms
+        self.threshold_ms = threshold_ms
+        # phase -> [occurrences, worst lag in ms, total lag in ms]
+        self.offenders: "Dict[str, List[int]]" = {}
+        self.stopped = False
+
+    def stop(self) -> None:
+        self.stopped = True
+
+    def worst_offenders(self, limit: int = 5) -> dict:
+        ranked = sorted(self.offenders.items(), key=lambda item: item[1][1], reverse=True)[:limit]
+        return {name: {"count": count, "worst_ms": worst, "total_ms": total} for name, (count, worst, total) in ranked}
+
+    def _record(self, lag_ms: int) -> None:
+        name = self.phases.take() or "unknown"
+        offender = self.offenders.get(name, None)
+        if offender is None:
+            self.offenders[name] = [1, lag_ms, lag_ms]
+            return
+        offender[0] += 1
+        offender[2] += lag_ms
+        if lag_ms > offender[1]:
+            offender[1] = lag_ms
+
+    async def start(self) -> None:
+        while not self.stopped:
+            expected = time.ticks_add(time.ticks_ms(), self.interval_ms)
+            await uasyncio.sleep_ms(self.interval_ms)
+            lag_ms = max(0, time.ticks_diff(time.ticks_ms(), expected))
+            self.histogram.observe(lag_ms)
+            if lag_ms >= self.threshold_ms:
+                self._record(lag_ms)
+            else:
+                self.phases.take()
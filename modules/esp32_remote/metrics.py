@@ -0,0 +1,99 @@
+import gc
+import time
+from array import array
+
+
+class Counter:
+    # read: optional function returning the current value of a count kept elsewhere.
+    def __init__(self, read=None):
+        self.value = 0
+        self.read = read
+
+    def inc(self, amount: int = 1) -> None:
+        self.value += amount
+
+    def sample(self) -> int:
+        if self.read is not None:
+            self.value = self.read()
+        return self.value
+
+
+class Gauge(Counter):
+    def set(self, value) -> None:
+        self.value = value
+
+
+class Histogram:
+    # Fixed buckets: counts[i] holds the values <= bounds[i], the last count everything above.
+    def __init__(self, bounds: "Tuple[int]"):
+        self.bounds = bounds
+        self.counts = array("I", (0 for _ in range(len(bounds) + 1)))
+        self.total = 0
+        self.max = 0
+
+    def observe(self, value: int) -> None:
+        index = 0
+        for bound in self.bounds:
+            if value <= bound:
+                break
+            index += 1
+        self.counts[index] += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def as_dict(self) -> dict:
+        return {"le": self.bounds, "n": list(self.counts), "sum": self.total, "max": self.max}
+
+
+def largest_free_block() -> "Optional[int]":
+    # Largest free block of the IDF heap, which TLS and WiFi buffers are allocated from.
+    try:
+        import esp32
+
+        return max(heap[2] for heap in esp32.idf_heap_info(esp32.HEAP_DATA))
+    except (ImportError, AttributeError, ValueError):
+        return None
+
+
+class Metrics:
+    def __init__(self):
+        self.counters: "Dict[str, Counter]" = {}
+        self.gauges: "Dict[str, Gauge]" = {}
+        self.histograms: "Dict[str, Histogram]" = {}
+        self.gauge("heap_free", gc.mem_free)
+        self.gauge("heap_alloc", gc.mem_alloc)
+        self.gauge("heap_largest_free", largest_free_block)
+        self.gc_count = self.counter("gc_count")
+        self.gc_ms = self.histogram("gc_ms", (1, 2, 5, 10, 20, 50, 100))
+
+    def counter(self, name: str, read=None) -> Counter:
+        counter = self.counters.get(name, None)
+        if counter is None:
+            counter = self.counters[name] = Counter(read)
+        return counter
+
+    def gauge(self, name: str, read=None) -> Gauge:
+        gauge = self.gauges.get(name, None)
+        if gauge is None:
+            gauge = self.gauges[name] = Gauge(read)
+        return gauge
+
+    def histogram(self, name: str, bounds: "Tuple[int]") -> Histogram:
+        histogram = self.histograms.get(name, None)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram(bounds)
+        return histogram
+
+    def collect_garbage(self) -> None:
+        started = time.ticks_ms()
+        gc.collect()
+        self.gc_ms.observe(time.ticks_diff(time.ticks_ms(), started))
+        self.gc_count.inc()
+
+    def snapshot(self) -> dict:
+        return {
+            "c": {name: counter.sample() for name, counter in self.counters.items()},
+            "g": {name: gauge.sample() for name, gauge in self.gauges.items()},
+            "h": {name: histogram.as_dict() for name, histogram in self.histograms.items()},
+        }
@@ -0,0 +1,194 @@
+import struct
+import time
+
+import uasyncio
+import usocket as socket
+from micropython import const
+from ringlog import log
+
+from .loop_monitor import NO_PHASES
+
+NTP_TO_UNIX_S = 2208988800
+# gmtime() counts from 2000 on the ESP32 port and from 1970 on the unix port and CPython.
+UNIX_TO_EPOCH_S = 946684800 if time.gmtime(0)[0] == 2000 else 0
+POLL_MS = const(10)
+CHECK_INTERVAL_MS = const(10000)
+# Until two syncs allowed to estimate it, assume the drift of a typical crystal.
+DEFAULT_DRIFT_PPM = const(50)
+MIN_UNCERTAINTY_PPM = const(2)
+# Syncs closer than this are too noisy (round trip jitter) to estimate the drift from.
+MIN_DRIFT_INTERVAL_MS = const(600000)
+FAILURES_BEFORE_RESOLVE = const(3)
+MODE_SERVER = const(4)
+LEAP_UNSYNCHRONIZED = const(3)
+MAX_STRATUM = const(15)
+
+
+class NTPClient:
+    # SNTP on a non-blocking UDP socket. Keeps the offset between ticks_ms() and UTC of the last sync and the
+    # drift of the clock measured between syncs. A new sync is only made once the estimated error exceeds
+    # max_error_ms, and attempts are throttled so a flapping link doesn't flood the server.
+    def __init__(
+        self,
+        host: str = "pool.ntp.org",
+        port: int = 123,
+        timeout_ms: int = 1000,
+        max_error_ms: int = 100,
+        min_interval_ms: int = 60000,
+        max_interval_ms: int = 86400000,
+        on_sync=None,
+        phases=NO_PHASES,
+    ):
+        self.host = host
+        self.port = port
+        self.timeout_ms = timeout_ms
+        self.max_error_ms = max_error_ms
+        self.min_interval_ms = min_interval_ms
+        self.max_interval_ms = max_interval_ms
+        self.on_sync = on_sync
+        self.phases = phases
+        self._addr = None
+        self.base_ticks = None
+        self.base_ms = 0
+        self.rtt_ms = 0
+        self.drift_ppm = None
+        self.uncertainty_ppm = DEFAULT_DRIFT_PPM
+        self.last_attempt = None
+        self.syncs = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.network_up = True
+        self.stopped = False
+        self.wakeup = uasyncio.Event()
+
+    @property
+    def synced(self) -> bool:
+        return self.base_ticks is not None
+
+    def _elapsed_ms(self) -> int:
+        return time.ticks_diff(time.ticks_ms(), self.base_ticks)
+
+    def now_ms(self) -> "Optional[int]":
+        # Milliseconds since the Unix epoch (UTC), None before the first sync.
+        if self.base_ticks is None:
+            return None
+        elapsed = self._elapsed_ms()
+        return self.base_ms + elapsed + elapsed * (self.drift_ppm or 0) // 1000000
+
+    def error_ms(self) -> "Optional[int]":
+        if self.base_ticks is None:
+            return None
+        return self.rtt_ms // 2 + self._elapsed_ms() * self.uncertainty_ppm // 1000000
+
+    def sync_due(self) -> bool:
+        if self.last_attempt is not None:
+            backoff_ms = self.min_interval_ms << min(self.consecutive_failures, 6)
+            if time.ticks_diff(time.ticks_ms(), self.last_attempt) < backoff_ms:
+                return False
+        if self.base_ticks is None:
+            return True
+        return self._elapsed_ms() >= self.max_interval_ms or self.error_ms() > self.max_error_ms
+
+    def _resolve(self) -> None:
+        # getaddrinfo blocks. The address is reused until the server stops answering.
+        self.phases.enter("ntp_dns")
+        try:
+            self._addr = socket.getaddrinfo(self.host, self.port, 0, socket.SOCK_DGRAM)[0][-1]
+        finally:
+            self.phases.leave()
+
+    async def _query(self) -> "Tuple[int, int]":
+        if self._addr is None:
+            self._resolve()
+        packet = bytearray(48)
+        packet[0] = 0x1B  # Version 3, client mode
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.setblocking(False)
+            sent = time.ticks_ms()
+            sock.sendto(packet, self._addr)
+            while True:
+                try:
+                    data = sock.recv(48)
+                except OSError:
+                    data = None
+                if data:
+                    break
+                if time.ticks_diff(time.ticks_ms(), sent) > self.timeout_ms:
+                    raise OSError("NTP request to {} timed out".format(self.host))
+                await uasyncio.sleep_ms(POLL_MS)
+            rtt_ms = time.ticks_diff(time.ticks_ms(), sent)
+        finally:
+            sock.close()
+        if len(data) < 48:
+            raise OSError("Short NTP response")
+        # Replies which don't carry the time fail like a timeout, so the attempts back off.
+        if data[0] & 0x07 != MODE_SERVER:
+            raise OSError("NTP response not in server mode")
+        if not data[1]:
+            # Kiss-o'-Death, the reference ID holds the code (RATE, DENY, ...).
+            raise OSError("NTP server sent kiss code {}".format(bytes(data[12:16])))
+        if data[1] > MAX_STRATUM or data[0] >> 6 == LEAP_UNSYNCHRONIZED:
+            raise OSError("NTP server isn't synchronised")
+        seconds, fraction = struct.unpack_from("!II", data, 40)
+        if not seconds and not fraction:
+            raise OSError("NTP response without transmit timestamp")
+        # The transmit timestamp of the server plus half the round trip.
+        return (seconds - NTP_TO_UNIX_S) * 1000 + (fraction * 1000 >> 32) + rtt_ms // 2, rtt_ms
+
+    async def sync(self) -> bool:
+        self.last_attempt = time.ticks_ms()
+        try:
+            server_ms, rtt_ms = await self._query()
+        except (OSError, IndexError) as e:
+            log.warning("NTP sync failed: %s", e)
+            self.failures += 1
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= FAILURES_BEFORE_RESOLVE:
+                self._addr = None
+            return False
+
+        now = time.ticks_ms()
+        if self.base_ticks is not None:
+            elapsed = time.ticks_diff(now, self.base_ticks)
+            if elapsed >= MIN_DRIFT_INTERVAL_MS:
+                drift_ppm = (server_ms - self.base_ms - elapsed) * 1000000 // elapsed
+                if self.drift_ppm is not None:
+                    self.uncertainty_ppm = max(MIN_UNCERTAINTY_PPM, abs(drift_ppm - self.drift_ppm))
+                self.drift_ppm = drift_ppm
+        self.base_ticks = now
+        self.base_ms = server_ms
+        self.rtt_ms = rtt_ms
+        self.syncs += 1
+        self.consecutive_failures = 0
+        self._set_rtc(server_ms)
+        if self.on_sync is not None:
+            self.on_sync(self)
+        return True
+
+    def _set_rtc(self, unix_ms: int) -> None:
+        import machine
+
+        tm = time.gmtime(unix_ms // 1000 - UNIX_TO_EPOCH_S)
+        machine.RTC().datetime((tm[0], tm[1], tm[2], tm[6] + 1, tm[3], tm[4], tm[5], unix_ms % 1000 * 1000))
+
+    def network_available(self) -> None:
+        self.network_up = True
+        self.wakeup.set()
+
+    def network_lost(self) -> None:
+        self.network_up = False
+
+    def stop(self) -> None:
+        self.stopped = True
+        self.wakeup.set()
+
+    async def start(self) -> None:
+        while not self.stopped:
+            if self.network_up and self.sync_due():
+                await self.sync()
+            try:
+                await uasyncio.wait_for_ms(self.wakeup.wait(), CHECK_INTERVAL_MS)
+            except uasyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
@@ -0,0 +1,54 @@
+import time
+from random import getrandbits
+
+
+class RetriesExhausted(Exception):
+    # The failure was already reported with all attempts. Callers should not report it again.
+    pass
+
+
+class RetryPolicy:
+    def __init__(self, attempts: int = 4, base_ms: int = 100, max_ms: int = 2000):
+        self.attempts = attempts
+        self.base_ms = base_ms
+        self.max_ms = max_ms
+
+    def delay_ms(self, attempt: int) -> int:
+        # Full jitter: a random delay between 0 and the exponential backoff for this attempt.
+        backoff = min(self.max_ms, self.base_ms << attempt)
+        return backoff * getrandbits(10) // 1024
+
+
+class CircuitBreaker:
+    # Opens after threshold consecutive failures and fails fast until reset_ms passed. Then it is half
+    # open: allow() lets a single probe through while everything else still fails fast. The probe's
+    # success closes the breaker, its failure opens it again for reset_ms. A probe which never reports
+    # back (e.g. a cancelled task) is replaced by a new one after reset_ms.
+    def __init__(self, threshold: int = 3, reset_ms: int = 30000):
+        self.threshold = threshold
+        self.reset_ms = reset_ms
+        self.failures = 0
+        self.opened_at = None
+        self.probe_at = None
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        now = time.ticks_ms()
+        if time.ticks_diff(now, self.opened_at) < self.reset_ms:
+            return False
+        if self.probe_at is not None and time.ticks_diff(now, self.probe_at) < self.reset_ms:
+            return False
+        self.probe_at = now
+        return True
+
+    def success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self.probe_at = None
+
+    def failure(self) -> None:
+        self.failures += 1
+        if self.probe_at is not None or self.failures >= self.threshold:
+            self.opened_at = time.ticks_ms()
+            self.probe_at = None
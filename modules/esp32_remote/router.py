@@ -0,0 +1,43 @@
+import json
+from collections import namedtuple
+
+from micropython import const
+
+PAYLOAD_RAW = const(0)
+PAYLOAD_TEXT = const(1)
+PAYLOAD_JSON = const(2)
+
+# What identifies a duplicate: the packet ID of a redelivered QoS 1 message and the top level "request_id" of a
+# JSON payload.
+DEDUP_PID = const(1)
+DEDUP_REQUEST_ID = const(2)
+DEDUP_JSON = const(3)
+
+
+class Route(namedtuple("Route", ("name", "handler", "payload", "qos", "deduplicate"))):
+    def decode(self, message: bytes):
+        if self.payload == PAYLOAD_JSON:
+            return json.loads(message)
+        elif self.payload == PAYLOAD_TEXT:
+            return message.decode()
+        return message
+
+
+class TopicRouter:
+    def __init__(self, topic_prefix: str):
+        self.topic_prefix = topic_prefix
+        self.routes: "Dict[bytes, Route]" = {}
+
+    def topic_name(self, name: str) -> str:
+        return "{}/{}".format(self.topic_prefix, name)
+
+    def add(self, name: str, handler, payload: int = PAYLOAD_JSON, qos: int = 1, deduplicate: int = 0) -> None:
+        # Routes are keyed on the full topic as received from the broker, so matching an
+        # incoming message is a single dict lookup on the raw topic bytes.
+        self.routes[self.topic_name(name).encode()] = Route(name, handler, payload, qos, deduplicate)
+
+    def match(self, topic: bytes) -> "Optional[Route]":
+        return self.routes.get(topic, None)
+
+    def subscriptions(self) -> "Tuple[Tuple[str, int]]":
+        return tuple((self.topic_name(route.name), route.qos) for route in self.routes.values())
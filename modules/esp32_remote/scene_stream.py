@@ -0,0 +1,147 @@
+# Incremental parsing of ir/command payloads. Scenes are walked on the raw payload buffer and
+# handed to the player one step at a time, so memory use is bounded by the largest step and not
+# by the scene length. The scene array is skipped without parsing while the other top level keys are read.
+import json
+
+from micropython import const
+
+from .commands import SceneCommand
+
+_QUOTE = const(0x22)  # "
+_BACKSLASH = const(0x5C)  # \
+_COLON = const(0x3A)  # :
+_COMMA = const(0x2C)  # ,
+_OPEN_OBJECT = const(0x7B)  # {
+_CLOSE_OBJECT = const(0x7D)  # }
+_OPEN_ARRAY = const(0x5B)  # [
+_CLOSE_ARRAY = const(0x5D)  # ]
+_WHITESPACE = (0x20, 0x09, 0x0D, 0x0A)
+
+SCENE_KEY = b"scene"
+TYPE_KEY = b"type"
+START_AT_KEY = b"start_at"
+SCENE_TYPE = b'"SCENE"'
+NULL = b"null"
+
+
+def _skip_whitespace(buffer: bytes, index: int) -> int:
+    length = len(buffer)
+    while index < length and buffer[index] in _WHITESPACE:
+        index += 1
+    if index >= length:
+        raise ValueError("Unexpected end of JSON payload")
+    return index
+
+
+def _skip_string(buffer: bytes, index: int) -> int:
+    # index points at the opening quote. Returns the index after the closing quote.
+    while True:
+        index = buffer.find(b'"', index + 1)
+        if index < 0:
+            raise ValueError("Unterminated string in JSON payload")
+        backslashes = 0
+        while buffer[index - 1 - backslashes] == _BACKSLASH:
+            backslashes += 1
+        if not backslashes % 2:
+            return index + 1
+
+
+def _skip_value(buffer: bytes, index: int) -> int:
+    # index points at the first byte of a value. Returns the index after it.
+    first = buffer[index]
+    if first == _QUOTE:
+        return _skip_string(buffer, index)
+    length = len(buffer)
+    if first == _OPEN_OBJECT or first == _OPEN_ARRAY:
+        depth = 0
+        while index < length:
+            char = buffer[index]
+            if char == _QUOTE:
+                index = _skip_string(buffer, index)
+                continue
+            if char == _OPEN_OBJECT or char == _OPEN_ARRAY:
+                depth += 1
+            elif char == _CLOSE_OBJECT or char == _CLOSE_ARRAY:
+                depth -= 1
+                if not depth:
+                    return index + 1
+            index += 1
+        raise ValueError("Unterminated container in JSON payload")
+    while index < length and buffer[index] not in _WHITESPACE:
+        char = buffer[index]
+        if char == _COMMA or char == _CLOSE_OBJECT or char == _CLOSE_ARRAY:
+            break
+        index += 1
+    return index
+
+
+class SceneSteps:
+    def __init__(self, buffer: bytes, start: int):
+        self.buffer = buffer
+        self.start = start
+
+    def __iter__(self):
+        buffer = self.buffer
+        index = self.start
+        if buffer[index] != _OPEN_ARRAY:
+            raise ValueError("No scene in payload")
+        index = _skip_whitespace(buffer, index + 1)
+        if buffer[index] == _CLOSE_ARRAY:
+            return
+        while True:
+            end = _skip_value(buffer, index)
+            yield json.loads(buffer[index:end])
+            index = _skip_whitespace(buffer, end)
+            if buffer[index] == _CLOSE_ARRAY:
+                return
+            if buffer[index] != _COMMA:
+                raise ValueError("Malformed scene array in JSON payload")
+            index = _skip_whitespace(buffer, index + 1)
+
+
+def top_level_items(buffer: bytes):
+    # Yields key, start and end of the raw value for every top level key of a JSON object, without parsing
+    # the values. Yields nothing if the payload isn't an object.
+    index = _skip_whitespace(buffer, 0)
+    if buffer[index] != _OPEN_OBJECT:
+        return
+    index = _skip_whitespace(buffer, index + 1)
+    while buffer[index] != _CLOSE_OBJECT:
+        if buffer[index] != _QUOTE:
+            raise ValueError("Malformed key in JSON payload")
+        key_end = _skip_string(buffer, index)
+        key = buffer[index + 1 : key_end - 1]  # noqa: E203
+        index = _skip_whitespace(buffer, key_end)
+        if buffer[index] != _COLON:
+            raise ValueError("Missing colon in JSON payload")
+        index = _skip_whitespace(buffer, index + 1)
+        end = _skip_value(buffer, index)
+        yield key, index, end
+        index = _skip_whitespace(buffer, end)
+        if buffer[index] == _COMMA:
+            index = _skip_whitespace(buffer, index + 1)
+
+
+def parse_command(buffer: bytes) -> "Union[dict, SceneCommand]":
+    # Scenes are returned as a SceneCommand streaming its steps from the buffer. Everything else is
+    # small and parsed with json.loads.
+    is_scene = False
+    scene_start = None
+    start_at = None
+    for key, start, end in top_level_items(buffer):
+        if key == SCENE_KEY:
+            scene_start = start
+        elif key == TYPE_KEY:
+            is_scene = buffer[start:end].upper() == SCENE_TYPE
+        elif key == START_AT_KEY:
+            # null means no start time, like in commands.from_dict.
+            if buffer[start:end] == NULL:
+                start_at = None
+                continue
+            try:
+                start_at = int(buffer[start:end])
+            except ValueError:
+                raise ValueError("start_at has to be a Unix timestamp in ms")
+    if is_scene and scene_start is not None:
+        return SceneCommand(SceneSteps(buffer, scene_start), start_at)
+    return json.loads(buffer)
@@ -0,0 +1,303 @@
+import heapq
+import json
+
+import uasyncio
+from micropython import const
+from ringlog import log
+
+from . import store
+from .commands import stored_payload
+
+KIND_AT = const(0)
+KIND_EVERY = const(1)
+KIND_CRON = const(2)
+KIND_NAMES = ("at", "every", "cron")
+
+# The timer wakes up at least this often, so a clock corrected by an NTP sync is picked up.
+MAX_SLEEP_MS = const(60000)
+MINUTE_MS = const(60000)
+# A cron rule which doesn't match within this many days (e.g. 31 2 *) is rejected.
+MAX_CRON_DAYS = const(1461)
+
+_CRON_RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 6))
+
+
+def _parse_cron_field(field: str, low: int, high: int) -> "Optional[Tuple[int]]":
+    # None matches everything. Supports *, n, a-b, */n, a-b/n and comma separated lists of them.
+    if field == "*":
+        return None
+    values = set()
+    for part in field.split(","):
+        step = 1
+        if "/" in part:
+            part, step_text = part.split("/")
+            step = int(step_text)
+            if step < 1:
+                raise ValueError("Invalid step in cron field {}".format(field))
+        if part == "*":
+            first, last = low, high
+        elif "-" in part:
+            first, last = (int(value) for value in part.split("-"))
+        else:
+            first = last = int(part)
+        if first < low or last > high or first > last:
+            raise ValueError("Cron field {} is outside of {}-{}".format(field, low, high))
+        values.update(range(first, last + 1, step))
+    return tuple(sorted(values))
+
+
+def parse_cron(rule: str) -> "Tuple[Optional[Tuple[int]], ...]":
+    # minute hour day-of-month month day-of-week (0 is Sunday)
+    fields = rule.split()
+    if len(fields) != 5:
+        raise ValueError("A cron rule needs 5 fields: minute hour day month weekday")
+    return tuple(_parse_cron_field(field, low, high) for field, (low, high) in zip(fields, _CRON_RANGES))
+
+
+def _civil_from_days(days: int) -> "Tuple[int, int, int]":
+    # Year, month and day of the days since 1970-01-01. Doesn't depend on the epoch of the port's gmtime().
+    days += 719468
+    era = days // 146097
+    day_of_era = days - era * 146097
+    year_of_era = (day_of_era - day_of_era // 1460 + day_of_era // 36524 - day_of_era // 146096) // 365
+    day_of_year = day_of_era - (365 * year_of_era + year_of_era // 4 - year_of_era // 100)
+    month = (5 * day_of_year + 2) // 153
+    day = day_of_year - (153 * month + 2) // 5 + 1
+    month = month + 3 if month < 10 else month - 9
+    return year_of_era + era * 400 + (month <= 2), month, day
+
+
+def next_cron(fields: tuple, after_ms: int, utc_offset_min: int = 0) -> int:
+    # The first matching minute after after_ms, as Unix ms. The rule is evaluated in UTC plus utc_offset_min.
+    minutes, hours, days_of_month, months, weekdays = fields
+    local_minute = after_ms // MINUTE_MS + 1 + utc_offset_min
+    day = local_minute // 1440
+    minute_of_day = local_minute % 1440
+    for _ in range(MAX_CRON_DAYS):
+        _, month, day_of_month = _civil_from_days(day)
+        weekday = (day + 4) % 7  # 1970-01-01 was a Thursday
+        if months is None or month in months:
+            # Like cron, a day matches either field if both are restricted.
+            if days_of_month is not None and weekdays is not None:
+                day_matches = day_of_month in days_of_month or weekday in weekdays
+            else:
+                day_matches = (days_of_month is None or day_of_month in days_of_month) and (
+                    weekdays is None or weekday in weekdays
+                )
+            if day_matches:
+                for hour in hours if hours is not None else range(24):
+                    for minute in minutes if minutes is not None else range(60):
+                        if hour * 60 + minute >= minute_of_day:
+                            return ((day * 1440 + hour * 60 + minute) - utc_offset_min) * MINUTE_MS
+        day += 1
+        minute_of_day = 0
+    raise ValueError("Cron rule never matches")
+
+
+class ScheduleEntry:
+    # command is the JSON payload of the command, parsed with scene streaming every time the entry is due.
+    def __init__(self, name: str, kind: int, spec, command: bytes, due: "Optional[int]"):
+        self.name = name
+        self.kind = kind
+        self.spec = spec
+        self.command = command
+        self.due = due
+        self.fields = parse_cron(spec) if kind == KIND_CRON else None
+        self.generation = 0
+
+    def as_list(self) -> list:
+        return [self.name, self.kind, self.spec, self.command.decode(), self.due]
+
+    def as_dict(self) -> dict:
+        return {KIND_NAMES[self.kind]: self.spec, "due": self.due, "command": json.loads(self.command)}
+
+
+class Scheduler:
+    # Timed and recurring commands. The entries are kept in a heap on their due time (Unix ms of the NTP clock),
+    # and a single task sleeps until the earliest one. Replacing or removing an entry leaves its heap item
+    # behind; stale items are recognised by their generation and skipped when they come up.
+    # The entries are stored on flash as a JSON list of [name, kind, spec, command, due] in heap order, so loading
+    # pushes every item without moving it. Runs of recurring entries aren't saved, which would wear out the flash.
+    # After loading, their past due times are moved to the next run once the clock is known, so runs missed while
+    # the unit was off are skipped like cron does.
+    def __init__(
+        self,
+        clock,
+        on_due,
+        path: str = "/schedule.json",
+        size: int = 32,
+        grace_ms: int = 300000,
+        utc_offset_min: int = 0,
+    ):
+        self.clock = clock
+        self.on_due = on_due
+        self.path = path
+        self.size = size
+        self.grace_ms = grace_ms
+        self.utc_offset_min = utc_offset_min
+        self.entries: "Dict[str, ScheduleEntry]" = {}
+        self.heap: "List[Tuple[int, int, str]]" = []
+        self.generation = 0
+        self.runs = 0
+        self.missed = 0
+        self.stopped = False
+        self.catch_up_pending = False
+        self.wakeup = uasyncio.Event()
+        self.load()
+
+    def load(self) -> None:
+        data = store.load(self.path)
+        if data is None:
+            return
+        if not isinstance(data, list):
+            log.warning("Dropped schedule in unknown format")
+            return
+        for item in data:
+            # A file in an old or broken format mustn't stop the boot, only its entries are dropped.
+            try:
+                name, kind, spec, command, due = item
+                if kind not in (KIND_AT, KIND_EVERY, KIND_CRON) or not isinstance(due, int):
+                    raise ValueError("Unknown kind or due time")
+                if kind != KIND_CRON and not isinstance(spec, int):
+                    raise ValueError("Time or interval isn't a number")
+                self._push(ScheduleEntry(str(name), kind, spec, command.encode(), due))
+            except (ValueError, TypeError, AttributeError) as e:
+                log.warning("Dropped schedule entry %s: %s", item, e)
+        self.catch_up_pending = True
+
+    def save(self) -> None:
+        store.save(self.path, [entry.as_list() for entry in self._live()])
+
+    def _live(self) -> "List[ScheduleEntry]":
+        # The current entries in heap order.
+        entries = self.entries
+        result = []
+        for _, generation, name in self.heap:
+            entry = entries.get(name, None)
+            if entry is not None and entry.generation == generation:
+                result.append(entry)
+        return result
+
+    def _push(self, entry: ScheduleEntry) -> None:
+        self.generation += 1
+        entry.generation = self.generation
+        self.entries[entry.name] = entry
+        heapq.heappush(self.heap, (entry.due, entry.generation, entry.name))
+        if len(self.heap) > 2 * self.size:
+            # Too many stale items from replaced and removed entries.
+            self.heap = [(item.due, item.generation, item.name) for item in self._live()]
+            heapq.heapify(self.heap)
+
+    def _next_due(self, entry: ScheduleEntry, now: int) -> "Optional[int]":
+        if entry.kind == KIND_AT:
+            return None
+        if entry.kind == KIND_EVERY:
+            # Keeps the phase of the first run, also across reboots.
+            interval = entry.spec * 1000
+            return entry.due + ((now - entry.due) // interval + 1) * interval
+        return next_cron(entry.fields, now, self.utc_offset_min)
+
+    def add(self, name: str, kind: int, spec, command: bytes, now: "Optional[int]" = None) -> ScheduleEntry:
+        if now is None:
+            now = self.clock()
+        if now is None:
+            raise ValueError("Clock not synchronised")
+        if name not in self.entries and len(self.entries) >= self.size:
+            raise ValueError("Schedule is full ({} entries)".format(self.size))
+        entry = ScheduleEntry(name, kind, spec, command, None)
+        if kind == KIND_AT:
+            if spec <= now:
+                raise ValueError("Time {} is in the past".format(spec))
+            entry.due = spec
+        elif kind == KIND_EVERY:
+            if spec < 1:
+                raise ValueError("Interval has to be at least 1 s")
+            entry.due = now + spec * 1000
+        else:
+            entry.due = next_cron(entry.fields, now, self.utc_offset_min)
+        self._push(entry)
+        self.save()
+        self.wakeup.set()
+        return entry
+
+    def set(self, data: dict) -> None:
+        # {"name": ..., "at": unix ms | "every": seconds | "cron": "min hour day month weekday", "command": {...}}
+        if "name" not in data or "command" not in data:
+            raise ValueError("No name or command in schedule entry")
+        if "at" in data:
+            kind, spec = KIND_AT, int(data["at"])
+        elif "every" in data:
+            kind, spec = KIND_EVERY, int(data["every"])
+        elif "cron" in data:
+            kind, spec = KIND_CRON, str(data["cron"])
+        else:
+            raise ValueError("No at, every or cron in schedule entry")
+        self.add(str(data["name"]), kind, spec, stored_payload(data["command"]))
+
+    def as_dict(self) -> dict:
+        return {name: entry.as_dict() for name, entry in self.entries.items()}
+
+    def remove(self, name: str) -> bool:
+        if self.entries.pop(name, None) is None:
+            return False
+        self.save()
+        self.wakeup.set()
+        return True
+
+    def clock_changed(self) -> None:
+        self.wakeup.set()
+
+    def _catch_up(self, now: int) -> None:
+        for entry in self._live():
+            if entry.kind != KIND_AT and entry.due <= now:
+                entry.due = self._next_due(entry, now)
+        self.heap = [(entry.due, entry.generation, entry.name) for entry in self._live()]
+        heapq.heapify(self.heap)
+
+    def _run_due(self) -> int:
+        # Runs the due entries and returns the ms until the next one.
+        now = self.clock()
+        if now is None:
+            return MAX_SLEEP_MS
+        if self.catch_up_pending:
+            self._catch_up(now)
+            self.catch_up_pending = False
+        changed = False
+        while self.heap and self.heap[0][0] <= now:
+            _, generation, name = heapq.heappop(self.heap)
+            entry = self.entries.get(name, None)
+            if entry is None or entry.generation != generation:
+                continue
+            late = now - entry.due
+            if late <= self.grace_ms:
+                self.runs += 1
+                self.on_due(entry, late)
+            else:
+                # The unit was off or the clock jumped. Recurring entries continue with their next run.
+                self.missed += 1
+                log.warning("Skipped schedule entry %s, %s ms late", name, late)
+            due = self._next_due(entry, now)
+            if due is None:
+                del self.entries[name]
+                changed = True
+            else:
+                entry.due = due
+                self._push(entry)
+        if changed:
+            self.save()
+        if not self.heap:
+            return MAX_SLEEP_MS
+        return min(self.heap[0][0] - now, MAX_SLEEP_MS)
+
+    def stop(self) -> None:
+        self.stopped = True
+        self.wakeup.set()
+
+    async def start(self) -> None:
+        while not self.stopped:
+            delay = self._run_due()
+            try:
+                await uasyncio.wait_for_ms(self.wakeup.wait(), delay)
+            except uasyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
@@ -0,0 +1,28 @@
+# JSON files on flash for the tables which are changed at runtime (schedule, triggers) and the ISCP cache. A file
+# is written through a temporary file and renamed, so a reset during the write keeps the previous version.
+import json
+import os
+
+from ringlog import log
+
+
+def load(path: "Optional[str]"):
+    # None if there is no path, no file or no valid JSON in it.
+    if not path:
+        return None
+    try:
+        with open(path, "r") as handle:
+            return json.load(handle)
+    except (OSError, ValueError):
+        return None
+
+
+def save(path: "Optional[str]", data) -> None:
+    if not path:
+        return
+    try:
+        with open(path + ".tmp", "w") as handle:
+            json.dump(data, handle)
+        os.rename(path + ".tmp", path)
+    except OSError as e:
+        log.warning("Could not write %s: %s", path, e)
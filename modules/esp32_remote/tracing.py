@@ -0,0 +1,126 @@
+import time
+from array import array
+
+from micropython import const
+
+# Captured is the end of an IR frame which fired a trigger, socket_read the MQTT read of a message.
+STAGE_CAPTURED = const(0)
+STAGE_SOCKET_READ = const(1)
+STAGE_RECEIVED = const(2)
+STAGE_PARSED = const(3)
+STAGE_QUEUED = const(4)
+STAGE_TX_START = const(5)
+STAGE_TX_DONE = const(6)
+STAGE_PUBLISHED = const(7)
+STAGE_COUNT = const(8)
+STAGE_NAMES = ("captured", "socket_read", "received", "parsed", "queued", "tx_start", "tx_done", "published")
+
+
+class Trace:
+    # time.ticks_us() stamps of one message on its way through the firmware. 0 marks a stage which
+    # wasn't reached. For scenes the stamps of the last step are kept.
+    def __init__(self):
+        self.label = None
+        self.stamps = array("i", (0 for _ in range(STAGE_COUNT)))
+        # Open from begin() until the task handling the message is done. Open traces aren't reused.
+        self.open = False
+        self.sequence = 0
+
+    def reset(self, label: str, sequence: int) -> None:
+        self.label = label
+        self.open = True
+        self.sequence = sequence
+        stamps = self.stamps
+        for stage in range(STAGE_COUNT):
+            stamps[stage] = 0
+
+    def mark(self, stage: int, ticks: int = None) -> None:
+        self.stamps[stage] = time.ticks_us() if ticks is None else ticks
+
+    def close(self) -> None:
+        self.open = False
+
+    def durations(self) -> "List[Tuple[int, int]]":
+        # (stage, us since the previous reached stage) for every reached stage after the first.
+        result = []
+        previous = None
+        for stage in range(STAGE_COUNT):
+            stamp = self.stamps[stage]
+            if not stamp:
+                continue
+            if previous is not None:
+                result.append((stage, time.ticks_diff(stamp, previous)))
+            previous = stamp
+        return result
+
+    def as_dict(self) -> dict:
+        return {"label": self.label, "us": {STAGE_NAMES[stage]: duration for stage, duration in self.durations()}}
+
+
+class _NoTrace:
+    label = None
+
+    def mark(self, stage: int, ticks: int = None) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+# Used where no trace is passed in and when tracing is disabled, so callers never check for None.
+NO_TRACE = _NoTrace()
+
+
+class Tracer:
+    # Fixed ring of preallocated traces. Starting a trace reuses the oldest closed slot, so tracing doesn't
+    # allocate on the command path and can stay enabled. Slots of messages still in progress (e.g. scenes
+    # waiting for start_at) are skipped, so their stamps aren't mixed with a later message. If all slots are
+    # open the message isn't traced.
+    def __init__(self, size: int = 32):
+        self.traces = [Trace() for _ in range(size)]
+        self.index = 0
+        self.count = 0
+        self.skipped = 0
+
+    def begin(self, label: str) -> "Union[Trace, _NoTrace]":
+        traces = self.traces
+        size = len(traces)
+        if not size:
+            return NO_TRACE
+        for _ in range(size):
+            trace = traces[self.index]
+            self.index = (self.index + 1) % size
+            if not trace.open:
+                self.count += 1
+                trace.reset(label, self.count)
+                return trace
+        self.skipped += 1
+        return NO_TRACE
+
+    def _in_order(self) -> "List[Trace]":
+        # Newest first.
+        used = [trace for trace in self.traces if trace.sequence]
+        used.sort(key=lambda trace: -trace.sequence)
+        return used
+
+    def recent(self, limit: int = 10) -> "List[dict]":
+        return [trace.as_dict() for trace in self._in_order()[:limit]]
+
+    def stats(self, label: "Optional[str]" = None) -> dict:
+        per_stage = [[] for _ in range(STAGE_COUNT)]
+        for trace in self._in_order():
+            if label is not None and trace.label != label:
+                continue
+            for stage, duration in trace.durations():
+                per_stage[stage].append(duration)
+        result = {}
+        for stage, durations in enumerate(per_stage):
+            if not durations:
+                continue
+            durations.sort()
+            result[STAGE_NAMES[stage]] = {
+                "count": len(durations),
+                "p50_us": durations[(len(durations) - 1) // 2],
+                "p95_us": durations[(len(durations) - 1) * 95 // 100],
+            }
+        return result
@@ -0,0 +1,165 @@
+import json
+import time
+
+from micropython import const
+from ringlog import log
+
+from . import store
+from .commands import stored_payload
+from .ir_handler import PROTOCOL_NEC, PROTOCOL_RC6
+
+PROTOCOLS = {"NEC": PROTOCOL_NEC, "RC6": PROTOCOL_RC6}
+PROTOCOL_NAMES = ("NEC", "RC6")
+
+_ADDRESS_SHIFT = const(8)
+_PROTOCOL_SHIFT = const(16)
+
+
+def trigger_key(protocol: int, address: int, command: int) -> int:
+    # (protocol, device_id or control, command or information) packed into a small int, so looking up a captured
+    # message neither allocates a tuple nor hashes one.
+    return protocol << _PROTOCOL_SHIFT | (address & 0xFF) << _ADDRESS_SHIFT | (command & 0xFF)
+
+
+def message_key(message) -> "Optional[int]":
+    from ir.ir_rx import NECMessage, RC6Message
+
+    if isinstance(message, NECMessage):
+        return trigger_key(PROTOCOL_NEC, message.device_id, message.command)
+    elif isinstance(message, RC6Message):
+        return trigger_key(PROTOCOL_RC6, message.control, message.information)
+    return None
+
+
+def message_protocol(message) -> "Optional[str]":
+    key = message_key(message)
+    return None if key is None else PROTOCOL_NAMES[key >> _PROTOCOL_SHIFT]
+
+
+def match_key(data: dict) -> int:
+    # The match is written like a captured command on ir/last-captured-command.
+    protocol = PROTOCOLS.get(str(data.get("type", "")).upper(), None)
+    if protocol == PROTOCOL_NEC:
+        if "device_id" not in data or "command" not in data:
+            raise ValueError("No device_id or command in NEC trigger")
+        return trigger_key(protocol, int(data["device_id"]), int(data["command"]))
+    elif protocol == PROTOCOL_RC6:
+        if "control" not in data or "information" not in data:
+            raise ValueError("No control or information in RC6 trigger")
+        return trigger_key(protocol, int(data["control"]), int(data["information"]))
+    raise ValueError("Triggers match NEC or RC6 messages")
+
+
+class Trigger:
+    # action is the JSON payload of the command, parsed with scene streaming every time the trigger fires.
+    def __init__(self, name: str, key: int, action: bytes):
+        self.name = name
+        self.key = key
+        self.action = action
+        self.last_fired = None
+        self.running = False
+
+    def as_list(self) -> list:
+        return [self.name, self.key, self.action.decode()]
+
+    def as_dict(self) -> dict:
+        key = self.key
+        protocol = key >> _PROTOCOL_SHIFT
+        address = key >> _ADDRESS_SHIFT & 0xFF
+        command = key & 0xFF
+        if protocol == PROTOCOL_NEC:
+            match = {"type": "NEC", "device_id": address, "command": command}
+        else:
+            match = {"type": "RC6", "control": address, "information": command}
+        return {"match": match, "action": json.loads(self.action)}
+
+
+class TriggerTable:
+    # Captured IR messages which run a stored command or scene on the unit itself, without a round trip over the
+    # broker. A trigger doesn't fire again while its action runs or within cooldown_ms, so a held button or the
+    # unit's own emitter seen by its receiver doesn't repeat it.
+    def __init__(self, path: str = "/triggers.json", size: int = 32, cooldown_ms: int = 500):
+        self.path = path
+        self.size = size
+        self.cooldown_ms = cooldown_ms
+        self.by_key: "Dict[int, Trigger]" = {}
+        self.by_name: "Dict[str, Trigger]" = {}
+        self.fired = 0
+        self.suppressed = 0
+        self.load()
+
+    def load(self) -> None:
+        data = store.load(self.path)
+        if data is None:
+            return
+        if not isinstance(data, list):
+            log.warning("Dropped triggers in unknown format")
+            return
+        for item in data:
+            # A file in an old or broken format mustn't stop the boot, only its entries are dropped.
+            try:
+                name, key, action = item
+                if not isinstance(key, int) or key < 0 or key >> _PROTOCOL_SHIFT >= len(PROTOCOL_NAMES):
+                    raise ValueError("Unknown match")
+                self._store(Trigger(str(name), key, action.encode()))
+            except (ValueError, TypeError, AttributeError) as e:
+                log.warning("Dropped trigger %s: %s", item, e)
+
+    def save(self) -> None:
+        store.save(self.path, [trigger.as_list() for trigger in self.by_name.values()])
+
+    def _store(self, trigger: Trigger) -> None:
+        self.by_key[trigger.key] = trigger
+        self.by_name[trigger.name] = trigger
+
+    def add(self, name: str, match: dict, action: bytes) -> Trigger:
+        key = match_key(match)
+        existing = self.by_key.get(key, None)
+        if existing is not None and existing.name != name:
+            raise ValueError("Trigger {} already matches this message".format(existing.name))
+        if name not in self.by_name and len(self.by_name) >= self.size:
+            raise ValueError("Trigger table is full ({} entries)".format(self.size))
+        self.remove(name, save=False)
+        trigger = Trigger(name, key, action)
+        self._store(trigger)
+        self.save()
+        return trigger
+
+    def set(self, data: dict) -> None:
+        # {"name": ..., "match": {"type": "NEC", "device_id": ..., "command": ...}, "action": {...}}
+        if "name" not in data or not isinstance(data.get("match", None), dict) or "action" not in data:
+            raise ValueError("No name, match or action in trigger")
+        self.add(str(data["name"]), data["match"], stored_payload(data["action"]))
+
+    def as_dict(self) -> dict:
+        return {name: trigger.as_dict() for name, trigger in self.by_name.items()}
+
+    def protocols(self) -> "Set[str]":
+        # The protocols the receivers have to decode for the stored triggers.
+        return set(PROTOCOL_NAMES[key >> _PROTOCOL_SHIFT] for key in self.by_key)
+
+    def remove(self, name: str, save: bool = True) -> bool:
+        trigger = self.by_name.pop(name, None)
+        if trigger is None:
+            return False
+        del self.by_key[trigger.key]
+        if save:
+            self.save()
+        return True
+
+    def match(self, message) -> "Optional[Trigger]":
+        # Called for every captured message. Returns the trigger to run, if any, and marks it as fired.
+        if not self.by_key:
+            return None
+        trigger = self.by_key.get(message_key(message), None)
+        if trigger is None:
+            return None
+        now = time.ticks_ms()
+        if trigger.running or (
+            trigger.last_fired is not None and time.ticks_diff(now, trigger.last_fired) < self.cooldown_ms
+        ):
+            self.suppressed += 1
+            return None
+        trigger.last_fired = now
+        self.fired += 1
+        return trigger
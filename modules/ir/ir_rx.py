@@ -1,52 +1,164 @@
-import math
 import time
 from array import array
 from collections import namedtuple
 
-from machine import Pin, Timer
+import machine
+import micropython
+import uasyncio
+from machine import Pin
 from micropython import const
+from ringlog import log
+
+
+FRAME_GAP_US = const(10000)
+# The worker waits this long without edges before checking again, in case a wakeup was lost to a full schedule queue.
+IDLE_CHECK_MS = const(1000)
+# Shorter bursts (e.g. NEC repeat codes) are dropped without counting them as decode failures.
+MIN_FRAME_EDGES = const(6)
 
 
 class InfraredRX:
-    def __init__(self, pin: Pin, number_edges: int, block_time_us: int):
+    # The interrupt handler only timestamps edges into a preallocated buffer. A frame ends once the line was
+    # quiet for FRAME_GAP_US or block_time_us after its first edge, which DecodeWorker checks for all receivers,
+    # so no receiver needs a hardware timer of its own.
+    def __init__(self, pin: Pin, number_edges: int, block_time_us: int, name: str = None):
         self.pin = pin
+        self.name = name
         self.number_edges = number_edges
         self.buffer = array("i", (0 for _ in range(number_edges)))
+        self.spare = array("i", (0 for _ in range(number_edges)))
         self.block_time_us = block_time_us
-        self.wait_time_ms = int(math.floor(self.block_time_us / 1000))
         self.index = 0
+        self.last_edge = 0
+        self.decode_failures = 0
+        # Scheduled with the first edge of a frame to wake up the decode worker. Set by DecodeWorker.add().
+        self.on_frame_start = None
         pin.irq(handler=self._on_data, trigger=Pin.IRQ_FALLING | Pin.IRQ_RISING)
-        self.timer = Timer(1)
 
     def _on_data(self, pin):
         tick_time = time.ticks_us()
+        if not self.index and self.on_frame_start is not None:
+            try:
+                micropython.schedule(self.on_frame_start, None)
+            except RuntimeError:
+                pass  # Queue full. The worker finds the frame on its next idle check.
         if self.index < self.number_edges:
-            if not self.index:
-                self.timer.init(period=self.wait_time_ms, mode=Timer.ONE_SHOT, callback=lambda *args: self._callback())
-
             self.buffer[self.index] = tick_time
             self.index += 1
-
-    @property
-    def time_relative_buffer(self):
-        start = None
-        d = []
-        for item in self.buffer:
-            if start is None:
-                start = item
-            if item <= 0:
-                break
-
-            d.append(item - start)
-            start = item
-        return d
-
-    def _callback(self):
-        self.buffer = array("i", (0 for _ in range(self.number_edges)))
+            self.last_edge = tick_time
+
+    def frame_complete(self, now_us: int) -> bool:
+        if not self.index:
+            return False
+        if time.ticks_diff(now_us, self.last_edge) >= FRAME_GAP_US:
+            return True
+        return time.ticks_diff(now_us, self.buffer[0]) >= self.block_time_us
+
+    def take_frame(self) -> "Tuple[array, int]":
+        # Swaps in the spare buffer, so edges of the next frame can be recorded while this one is decoded.
+        state = machine.disable_irq()
+        frame, length = self.buffer, self.index
+        self.buffer = self.spare
+        self.spare = frame
         self.index = 0
+        machine.enable_irq(state)
+        return frame, length
+
+    def decode(self, buffer: array, length: int):
+        raise NotImplementedError()
 
     def close(self):
-        self.pin.deinit()
+        self.pin.irq(handler=None)
+
+
+def relative_timings(buffer: array, length: int) -> "List[int]":
+    # Durations between the edges, preceded by 0 for the first edge.
+    d = [0]
+    for index in range(1, length):
+        d.append(time.ticks_diff(buffer[index], buffer[index - 1]))
+    return d
+
+
+class DecodeWorker:
+    # One task decodes the finished frames of all receivers. A message captured by several receivers within
+    # dedup_ms is only reported for the first one, so more receivers improve coverage without more publishes.
+    # The callback gets the message, the name of the receiver and the ticks_us() of the last edge of the frame.
+    # The worker only polls while a frame is being received. Otherwise it sleeps until the first edge of the next
+    # frame wakes it up from the interrupt handler.
+    def __init__(self, callback, poll_ms: int = 5, dedup_ms: int = 150):
+        self.callback = callback
+        self.poll_ms = poll_ms
+        self.dedup_ms = dedup_ms
+        self.receivers: "List[InfraredRX]" = []
+        self.last_message = None
+        self.last_receiver = None
+        self.last_ticks = 0
+        self.duplicates = 0
+        self.stopped = False
+        self.wakeup = uasyncio.Event()
+        # Bound once, so the interrupt handler doesn't allocate a bound method for every frame.
+        self._wake = self.wake
+
+    def add(self, receiver: InfraredRX) -> None:
+        receiver.on_frame_start = self._wake
+        self.receivers.append(receiver)
+
+    def wake(self, _argument=None) -> None:
+        self.wakeup.set()
+
+    @property
+    def decode_failures(self) -> int:
+        return sum(receiver.decode_failures for receiver in self.receivers)
+
+    def is_duplicate(self, message, receiver: InfraredRX) -> bool:
+        now = time.ticks_ms()
+        same = receiver is not self.last_receiver and message == self.last_message
+        if same and time.ticks_diff(now, self.last_ticks) < self.dedup_ms:
+            self.duplicates += 1
+            return True
+        self.last_message = message
+        self.last_receiver = receiver
+        self.last_ticks = now
+        return False
+
+    def poll(self) -> bool:
+        # Returns whether a frame is still being received.
+        now = time.ticks_us()
+        receiving = False
+        for receiver in self.receivers:
+            if not receiver.frame_complete(now):
+                receiving = receiving or receiver.index > 0
+                continue
+            buffer, length = receiver.take_frame()
+            if length < MIN_FRAME_EDGES:
+                continue
+            decoded = receiver.decode(buffer, length)
+            if decoded is None:
+                receiver.decode_failures += 1
+            elif not self.is_duplicate(decoded, receiver):
+                if self.callback is None:
+                    log.info("Received %s on %s", decoded, receiver.name)
+                else:
+                    self.callback(decoded, receiver.name, buffer[length - 1])
+        return receiving
+
+    def close(self) -> None:
+        self.stopped = True
+        for receiver in self.receivers:
+            receiver.close()
+        self.wakeup.set()
+
+    async def start(self) -> None:
+        while not self.stopped:
+            # Cleared before polling, so an edge during the poll still wakes up the wait below.
+            self.wakeup.clear()
+            if self.poll():
+                await uasyncio.sleep_ms(self.poll_ms)
+                continue
+            try:
+                await uasyncio.wait_for_ms(self.wakeup.wait(), IDLE_CHECK_MS)
+            except uasyncio.TimeoutError:
+                pass
 
 
 class NECMessage(namedtuple("NECMessage", ["device_id", "command"])):
@@ -70,21 +182,13 @@ MAX_COMMAND_ID_CHECK_INDEX = MAX_COMMAND_ID_INDEX + 8
 
 
 class NEC(InfraredRX):
-    def __init__(self, pin: Pin, callback=None):
-        super().__init__(pin=pin, number_edges=(8 * 4 + 2 + 1) * 2, block_time_us=80 * 1000)
-        self.on_data = callback
-
-    def _callback(self):
-        decoded = self._decode()
-        if decoded is not None:
-            if self.on_data is None:
-                print(decoded)
-            else:
-                self.on_data(decoded)
+    NUMBER_EDGES = (8 * 4 + 2 + 1) * 2
+    BLOCK_TIME_US = 80 * 1000
 
-        super()._callback()
+    def __init__(self, pin: Pin, name: str = None):
+        super().__init__(pin=pin, number_edges=self.NUMBER_EDGES, block_time_us=self.BLOCK_TIME_US, name=name)
 
-    def _decode(self) -> "Optional[NECMessage]":
+    def decode(self, buffer: array, length: int) -> "Optional[NECMessage]":
         start_high_received = False
 
         device_id = 0
@@ -92,16 +196,16 @@ class NEC(InfraredRX):
         command_id = 0
         command_id_check = 0
 
-        for index in range(self.number_edges / 2):
+        for index in range(length // 2):
             real_index = index * 2
-            if real_index + 2 >= self.number_edges:
+            if real_index + 2 >= length:
                 break
-            first_timing = self.buffer[real_index + 1] - self.buffer[real_index]
-            second_timing = self.buffer[real_index + 2] - self.buffer[real_index + 1]
+            first_timing = time.ticks_diff(buffer[real_index + 1], buffer[real_index])
+            second_timing = time.ticks_diff(buffer[real_index + 2], buffer[real_index + 1])
 
             if not start_high_received:
                 if not is_nec_start_high(first_timing, second_timing):
-                    print("Start Flag not there Timing(%s, %s)" % (first_timing, second_timing))
+                    log.debug("Start Flag not there Timing(%s, %s)", first_timing, second_timing)
                     return None
                 else:
                     start_high_received = True
@@ -110,7 +214,7 @@ class NEC(InfraredRX):
             try:
                 nec_bit = convert_nec_to_bit(first_timing, second_timing)
             except AssertionError:
-                print("Cannot decode NEC Burst(%s, %s)" % (first_timing, second_timing))
+                log.debug("Cannot decode NEC Burst(%s, %s)", first_timing, second_timing)
                 return None
 
             if index < MAX_DEVICE_ID_INDEX:
@@ -125,9 +229,12 @@ class NEC(InfraredRX):
         if device_id == device_id_check ^ 0xFF and command_id == command_id_check ^ 0xFF:
             return NECMessage(device_id, command_id)
         else:
-            print(
-                "Could not decode NEC message DeviceID(%s, %s), CommandID(%s, %s)"
-                % (device_id, device_id_check, command_id, command_id_check)
+            log.debug(
+                "Could not decode NEC message DeviceID(%s, %s), CommandID(%s, %s)",
+                device_id,
+                device_id_check,
+                command_id,
+                command_id_check,
             )
             return None
 
@@ -147,7 +254,7 @@ RC6_BLOCK_TIME = const(
 )
 
 
-def convert_to_int(byte_list: List[int]) -> int:
+def convert_to_int(byte_list: "List[int]") -> int:
     item = 0
     for byte_item in byte_list:
         item = (item << 1) | byte_item
@@ -169,14 +276,14 @@ def timing_in_rc_units(timing: int) -> int:
     return int(round(float(timing) / RC6_TIME_FRAME_US))
 
 
-def buffer_to_rc6(buffer: List[int]) -> Optional[RC6Message]:
+def buffer_to_rc6(buffer: "List[int]") -> "Optional[RC6Message]":
     if len(buffer) != 20:
-        print("Tried to convert a message which doesn't have 20 bits for RC6. Aborting. Message: %s" % buffer)
+        log.debug("Tried to convert a message which doesn't have 20 bits for RC6. Aborting. Message: %s", buffer)
         return None
 
     mode = convert_to_int(buffer[0:3])
     if mode != 0:
-        print("Unknown RC6 mode received. Only mode 0 is supported. Got an RC6 message with mode %s" % mode)
+        log.debug("Unknown RC6 mode received. Only mode 0 is supported. Got an RC6 message with mode %s", mode)
         return None
 
     control_buffer_start = 4
@@ -189,22 +296,14 @@ def buffer_to_rc6(buffer: List[int]) -> Optional[RC6Message]:
 
 
 class RC6(InfraredRX):
-    def __init__(self, pin: Pin, callback=None):
-        super().__init__(pin=pin, number_edges=(1 + 1 + 3 + 1 + 8 * 2 + 1) * 2, block_time_us=RC6_BLOCK_TIME)
-        self.on_data = callback
-
-    def _callback(self):
-        decoded = self._decode()
-        if decoded is not None:
-            if self.on_data is None:
-                print(decoded)
-            else:
-                self.on_data(decoded)
+    NUMBER_EDGES = (1 + 1 + 3 + 1 + 8 * 2 + 1) * 2
+    BLOCK_TIME_US = RC6_BLOCK_TIME
 
-        super()._callback()
+    def __init__(self, pin: Pin, name: str = None):
+        super().__init__(pin=pin, number_edges=self.NUMBER_EDGES, block_time_us=self.BLOCK_TIME_US, name=name)
 
-    def _decode(self) -> "Optional[RC6Message]":
-        buffer = self.time_relative_buffer
+    def decode(self, edges: array, length: int) -> "Optional[RC6Message]":
+        buffer = relative_timings(edges, length)
         if len(buffer) < 4:
             return None
 
@@ -212,14 +311,16 @@ class RC6(InfraredRX):
         first_timing = buffer[1]
         second_timing = buffer[2]
         if not is_rc6_start(first_timing, second_timing):
-            print("Could not decode RC6 message. Timing(%s, %s)" % (first_timing, second_timing))
+            log.debug("Could not decode RC6 message. Timing(%s, %s)", first_timing, second_timing)
             return None
 
         current_state = 1
         if timing_in_rc_units(buffer[3]) != 1:
-            print(
+            log.debug(
                 "Could not decode RC6 message. Timing of Start bit after LS bit is not 1 Unit. "
-                "Timing was (%s, %s ticks)" % (buffer[3], timing_in_rc_units(buffer[3]))
+                "Timing was (%s, %s ticks)",
+                buffer[3],
+                timing_in_rc_units(buffer[3]),
             )
             return None
 
@@ -238,9 +339,12 @@ class RC6(InfraredRX):
                 if rc_unit_timing == 0 or rc_unit_timing in (6, 7):
                     return buffer_to_rc6(decoded_binary)
                 else:
-                    print(
-                        "Did not find RC6 signal free time at index %s on buffer %s with timings %s with payload %s"
-                        % (i, buffer, timing_buffer, decoded_binary)
+                    log.debug(
+                        "Did not find RC6 signal free time at index %s on buffer %s with timings %s with payload %s",
+                        i,
+                        buffer,
+                        timing_buffer,
+                        decoded_binary,
                     )
                     return None
             if len(decoded_binary) == 3:
@@ -254,9 +358,12 @@ class RC6(InfraredRX):
                     record_value(current_state)
                     last_recorded_index = i
                 else:
-                    print(
+                    log.debug(
                         "Invalid state sending in RC6 message on header. "
-                        "Stopped at index %s on buffer %s with timings %s" % (i, buffer, timing_buffer)
+                        "Stopped at index %s on buffer %s with timings %s",
+                        i,
+                        buffer,
+                        timing_buffer,
                     )
                     return None
 
@@ -270,9 +377,11 @@ class RC6(InfraredRX):
                 record_value(current_state)
                 last_recorded_index = i
             else:
-                print(
-                    "Invalid state sending in RC6 message. Stopped at index %s on buffer %s with timings %s"
-                    % (i, buffer, timing_buffer)
+                log.debug(
+                    "Invalid state sending in RC6 message. Stopped at index %s on buffer %s with timings %s",
+                    i,
+                    buffer,
+                    timing_buffer,
                 )
                 return None
 
@@ -280,3 +389,23 @@ class RC6(InfraredRX):
             decoded_binary.append(current_state)
 
         return buffer_to_rc6(decoded_binary)
+
+
+class MultiProtocol(InfraredRX):
+    # Decodes every frame with each of the receiver types in turn, so one pin captures several protocols at once.
+    # The decoders only look at the edges, not at the receiver they are called on.
+    def __init__(self, pin: Pin, receiver_types: tuple, name: str = None):
+        super().__init__(
+            pin=pin,
+            number_edges=max(receiver_type.NUMBER_EDGES for receiver_type in receiver_types),
+            block_time_us=max(receiver_type.BLOCK_TIME_US for receiver_type in receiver_types),
+            name=name,
+        )
+        self.receiver_types = receiver_types
+
+    def decode(self, buffer: array, length: int):
+        for receiver_type in self.receiver_types:
+            message = receiver_type.decode(self, buffer, length)
+            if message is not None:
+                return message
+        return None
@@ -1,11 +1,15 @@
+from array import array
 from collections import namedtuple
 
 from esp32 import RMT
 from machine import Pin
 from micropython import const
+from ringlog import log
 
 Packet = namedtuple("Packet", ["value", "timing_us"])
 
+MAX_PULSES = const(96)
+
 
 class InfraredTx:
     def __init__(self, pin: Pin, rmt: RMT = None, rmt_number: int = 0, carrier_freq: int = 38000) -> None:
@@ -13,23 +17,40 @@ class InfraredTx:
         if rmt is None:
             rmt = RMT(rmt_number, pin=self.pin, clock_div=80, carrier_freq=carrier_freq)
         self.rmt = rmt
+        # Frames are encoded into a preallocated array. write_pulses() only takes lists and tuples, so the
+        # pulses are copied into a list of the frame's length, which is reused for every frame of that length.
+        self._buffer = array("H", (0 for _ in range(MAX_PULSES)))
+        self._frames = {}
         self.reset()
 
     def reset(self) -> None:
-        self._buffer = []
+        self._length = 0
 
-    def _add(self, timing_us: float) -> None:
-        self._buffer.append(int(timing_us))
+    def _add(self, timing_us: int) -> None:
+        self._buffer[self._length] = timing_us
+        self._length += 1
 
     def trigger(self) -> None:
+        length = self._length
+        frame = self._frames.get(length, None)
+        if frame is None:
+            frame = self._frames[length] = [0] * length
+        buffer = self._buffer
+        for index in range(length):
+            frame[index] = buffer[index]
         rmt = self.rmt
-        payload = tuple(self._buffer)
-        rmt.write_pulses(payload, start=1)
+        rmt.write_pulses(frame, start=1)
         rmt.wait_done()
 
         self.reset()
 
 
+NEC_BURST_US = const(9000)
+NEC_SPACE_US = const(4500)
+NEC_PULSE_US = const(562)
+NEC_ONE_US = const(1687)
+
+
 class NEC(InfraredTx):
     def send(self, device_id: int, command: int):
         self._add_start_burst()
@@ -47,18 +68,18 @@ class NEC(InfraredTx):
             self.add(bool(data & 2 ** index))
 
     def add(self, bit: bool) -> None:
-        self._add(562.5)
+        self._add(NEC_PULSE_US)
         if bit:
-            self._add(1687.5)
+            self._add(NEC_ONE_US)
         else:
-            self._add(562.5)
+            self._add(NEC_PULSE_US)
 
     def _add_start_burst(self) -> None:
-        self._add(9000)
-        self._add(4500)
+        self._add(NEC_BURST_US)
+        self._add(NEC_SPACE_US)
 
     def _add_end_burst(self) -> None:
-        self._add(562.5)
+        self._add(NEC_PULSE_US)
 
 
 RC6_TIME_FRAME_US = const(444)
@@ -69,7 +90,7 @@ class RC6(InfraredTx):
 
     def send(self, control: int, information: int, header: int = 0) -> None:
         self._current_state = None
-        print("SENDING RC6 Message with Control=%s, Information=%s, Header=%s" % (control, information, header))
+        log.debug("Sending RC6 Message with Control=%s, Information=%s, Header=%s", control, information, header)
         self._add_start_burst()
         self._add_start_flag()
         self._add_header(header, trailing_flag=self.trailing_flag)
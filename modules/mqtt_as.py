@@ -7,6 +7,8 @@
 # Various improvements contributed by Kevin Köck.
 
 import gc
+import json
+import os
 
 import usocket as socket
 import ustruct as struct
@@ -17,7 +19,7 @@ from ubinascii import hexlify
 
 gc.collect()
 from uerrno import EINPROGRESS, ETIMEDOUT
-from utime import ticks_diff, ticks_ms
+from utime import ticks_diff, ticks_ms, ticks_us
 
 gc.collect()
 import network
@@ -71,6 +73,11 @@ config = {
     "connect_coro": eliza,
     "ssid": None,
     "wifi_pw": None,
+    "net_cache": None,
+    "phases": None,
+    "profiler": None,
+    "logger": None,
+    "gc_collect": True,
 }
 
 
@@ -122,6 +129,14 @@ class MQTT_base:
         self._cb = config["subs_cb"]
         self._wifi_handler = config["wifi_coro"]
         self._connect_handler = config["connect_coro"]
+        # Optional tracker with enter(name)/leave() around calls which block the event loop.
+        self._phases = config["phases"]
+        # Optional boot profiler. mark(name) is called at the end of each connect phase.
+        self._profiler = config["profiler"]
+        # Optional logger. dprint() output goes to its info level instead of the console.
+        self._logger = config["logger"]
+        # Collect garbage every second while connected. Off if the application schedules collections itself.
+        self._gc_collect = config["gc_collect"]
         # Network
         self.port = config["port"]
         if self.port == 0:
@@ -132,9 +147,23 @@ class MQTT_base:
         self._sock = None
         self._sta_if = network.WLAN(network.STA_IF)
         self._sta_if.active(True)
+        # Last good access point and broker address. Persisted to flash if a path is configured.
+        self._net_cache = config["net_cache"]
+        self._bssid = None
+        self._channel = None
+        self._addr = None
+        self._net_cache_data = None
+        self._load_net_cache()
+        # Duration of the phases of the last (re)connect in ms.
+        self.timings = {}
+        self.down_at = None
 
         self.newpid = pid_gen()
+        self._pub_header = bytearray(7)
         self.rcv_pids = set()  # PUBACK and SUBACK pids awaiting ACK response
+        self.rx_pid = None
+        self.rx_dup = False
+        self.rx_us = 0
         self.last_rx = ticks_ms()  # Time of last communication from broker
         self.lock = asyncio.Lock()
 
@@ -148,9 +177,61 @@ class MQTT_base:
         self._lw_retain = retain
 
     def dprint(self, *args):
-        if self.DEBUG:
+        if self._logger is not None:
+            self._logger.info(" ".join(str(arg) for arg in args))
+        elif self.DEBUG:
             print(*args)
 
+    def _load_net_cache(self):
+        if not self._net_cache:
+            return
+        try:
+            with open(self._net_cache, "r") as handle:
+                data = json.load(handle)
+        except (OSError, ValueError):
+            return
+        self._net_cache_data = data
+        if data.get("ssid") == self._ssid and data.get("bssid"):
+            self._bssid = bytes(int(part, 16) for part in data["bssid"].split(":"))
+            self._channel = data.get("channel")
+        if data.get("server") == self.server and data.get("port") == self.port and data.get("addr"):
+            self._addr = tuple(data["addr"])
+
+    def _save_net_cache(self):
+        if not self._net_cache:
+            return
+        data = {
+            "ssid": self._ssid,
+            "bssid": ":".join("{:02x}".format(b) for b in self._bssid) if self._bssid else None,
+            "channel": self._channel,
+            "server": self.server,
+            "port": self.port,
+            "addr": list(self._addr) if self._addr else None,
+        }
+        if data == self._net_cache_data:  # Spare the flash.
+            return
+        self._net_cache_data = data
+        try:
+            # Through a temporary file, so a reset during the write keeps the previous cache.
+            with open(self._net_cache + ".tmp", "w") as handle:
+                json.dump(data, handle)
+            os.rename(self._net_cache + ".tmp", self._net_cache)
+        except OSError as e:
+            self.dprint("Could not write network cache", e)
+
+    def _enter(self, phase):
+        if self._phases is not None:
+            self._phases.enter(phase)
+
+    def _leave(self):
+        if self._phases is not None:
+            self._phases.leave()
+
+    def _timing(self, phase, t):
+        self.timings[phase] = ticks_diff(ticks_ms(), t)
+        if self._profiler is not None:
+            self._profiler.mark(phase)
+
     def _timeout(self, t):
         return ticks_diff(ticks_ms(), t) > self._response_time
 
@@ -218,21 +299,26 @@ class MQTT_base:
         while True:
             try:
                 gc.collect()
+                self._enter("mqtt_connect")
                 self._sock.connect(self._addr)
                 gc.collect()
                 break
             except OSError as e:
                 if e.args[0] not in BUSY_ERRORS:
                     raise
+            finally:
+                self._leave()
         await asyncio.sleep_ms(_DEFAULT_MS)
         self.dprint("Connecting to broker.")
         if self._ssl:
             import ussl
 
+            t = ticks_ms()
             tries = 0
             while True:
                 try:
                     gc.collect()
+                    self._enter("mqtt_ssl")
                     self._sock = ussl.wrap_socket(self._sock, **self._ssl_params)
                     gc.collect()
                     break
@@ -240,7 +326,10 @@ class MQTT_base:
                     tries += 1
                     if e.args[0] not in BUSY_ERRORS and tries > 10:
                         raise
-                    await asyncio.sleep_ms(_DEFAULT_MS)
+                finally:
+                    self._leave()
+                await asyncio.sleep_ms(_DEFAULT_MS)
+            self._timing("tls", t)
         sock.setblocking(False)
 
         premsg = bytearray(b"\x10\0\0\0\0\0")
@@ -375,8 +464,9 @@ class MQTT_base:
             self.REPUB_COUNT += 1
 
     async def _publish(self, topic, msg, retain, qos, dup, pid):
-        pkt = bytearray(b"\x30\0\0\0")
-        pkt[0] |= qos << 1 | retain | dup << 3
+        # Callers hold self.lock, so the header buffer is reused for every message.
+        pkt = self._pub_header
+        pkt[0] = 0x30 | qos << 1 | retain | dup << 3
         sz = 2 + len(topic) + len(msg)
         if qos > 0:
             sz += 2
@@ -388,8 +478,10 @@ class MQTT_base:
             sz >>= 7
             i += 1
         pkt[i] = sz
-        await self._as_write(pkt, i + 1)
-        await self._send_str(topic)
+        # Fixed header and the length of the topic in one write.
+        struct.pack_into("!H", pkt, i + 1, len(topic))
+        await self._as_write(pkt, i + 3)
+        await self._as_write(topic)
         if qos > 0:
             struct.pack_into("!H", pkt, 0, pid)
             await self._as_write(pkt, 2)
@@ -397,14 +489,31 @@ class MQTT_base:
 
     # Can raise OSError if WiFi fails. Subclass traps
     async def subscribe(self, topic, qos):
-        pkt = bytearray(b"\x82\0\0\0")
+        await MQTT_base.subscribe_many(self, ((topic, qos),))
+
+    # Subscribe to several (topic, qos) filters with a single SUBSCRIBE packet
+    # and a single SUBACK round trip.
+    async def subscribe_many(self, topics):
+        pkt = bytearray(b"\x82\0\0\0\0\0")
         pid = next(self.newpid)
         self.rcv_pids.add(pid)
-        struct.pack_into("!BH", pkt, 1, 2 + 2 + len(topic) + 1, pid)
+        sz = 2
+        for topic, qos in topics:
+            sz += 2 + len(topic) + 1
+        if sz >= 2097152:
+            raise MQTTException("Strings too long.")
+        i = 1
+        while sz > 0x7F:
+            pkt[i] = (sz & 0x7F) | 0x80
+            sz >>= 7
+            i += 1
+        pkt[i] = sz
+        struct.pack_into("!H", pkt, i + 1, pid)
         async with self.lock:
-            await self._as_write(pkt)
-            await self._send_str(topic)
-            await self._as_write(qos.to_bytes(1, "little"))
+            await self._as_write(pkt, i + 3)
+            for topic, qos in topics:
+                await self._send_str(topic)
+                await self._as_write(qos.to_bytes(1, "little"))
 
         if not await self._await_pid(pid):
             raise OSError(-1)
@@ -437,11 +546,12 @@ class MQTT_base:
             else:
                 raise OSError(-1)
 
-        if op == 0x90:  # SUBACK
-            resp = await self._as_read(4)
-            if resp[3] == 0x80:
+        if op == 0x90:  # SUBACK. One return code per topic filter of the SUBSCRIBE.
+            sz = await self._recv_len()
+            resp = await self._as_read(sz)
+            if 0x80 in resp[2:]:
                 raise OSError(-1)
-            pid = resp[2] | (resp[1] << 8)
+            pid = resp[1] | (resp[0] << 8)
             if pid in self.rcv_pids:
                 self.rcv_pids.discard(pid)
             else:
@@ -459,7 +569,12 @@ class MQTT_base:
             pid = pid[0] << 8 | pid[1]
             sz -= 2
         msg = await self._as_read(sz)
+        self.rx_us = ticks_us()
         retained = op & 0x01
+        # PID, DUP flag and ticks_us() when the socket read completed of the message being delivered,
+        # valid during the callback.
+        self.rx_pid = pid if op & 6 else None
+        self.rx_dup = bool(op & 0x08)
         self._cb(topic, msg, bool(retained))
         if op & 6 == 2:  # qos 1
             pkt = bytearray(b"\x40\x02\0\0")  # Send PUBACK
@@ -489,8 +604,41 @@ class MQTTClient(MQTT_base):
 
             esp.sleep_type(0)  # Improve connection integrity at cost of power consumption.
 
+    # Pick the strongest access point broadcasting our SSID. Used on a full
+    # lookup when no last good BSSID is known or it stopped working.
+    def _scan_bssid(self):
+        best = None
+        try:
+            for ap in self._sta_if.scan():
+                ssid, bssid, channel, rssi = ap[0:4]
+                if ssid.decode() == self._ssid and (best is None or rssi > best[2]):
+                    best = (bssid, channel, rssi)
+        except OSError:
+            return None
+        return best
+
+    async def _await_wifi(self, s):
+        start_time = ticks_ms()
+        max_wait_time = 60000
+        while s.status() == network.STAT_CONNECTING:  # Break out on fail or success. Check once per sec.
+            if ticks_diff(ticks_ms(), start_time) > max_wait_time:
+                self.dprint(
+                    "Waited for {} seconds for a conncetion to occur. Hard reboot to clear local state".format(
+                        max_wait_time / 1000
+                    )
+                )
+                self._sta_if.active(False)
+                reset()
+            elif ticks_diff(ticks_ms(), start_time) > 3000:
+                self.dprint("Waiting for WiFi to connect. Waiting for {}ms".format(ticks_diff(ticks_ms(), start_time)))
+                await asyncio.sleep(1)
+                continue
+            await asyncio.sleep_ms(100)  # Poll fast while an association is likely to finish soon.
+
     async def wifi_connect(self):
         s = self._sta_if
+        t = ticks_ms()
+        fast = False
         if ESP8266:
             if s.isconnected():  # 1st attempt, already connected.
                 return
@@ -509,6 +657,27 @@ class MQTTClient(MQTT_base):
                 s.connect(self._ssid, self._wifi_pw)
                 while s.status() == network.STAT_CONNECTING:  # Break out on fail or success. Check once per sec.
                     await asyncio.sleep(1)
+        elif ESP32 and self._ssid is not None:
+            s.active(True)
+            if self._bssid is not None:
+                # Fast path: join the last good access point without a scan.
+                s.connect(self._ssid, self._wifi_pw, bssid=self._bssid)
+                await self._await_wifi(s)
+                fast = s.isconnected()
+                if not fast:
+                    self.dprint("Cached access point unavailable. Falling back to full lookup.")
+                    self._bssid = None
+                    s.disconnect()
+            if not fast:
+                best = self._scan_bssid()
+                if best is None:
+                    s.connect(self._ssid, self._wifi_pw)
+                else:
+                    self._bssid, self._channel, _ = best
+                    s.connect(self._ssid, self._wifi_pw, bssid=self._bssid)
+                await self._await_wifi(s)
+                if not s.isconnected():
+                    self._bssid = None
         else:
             s.active(True)
             s.connect(self._ssid, self._wifi_pw)
@@ -523,46 +692,62 @@ class MQTTClient(MQTT_base):
                     if i >= 10:
                         break
             else:
-                start_time = ticks_ms()
-                max_wait_time = 60000
-                while s.status() == network.STAT_CONNECTING:  # Break out on fail or success. Check once per sec.
-                    if ticks_diff(ticks_ms(), start_time) > max_wait_time:
-                        self.dprint(
-                            "Waited for {} seconds for a conncetion to occur. Hard reboot to clear local state".format(
-                                max_wait_time / 1000
-                            )
-                        )
-                        self._sta_if.active(False)
-                        reset()
-                    else:
-                        self.dprint(
-                            "Waiting for WiFi to connect. Waiting for {}ms".format(ticks_diff(ticks_ms(), start_time))
-                        )
-                    await asyncio.sleep(1)
+                await self._await_wifi(s)
 
         if not s.isconnected():
             raise OSError
-        # Ensure connection stays up for a few secs.
+        # Ensure connection stays up for a few secs. A known good access point
+        # only gets a short check.
         self.dprint("Checking WiFi integrity.")
-        for _ in range(5):
+        for _ in range(1 if fast else 5):
             if not s.isconnected():
                 raise OSError  # in 1st 5 secs
             await asyncio.sleep(1)
         self.dprint("Got reliable connection")
+        self.timings["wifi_fast"] = fast
+        self._timing("wifi", t)
+
+    def _resolve(self):
+        t = ticks_ms()
+        # Note this blocks while the DNS lookup occurs.
+        self._enter("mqtt_dns")
+        try:
+            self._addr = socket.getaddrinfo(self.server, self.port, 0, socket.SOCK_STREAM)[0][-1]
+        finally:
+            self._leave()
+        self._timing("dns", t)
 
     async def connect(self):
         if not self._has_connected:
+            self.timings = {}
             await self.wifi_connect()  # On 1st call, caller handles error
-            # Note this blocks if DNS lookup occurs. Do it once to prevent
-            # blocking during later internet outage:
-            self._addr = socket.getaddrinfo(self.server, self.port, 0, socket.SOCK_STREAM)[0][-1]
+        # Resolve once and reuse the address (also across reboots via the net
+        # cache) to prevent blocking during later internet outage.
+        cached = self._addr is not None
+        if not cached:
+            self._resolve()
         self._in_connect = True  # Disable low level ._isconnected check
         clean = self._clean if self._has_connected else self._clean_init
+        t = ticks_ms()
         try:
-            await self._connect(clean)
+            try:
+                await self._connect(clean)
+            except OSError:
+                if not cached:
+                    raise
+                # The broker might have moved. Retry once with a fresh lookup.
+                self.dprint("Cached broker address failed. Resolving again.")
+                self.close()
+                self._resolve()
+                t = ticks_ms()
+                await self._connect(clean)
         except Exception:
             self.close()
             raise
+        self._timing("broker", t)
+        if self.down_at is not None:
+            self.timings["outage"] = ticks_diff(ticks_ms(), self.down_at)
+        self._save_net_cache()
         self.rcv_pids.clear()
         # If we get here without error broker/LAN must be up.
         self._isconnected = True
@@ -629,6 +814,8 @@ class MQTTClient(MQTT_base):
     def _reconnect(self):  # Schedule a reconnection if not underway.
         if self._isconnected:
             self._isconnected = False
+            self.down_at = ticks_ms()
+            self.timings = {}
             self.close()
             loop = asyncio.get_event_loop()
             loop.create_task(self._wifi_handler(False))  # User handler.
@@ -645,7 +832,8 @@ class MQTTClient(MQTT_base):
             if self.isconnected():  # Pause for 1 second
                 self._reconnect_tries = 0
                 await asyncio.sleep(1)
-                gc.collect()
+                if self._gc_collect:
+                    gc.collect()
             else:
                 self._sta_if.active(False)
                 await asyncio.sleep(1)
@@ -674,11 +862,15 @@ class MQTTClient(MQTT_base):
         self.dprint("Disconnected, exited _keep_connected")
 
     async def subscribe(self, topic, qos=0):
-        qos_check(qos)
+        return await self.subscribe_many(((topic, qos),))
+
+    async def subscribe_many(self, topics):
+        for _, qos in topics:
+            qos_check(qos)
         while 1:
             await self._connection()
             try:
-                return await super().subscribe(topic, qos)
+                return await super().subscribe_many(topics)
             except OSError:
                 pass
             self._reconnect()  # Broker or WiFi fail.
@@ -0,0 +1,112 @@
+# Leveled logger keeping the most recent records in RAM. Kept outside of esp32_remote so the ir package can log
+# too. Printing goes synchronously over the UART, so only records from console_level on are printed.
+import time
+
+from micropython import const
+
+DEBUG = const(10)
+INFO = const(20)
+WARNING = const(30)
+ERROR = const(40)
+OFF = const(50)
+
+LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR, "off": OFF}
+LEVEL_NAMES = {DEBUG: "debug", INFO: "info", WARNING: "warning", ERROR: "error"}
+# Arguments of these types are stored as they are. Anything else may change before the record is formatted.
+_IMMUTABLE = (int, float, str, bytes, bool, tuple, type(None))
+
+
+def parse_level(name: "Union[str, int]", default: int = INFO) -> int:
+    if isinstance(name, int):
+        return name
+    return LEVELS.get(str(name).strip().lower(), default)
+
+
+class RingLogger:
+    # Records are stored in a preallocated ring of [ticks_ms, level, message, args] slots. The message is only
+    # formatted with its arguments when the record is printed or dumped. Mutable arguments (dicts, lists, objects)
+    # are converted to strings when logging, so a record shows their state at that time. Hot paths check
+    # `log.level <= DEBUG` before building the arguments at all.
+    def __init__(self, size: int = 64, level: int = INFO, console_level: int = WARNING):
+        self.records = None
+        self.configure(size, level, console_level)
+
+    def configure(self, size: int = 64, level: int = INFO, console_level: int = WARNING) -> None:
+        # Records logged before the configuration was read are kept unless the size changes.
+        if self.records is None or len(self.records) != size:
+            self.records = [[0, 0, None, None] for _ in range(size)]
+            self.index = 0
+            self.count = 0
+        self.size = size
+        self.ring_level = level if size > 0 else OFF
+        self.console_level = console_level
+        self.level = min(self.ring_level, console_level)
+
+    def log(self, level: int, message: str, *args) -> None:
+        if level < self.level:
+            return
+        if level >= self.ring_level:
+            record = self.records[self.index]
+            record[0] = time.ticks_ms()
+            record[1] = level
+            record[2] = message
+            record[3] = snapshot(args)
+            self.index = (self.index + 1) % self.size
+            self.count += 1
+        if level >= self.console_level:
+            print(format_message(message, args))
+
+    def debug(self, message: str, *args) -> None:
+        if DEBUG >= self.level:
+            self.log(DEBUG, message, *args)
+
+    def info(self, message: str, *args) -> None:
+        if INFO >= self.level:
+            self.log(INFO, message, *args)
+
+    def warning(self, message: str, *args) -> None:
+        if WARNING >= self.level:
+            self.log(WARNING, message, *args)
+
+    def error(self, message: str, *args) -> None:
+        if ERROR >= self.level:
+            self.log(ERROR, message, *args)
+
+    def dump(self, level: int = DEBUG, limit: "Optional[int]" = None) -> dict:
+        # Oldest first, with the age of every record in ms at the time of the dump.
+        now = time.ticks_ms()
+        stored = min(self.count, self.size)
+        records = []
+        for offset in range(stored):
+            ticks, record_level, message, args = self.records[(self.index - stored + offset) % self.size]
+            if record_level >= level:
+                records.append(
+                    [
+                        time.ticks_diff(now, ticks),
+                        LEVEL_NAMES.get(record_level, record_level),
+                        format_message(message, args),
+                    ]
+                )
+        if limit is not None:
+            records = records[-limit:] if limit > 0 else []
+        return {"dropped": self.count - stored, "records": records}
+
+
+def snapshot(args: tuple) -> tuple:
+    # Only allocates if an argument has to be converted.
+    for arg in args:
+        if type(arg) not in _IMMUTABLE:
+            return tuple(arg if type(arg) in _IMMUTABLE else str(arg) for arg in args)
+    return args
+
+
+def format_message(message: str, args: tuple) -> str:
+    if not args:
+        return message
+    try:
+        return message % args
+    except (TypeError, ValueError):
+        return "{} {}".format(message, args)
+
+
+log = RingLogger()
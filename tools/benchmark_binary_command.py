@@ -0,0 +1,67 @@
+# Compare parse time and peak heap of the JSON and the binary command path under CPython.
+#
+# Usage: python tools/benchmark_binary_command.py [scene length] [iterations]
+import json
+import sys
+import time
+import tracemalloc
+
+from command_codec import encode
+from host import load_package
+
+load_package()
+
+from esp32_remote.binary_command import decode  # noqa: E402
+from esp32_remote.commands import from_dict  # noqa: E402
+
+
+def scene(length: int) -> dict:
+    steps = []
+    for index in range(length):
+        if index % 3 == 0:
+            steps.append({"type": "NEC", "device_id": 4, "command": index % 256})
+        elif index % 3 == 1:
+            steps.append({"type": "RC6", "mode": 0, "control": 4, "information": index % 256})
+        else:
+            steps.append({"type": "WAIT", "ms": 100})
+    steps.append({"type": "ISCP", "identifier": "0009B0D8A31C", "command": "MVL", "argument": "20"})
+    steps.append({"type": "REPEAT", "count": 3, "item": {"type": "NEC", "device_id": 4, "command": 2}})
+    return {"type": "SCENE", "scene": steps}
+
+
+def parse_json(payload: bytes):
+    command = from_dict(json.loads(payload))
+    # Convert every step as the scene player would.
+    return [from_dict(step) for step in command.steps]
+
+
+def parse_binary(payload: bytes):
+    return decode(payload).steps
+
+
+def measure(parse, payload: bytes, iterations: int) -> dict:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        parse(payload)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    parse(payload)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"payload_bytes": len(payload), "parse_us": elapsed / iterations * 1e6, "peak_heap_bytes": peak}
+
+
+def main() -> None:
+    length = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    command = scene(length)
+    results = {
+        "json": measure(parse_json, json.dumps(command).encode(), iterations),
+        "binary": measure(parse_binary, encode(command), iterations),
+    }
+    print(json.dumps({"scene_length": length, "iterations": iterations, "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
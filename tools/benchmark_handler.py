@@ -0,0 +1,251 @@
+# End to end benchmark of the firmware on the host: MQTT message in, pulses out of the RMT. Runs the real
+# Handler, IRHandler and MQTTClient against tools/mqtt_broker.py (see tools/simulation.py).
+#
+# Usage: python tools/benchmark_handler.py [--commands 50] [--output results.json] [--baseline previous.json]
+import argparse
+import asyncio
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+
+from host import MODULES
+from mqtt_broker import MQTTBroker
+from simulation import SimulatedNode
+
+
+def percentile(values: list, fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def nec_command(index: int) -> dict:
+    return {"type": "NEC", "device_id": 0x20, "command": index % 0x100, "request_id": "bench-{}".format(index)}
+
+
+async def run_sequential(node: SimulatedNode, count: int, offset: int) -> dict:
+    # One command at a time: latency from the broker writing the message to the RMT receiving the pulses.
+    latencies = []
+    started = time.perf_counter()
+    for index in range(offset, offset + count):
+        sent = node.publish("ir/command", nec_command(index))
+        transmission = await node.next_transmission()
+        latencies.append((transmission.written - sent) * 1000)
+    elapsed = time.perf_counter() - started
+    return {
+        "commands": count,
+        "commands_per_s": round(count / elapsed, 2),
+        "p50_ms": round(percentile(latencies, 0.5), 3),
+        "p95_ms": round(percentile(latencies, 0.95), 3),
+        "max_ms": round(max(latencies), 3),
+    }
+
+
+async def run_burst(node: SimulatedNode, count: int, offset: int) -> dict:
+    # All commands at once: how fast the queue drains.
+    started = time.perf_counter()
+    for index in range(offset, offset + count):
+        node.publish("ir/command", nec_command(index))
+    for _ in range(count):
+        transmission = await node.next_transmission()
+    elapsed = transmission.done - started
+    return {"commands": count, "commands_per_s": round(count / elapsed, 2), "elapsed_ms": round(elapsed * 1000, 3)}
+
+
+async def run_scene(node: SimulatedNode, steps: int, offset: int) -> dict:
+    scene = {
+        "type": "SCENE",
+        "request_id": "bench-scene-{}".format(offset),
+        "scene": [nec_command(offset + index) for index in range(steps)],
+    }
+    sent = node.publish("ir/command", scene)
+    transmissions = [await node.next_transmission() for _ in range(steps)]
+    on_air = sum(transmission.done - transmission.written for transmission in transmissions)
+    wall_clock = transmissions[-1].done - sent
+    return {
+        "steps": steps,
+        "wall_clock_ms": round(wall_clock * 1000, 3),
+        "on_air_ms": round(on_air * 1000, 3),
+        "overhead_ms_per_step": round((wall_clock - on_air) * 1000 / steps, 3),
+    }
+
+
+def nec_edges(device_id: int, command: int) -> "List[int]":
+    # Edge timings in us of an NEC frame as seen by the receiver.
+    timings = [0, 9000, 4500]
+    for byte in (device_id, device_id ^ 0xFF, command, command ^ 0xFF):
+        for bit in range(7, -1, -1):
+            timings += [562, 1687 if byte >> bit & 1 else 562]
+    return timings + [562]
+
+
+async def run_triggers(node: SimulatedNode, broker: MQTTBroker, count: int, cooldown_s: float) -> dict:
+    # Latency from the end of a captured IR frame to the RMT sending the reaction: once with a trigger on the
+    # unit and once with a backend reacting to ir/last-captured-command over the broker.
+    edges = nec_edges(0x04, 0x08)
+    frame_s = sum(edges) / 1000000
+    reaction = {"type": "NEC", "device_id": 0x20, "command": 0x01}
+
+    async def measure() -> list:
+        receiver = next(iter(node.handler.ir_handler.rx_pins.values()))
+        latencies = []
+        for _ in range(count):
+            frame_end = time.perf_counter() + frame_s
+            receiver.simulate_edges(edges)
+            transmission = await node.next_transmission()
+            latencies.append((transmission.written - frame_end) * 1000)
+            await asyncio.sleep(cooldown_s)
+        return latencies
+
+    await node.request(
+        "trigger/set",
+        {"name": "bench", "match": {"type": "NEC", "device_id": 0x04, "command": 0x08}, "action": reaction},
+        "trigger/result",
+    )
+    # The trigger starts the receiver on its own, without listening mode.
+    local = await measure()
+    await node.request("trigger/remove", "bench", "trigger/result")
+    node.publish("ir/listening-mode", "NEC")
+    await asyncio.sleep(0.3)
+
+    def backend(topic: str, payload: bytes, retained: bool) -> None:
+        broker.publish(node.topic("ir/command"), json.dumps(reaction), 1)
+
+    broker.subscribe(node.topic("ir/last-captured-command"), backend)
+    via_broker = await measure()
+    broker.listeners.remove((node.topic("ir/last-captured-command"), backend))
+    node.publish("ir/listening-mode", "OFF")
+    return {
+        "frames": count,
+        "local_p50_ms": round(percentile(local, 0.5), 3),
+        "local_max_ms": round(max(local), 3),
+        "via_broker_p50_ms": round(percentile(via_broker, 0.5), 3),
+        "via_broker_max_ms": round(max(via_broker), 3),
+        "trace_stats": json.loads(await node.request("trace/dump", "stats trigger", "trace/result")),
+    }
+
+
+async def run_allocations(node: SimulatedNode, count: int, offset: int, repeated: bool = False) -> dict:
+    # Python heap traffic per command. Indicative only: CPython allocates differently than MicroPython,
+    # but a change in the numbers points at a change in the firmware's hot path. With repeated, the same
+    # IR command is sent every time (with a new request ID), like a remote would.
+    peaks = []
+    firmware = [tracemalloc.Filter(True, MODULES + "/*")]
+    tracemalloc.start()
+    try:
+        baseline_current, _ = tracemalloc.get_traced_memory()
+        baseline_firmware = tracemalloc.take_snapshot().filter_traces(firmware)
+        for index in range(offset, offset + count):
+            current, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            command = nec_command(index)
+            if repeated:
+                command["command"] = offset % 0x100
+            node.publish("ir/command", command)
+            await node.next_transmission()
+            await asyncio.sleep(0.15)  # Let the handler publish ir/last-sent-command.
+            peaks.append(tracemalloc.get_traced_memory()[1] - current)
+        retained = tracemalloc.get_traced_memory()[0] - baseline_current
+        # Only memory still referenced from allocations in the firmware, without the broker and asyncio buffers.
+        firmware_retained = sum(
+            stat.size_diff
+            for stat in tracemalloc.take_snapshot().filter_traces(firmware).compare_to(baseline_firmware, "filename")
+        )
+    finally:
+        tracemalloc.stop()
+    return {
+        "commands": count,
+        "peak_bytes_p50": percentile(peaks, 0.5),
+        "peak_bytes_max": max(peaks),
+        "retained_bytes_per_command": round(retained / count, 1),
+        "firmware_retained_bytes_per_command": round(firmware_retained / count, 1),
+    }
+
+
+async def benchmark(args) -> dict:
+    broker = await MQTTBroker().start()
+    with tempfile.TemporaryDirectory() as work_dir:
+        started = time.perf_counter()
+        node = await SimulatedNode(broker, work_dir).start()
+        boot_ms = (time.perf_counter() - started) * 1000
+        try:
+            await asyncio.sleep(1)  # Let the subscriptions and the first livesign settle.
+            results = {
+                "boot_ms": round(boot_ms, 3),
+                "sequential": await run_sequential(node, args.commands, 0),
+                "burst": await run_burst(node, args.burst, 10000),
+                "scene": await run_scene(node, args.scene_steps, 20000),
+                "allocations": await run_allocations(node, args.allocation_commands, 30000),
+                "allocations_repeated": await run_allocations(node, args.allocation_commands, 40000, repeated=True),
+                "triggers": await run_triggers(node, broker, args.triggers, 0.6),
+                "trace_stats": json.loads(await node.request("trace/dump", "stats", "trace/result")),
+                "broker": dict(broker.stats),
+            }
+        finally:
+            await node.stop()
+            await broker.stop()
+    return results
+
+
+def flatten(data: dict, prefix: str = "") -> dict:
+    values = {}
+    for key, value in data.items():
+        if isinstance(value, dict):
+            values.update(flatten(value, "{}{}.".format(prefix, key)))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values["{}{}".format(prefix, key)] = value
+    return values
+
+
+def compare(results: dict, baseline: dict) -> dict:
+    # Relative change of every metric against a previous run, in percent.
+    current = flatten(results)
+    previous = flatten(baseline)
+    return {
+        key: round((value - previous[key]) * 100 / previous[key], 1)
+        for key, value in current.items()
+        if previous.get(key)
+    }
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="End to end benchmark of the firmware against a local broker")
+    parser.add_argument("--commands", type=int, default=50)
+    parser.add_argument("--burst", type=int, default=20)
+    parser.add_argument("--scene-steps", type=int, default=10)
+    parser.add_argument("--allocation-commands", type=int, default=10)
+    parser.add_argument("--triggers", type=int, default=10)
+    parser.add_argument("--output", help="Write the results to this file as well")
+    parser.add_argument("--baseline", help="Results of a previous run to compare against")
+    args = parser.parse_args()
+    with redirect_stdout(sys.stderr):  # Keep the firmware's prints out of the results.
+        results = asyncio.run(benchmark(args))
+    report = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "parameters": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+        "results": results,
+    }
+    if args.baseline:
+        with open(args.baseline) as handle:
+            report["change_percent"] = compare(results, json.load(handle)["results"])
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as handle:
+            handle.write(output)
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
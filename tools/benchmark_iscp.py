@@ -0,0 +1,147 @@
+# ISCP throughput benchmark: drives ISCPHandler.discover/send against tools/iscp_emulator.py under CPython.
+#
+# Usage: python tools/benchmark_iscp.py [--commands 200] [--latency-ms 5] [--loss 0] [--batch 4]
+import argparse
+import asyncio
+import json
+import sys
+import time
+from contextlib import redirect_stdout
+
+from host import load_package
+
+load_package()
+
+import eiscp  # noqa: E402
+from iscp_emulator import ISCPEmulator  # noqa: E402
+
+from esp32_remote.commands import ISCPBatchItem  # noqa: E402
+from esp32_remote.iscp_handler import ISCPHandler  # noqa: E402
+
+
+def percentile(values: list, fraction: float) -> float:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def summary(latencies_ms: list, elapsed_s: float, failures: int) -> dict:
+    return {
+        "commands": len(latencies_ms) + failures,
+        "failures": failures,
+        "commands_per_s": round(len(latencies_ms) / elapsed_s, 1) if elapsed_s else None,
+        "p50_ms": round(percentile(latencies_ms, 0.5), 3) if latencies_ms else None,
+        "p99_ms": round(percentile(latencies_ms, 0.99), 3) if latencies_ms else None,
+    }
+
+
+async def run_sequential(handler: ISCPHandler, identifier: str, count: int) -> dict:
+    latencies = []
+    failures = 0
+    started = time.perf_counter()
+    for index in range(count):
+        sent = time.perf_counter()
+        try:
+            result = await handler.send(identifier, "MVL", "{:02X}".format(index % 0x40))
+        except OSError:
+            result = None
+        if result is None:
+            failures += 1
+        else:
+            latencies.append((time.perf_counter() - sent) * 1000)
+    return summary(latencies, time.perf_counter() - started, failures)
+
+
+async def run_batched(handler: ISCPHandler, identifier: str, count: int, batch_size: int) -> dict:
+    latencies = []
+    failures = 0
+    started = time.perf_counter()
+    for index in range(0, count, batch_size):
+        items = [
+            ISCPBatchItem("MVL" if offset % 2 else "SLI", "{:02X}".format((index + offset) % 0x40), True)
+            for offset in range(min(batch_size, count - index))
+        ]
+        sent = time.perf_counter()
+        try:
+            results = await handler.send_batch(identifier, items)
+        except OSError:
+            results = [None] * len(items)
+        elapsed = (time.perf_counter() - sent) * 1000
+        for result in results:
+            if result is None:
+                failures += 1
+            else:
+                latencies.append(elapsed / len(items))
+    return summary(latencies, time.perf_counter() - started, failures)
+
+
+async def run_reconnect(handler: ISCPHandler, emulator: ISCPEmulator, identifier: str, rounds: int) -> dict:
+    # The emulator resets all connections before each command, as a rebooting receiver would.
+    latencies = []
+    failures = 0
+    started = time.perf_counter()
+    for index in range(rounds):
+        emulator.drop_connections()
+        await asyncio.sleep(0.01)
+        sent = time.perf_counter()
+        result = None
+        for _ in range(2):  # One retry, as the handler's retry policy would do.
+            try:
+                result = await handler.send(identifier, "MVL", "{:02X}".format(index))
+                break
+            except OSError:
+                continue
+        if result is None:
+            failures += 1
+        else:
+            latencies.append((time.perf_counter() - sent) * 1000)
+    return summary(latencies, time.perf_counter() - started, failures)
+
+
+async def benchmark(args) -> dict:
+    emulator = await ISCPEmulator(latency_ms=args.latency_ms, loss=args.loss, seed=1).start()
+    eiscp.BROADCAST_ADDRESS = ("127.0.0.1", emulator.discovery_port)
+    eiscp.DISCOVERY_TIMEOUT = 0.2
+    handler = ISCPHandler(cache_path=None, discovery_interval_ms=0)
+    maintenance = asyncio.ensure_future(handler.start())
+    try:
+        started = time.perf_counter()
+        devices = await handler.discover()
+        discover_ms = (time.perf_counter() - started) * 1000
+        identifier = emulator.identifier
+
+        started = time.perf_counter()
+        await handler.send(identifier, "PWR", "01")
+        first_command_ms = (time.perf_counter() - started) * 1000
+
+        results = {
+            "discover": {"devices": len(devices), "ms": round(discover_ms, 3)},
+            "first_command_ms": round(first_command_ms, 3),
+            "sequential": await run_sequential(handler, identifier, args.commands),
+            "batched": await run_batched(handler, identifier, args.commands, args.batch),
+            "reconnect": await run_reconnect(handler, emulator, identifier, args.reconnects),
+            "emulator": emulator.stats,
+        }
+    finally:
+        handler.stop()
+        maintenance.cancel()
+        await emulator.stop()
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="ISCP throughput benchmark against the local emulator")
+    parser.add_argument("--commands", type=int, default=200)
+    parser.add_argument("--batch", type=int, default=4)
+    parser.add_argument("--reconnects", type=int, default=10)
+    parser.add_argument("--latency-ms", type=float, default=5)
+    parser.add_argument("--loss", type=float, default=0.0)
+    args = parser.parse_args()
+    with redirect_stdout(sys.stderr):  # Keep the firmware's prints out of the results.
+        results = asyncio.run(benchmark(args))
+    print(json.dumps({"parameters": vars(args), "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
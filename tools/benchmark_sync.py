@@ -0,0 +1,112 @@
+# Start time spread of a scene sent to several units at once. Boots --nodes simulated units against one broker,
+# each with its own NTP server answering after a random delay (an asymmetric path, so every unit ends up with a
+# slightly different clock offset). Every round publishes the same scene to all units with a random delay between
+# them, once without and once with start_at, and measures the spread of the first IR frame over the units.
+#
+# Usage: python tools/benchmark_sync.py [--nodes 4] [--rounds 10] [--lead-ms 500] [--jitter-ms 50]
+import argparse
+import asyncio
+import json
+import random
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+
+from mqtt_broker import MQTTBroker
+from ntp_server import NTPServer
+from simulation import SimulatedNode
+
+
+def percentile(values: list, fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def summary(values: list) -> dict:
+    return {
+        "p50_ms": round(percentile(values, 0.5), 3),
+        "p95_ms": round(percentile(values, 0.95), 3),
+        "max_ms": round(max(values), 3),
+    }
+
+
+async def wait_synced(nodes: "List[SimulatedNode]", timeout_s: float = 10) -> None:
+    deadline = time.perf_counter() + timeout_s
+    while not all(node.handler.ntp.synced for node in nodes):
+        if time.perf_counter() > deadline:
+            raise TimeoutError("Not all nodes synchronised their clock")
+        await asyncio.sleep(0.05)
+
+
+async def run_round(nodes: "List[SimulatedNode]", index: int, args, rng: random.Random, start_at: bool) -> dict:
+    scene = {"type": "SCENE", "scene": [{"type": "NEC", "device_id": 0x20, "command": index % 0x100}]}
+    target = None
+    started = []
+    if start_at:
+        target = int(time.time() * 1000) + args.lead_ms
+        # start_at after the scene, which the units have to find behind the array.
+        scene = {"type": "SCENE", "scene": scene["scene"], "start_at": target}
+        started = [asyncio.ensure_future(node.next_message("scene/started", 5 + args.lead_ms / 1000)) for node in nodes]
+        await asyncio.sleep(0)
+    for node in nodes:
+        node.publish("ir/command", scene)
+        await asyncio.sleep(rng.uniform(0, args.jitter_ms) / 1000)
+    written = [(await node.next_transmission()).written for node in nodes]
+    result = {"spread_ms": (max(written) - min(written)) * 1000}
+    if start_at:
+        # The host clock is the reference: how late the frames actually went out and what the units reported.
+        perf_offset = time.perf_counter() - time.time()
+        result["late_ms"] = [(value - perf_offset) * 1000 - target for value in written]
+        result["reported_late_ms"] = [json.loads(await waiter)["late_ms"] for waiter in started]
+    # Let the emitters finish their inter-frame gap before the next round.
+    await asyncio.sleep(0.2)
+    return result
+
+
+async def benchmark(args) -> dict:
+    rng = random.Random(args.seed)
+    broker = await MQTTBroker().start()
+    ntp_servers = [await NTPServer(latency_ms=rng.uniform(0, args.ntp_latency_ms)).start() for _ in range(args.nodes)]
+    results = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        nodes = []
+        try:
+            for index, ntp_server in enumerate(ntp_servers):
+                node = SimulatedNode(broker, work_dir, "sim/node{}".format(index), ntp_server=ntp_server)
+                nodes.append(await node.start())
+            await wait_synced(nodes)
+            results["clock_offset_ms"] = [round(node.handler.ntp.now_ms() - time.time() * 1000, 3) for node in nodes]
+            for name, start_at in (("on_arrival", False), ("start_at", True)):
+                rounds = [await run_round(nodes, index, args, rng, start_at) for index in range(args.rounds)]
+                result = {"spread": summary([item["spread_ms"] for item in rounds])}
+                if start_at:
+                    result["late"] = summary([value for item in rounds for value in item["late_ms"]])
+                    result["reported_late"] = summary([value for item in rounds for value in item["reported_late_ms"]])
+                results[name] = result
+        finally:
+            for node in nodes:
+                await node.stop()
+            for ntp_server in ntp_servers:
+                ntp_server.stop()
+            await broker.stop()
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Start time spread of a scene over several simulated units")
+    parser.add_argument("--nodes", type=int, default=4)
+    parser.add_argument("--rounds", type=int, default=10)
+    parser.add_argument("--lead-ms", type=int, default=500, help="How far ahead start_at is set")
+    parser.add_argument("--jitter-ms", type=float, default=50, help="Maximum delay between the publishes to two units")
+    parser.add_argument("--ntp-latency-ms", type=float, default=10, help="Maximum one way NTP response delay")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    with redirect_stdout(sys.stderr):  # Keep the firmware's prints out of the results.
+        results = asyncio.run(benchmark(args))
+    results["settings"] = vars(args)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
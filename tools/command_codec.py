@@ -0,0 +1,81 @@
+# Host side encoder for the binary command format accepted on the ir/command/bin topic.
+#
+# Usage: python tools/command_codec.py '{"type": "NEC", "device_id": 4, "command": 8}' > command.bin
+import json
+import struct
+import sys
+
+from host import load_package
+
+load_package()
+
+from esp32_remote.binary_command import (  # noqa: E402
+    FLAG_EXPECT_RESPONSE,
+    STEP_EMITTER,
+    STEP_ISCP,
+    STEP_ISCP_BATCH,
+    STEP_NEC,
+    STEP_RC6,
+    STEP_REPEAT,
+    STEP_SCENE,
+    STEP_START_AT,
+    STEP_WAIT,
+    VERSION,
+)
+
+
+def encode(command: dict) -> bytes:
+    return bytes((VERSION,)) + encode_step(command)
+
+
+def _encode_string(value: str) -> bytes:
+    data = value.encode()
+    if len(data) > 255:
+        raise ValueError("String {!r} is too long for the binary format".format(value))
+    return struct.pack("<B", len(data)) + data
+
+
+def encode_step(command: dict) -> bytes:
+    command_type = command.get("type", "").upper()
+    if command.get("emitter", None) is not None and command_type in ("NEC", "RC6"):
+        step = dict(command)
+        return struct.pack("<B", STEP_EMITTER) + _encode_string(step.pop("emitter")) + encode_step(step)
+    if command.get("start_at", None) is not None and command_type == "SCENE":
+        step = dict(command)
+        return struct.pack("<BQ", STEP_START_AT, step.pop("start_at")) + encode_step(step)
+    if command_type == "NEC":
+        return struct.pack("<BBB", STEP_NEC, command["device_id"], command["command"])
+    elif command_type == "RC6":
+        return struct.pack("<BBBB", STEP_RC6, command.get("mode", 0), command["control"], command["information"])
+    elif command_type == "ISCP":
+        return b"".join(
+            (
+                struct.pack("<B", STEP_ISCP),
+                _encode_string(command["identifier"]),
+                _encode_string(command["command"]),
+                _encode_string(command["argument"]),
+            )
+        )
+    elif command_type == "ISCP_BATCH":
+        items = command["commands"]
+        parts = [
+            struct.pack("<B", STEP_ISCP_BATCH),
+            _encode_string(command["identifier"]),
+            struct.pack("<B", len(items)),
+        ]
+        for item in items:
+            flags = FLAG_EXPECT_RESPONSE if item.get("expect_response", True) else 0
+            parts.extend((struct.pack("<B", flags), _encode_string(item["command"]), _encode_string(item["argument"])))
+        return b"".join(parts)
+    elif command_type == "WAIT":
+        return struct.pack("<BI", STEP_WAIT, int(command.get("ms", command.get("s", 1) * 1000)))
+    elif command_type == "REPEAT":
+        return struct.pack("<BH", STEP_REPEAT, command.get("count", 1)) + encode_step(command["item"])
+    elif command_type == "SCENE":
+        steps = command["scene"]
+        return struct.pack("<BH", STEP_SCENE, len(steps)) + b"".join(encode_step(step) for step in steps)
+    raise ValueError("Unknown command type {!r}".format(command_type))
+
+
+if __name__ == "__main__":
+    sys.stdout.buffer.write(encode(json.loads(sys.argv[1] if len(sys.argv) > 1 else sys.stdin.read())))
@@ -0,0 +1,49 @@
+# Helpers to import the firmware modules under CPython.
+import os
+import sys
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODULES = os.path.join(ROOT, "modules")
+SHIMS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "shims")
+
+
+def setup_path() -> None:
+    for path in (MODULES, SHIMS):
+        if path not in sys.path:
+            sys.path.insert(0, path)
+    install_time_shims()
+    install_gc_shims()
+
+
+def install_time_shims() -> None:
+    # The firmware calls the MicroPython ticks functions on the time module.
+    import time
+
+    import utime
+
+    for name in ("ticks_ms", "ticks_us", "ticks_add", "ticks_diff", "sleep_ms", "sleep_us"):
+        if not hasattr(time, name):
+            setattr(time, name, getattr(utime, name))
+
+
+def install_gc_shims() -> None:
+    # MicroPython's gc reports the heap of the device. Under CPython the numbers are only indicative.
+    import gc
+
+    if not hasattr(gc, "mem_free"):
+        gc.mem_free = lambda: 100000
+        gc.mem_alloc = lambda: 0
+    if not hasattr(gc, "threshold"):
+        gc.threshold = lambda *args: -1
+
+
+def load_package(name: str = "esp32_remote") -> types.ModuleType:
+    # Register the package without running its __init__, which pulls in the whole
+    # device stack. Submodules without hardware dependencies can then be imported.
+    setup_path()
+    if name not in sys.modules:
+        package = types.ModuleType(name)
+        package.__path__ = [os.path.join(MODULES, name)]
+        sys.modules[name] = package
+    return sys.modules[name]
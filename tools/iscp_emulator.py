@@ -0,0 +1,173 @@
+# Local eISCP device emulator: a UDP discovery responder and a TCP eISCP server.
+#
+# Usage: python tools/iscp_emulator.py [--latency-ms 20] [--loss 0.01] [--push-interval-ms 5000]
+import argparse
+import asyncio
+import random
+import struct
+
+ISCP_PORT = 60128
+
+
+def encode_frame(message: str, terminator: bytes = b"\x1a\r\n") -> bytes:
+    data = message.encode() + terminator
+    return b"ISCP" + struct.pack(">IIB3x", 16, len(data), 1) + data
+
+
+def decode_frame(data: bytes) -> str:
+    header_size, data_size = struct.unpack_from(">II", data, 4)
+    return data[header_size : header_size + data_size].decode().rstrip("\x1a\r\n")  # noqa: E203
+
+
+class _DiscoveryProtocol(asyncio.DatagramProtocol):
+    def __init__(self, emulator: "ISCPEmulator"):
+        self.emulator = emulator
+        self.transport = None
+
+    def connection_made(self, transport) -> None:
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, address) -> None:
+        try:
+            message = decode_frame(data)
+        except (struct.error, UnicodeDecodeError):
+            return
+        if message[2:] == "ECNQSTN":
+            self.emulator.stats["discoveries"] += 1
+            self.transport.sendto(encode_frame(self.emulator.ecn_message(), b"\x19\r\n"), address)
+
+
+class ISCPEmulator:
+    def __init__(
+        self,
+        identifier: str = "0009B0E3A001",
+        model: str = "TX-EMU",
+        host: str = "127.0.0.1",
+        port: int = 0,
+        discovery_port: int = 0,
+        latency_ms: float = 0,
+        loss: float = 0.0,
+        push_interval_ms: int = 0,
+        seed: int = None,
+    ):
+        self.identifier = identifier
+        self.model = model
+        self.host = host
+        self.port = port
+        self.discovery_port = discovery_port
+        self.latency_ms = latency_ms
+        self.loss = loss
+        self.push_interval_ms = push_interval_ms
+        self.random = random.Random(seed)
+        self.state = {"PWR": "01", "MVL": "20", "SLI": "01", "LMD": "00", "AMT": "00"}
+        self.writers = set()
+        self.stats = {"connections": 0, "frames": 0, "dropped": 0, "pushes": 0, "discoveries": 0}
+        self._server = None
+        self._discovery = None
+        self._push_task = None
+
+    def ecn_message(self) -> str:
+        return "!1ECN{}/{}/XX/{}".format(self.model, self.port, self.identifier)
+
+    async def start(self) -> "ISCPEmulator":
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        loop = asyncio.get_running_loop()
+        self._discovery, _ = await loop.create_datagram_endpoint(
+            lambda: _DiscoveryProtocol(self), local_addr=(self.host, self.discovery_port)
+        )
+        self.discovery_port = self._discovery.get_extra_info("sockname")[1]
+        if self.push_interval_ms:
+            self._push_task = asyncio.ensure_future(self._push_loop())
+        return self
+
+    async def stop(self) -> None:
+        if self._push_task is not None:
+            self._push_task.cancel()
+        self.drop_connections()
+        self._discovery.close()
+        self._server.close()
+        await self._server.wait_closed()
+
+    def drop_connections(self) -> None:
+        # Simulates a receiver reboot: all open connections are reset.
+        for writer in list(self.writers):
+            writer.close()
+        self.writers.clear()
+
+    def respond(self, message: str) -> "Optional[str]":
+        command, argument = message[2:5], message[5:]
+        if argument == "QSTN":
+            value = self.state.get(command, None)
+        elif argument in ("UP", "DOWN") and command == "MVL":
+            volume = int(self.state["MVL"], 16) + (1 if argument == "UP" else -1)
+            value = self.state["MVL"] = "{:02X}".format(max(0, min(0x64, volume)))
+        else:
+            value = self.state[command] = argument
+        return "!1{}{}".format(command, value if value is not None else "N/A")
+
+    def _broadcast(self, message: str) -> None:
+        frame = encode_frame(message)
+        for writer in list(self.writers):
+            writer.write(frame)
+
+    async def _push_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.push_interval_ms / 1000)
+            self.stats["pushes"] += 1
+            self._broadcast(self.respond("!1MVL{:02X}".format(self.random.randint(0, 0x50))))
+
+    async def _reply(self, writer, message: str) -> None:
+        if self.latency_ms:
+            await asyncio.sleep(self.latency_ms / 1000)
+        if writer in self.writers:
+            writer.write(encode_frame(message))
+
+    async def _handle(self, reader, writer) -> None:
+        self.stats["connections"] += 1
+        self.writers.add(writer)
+        try:
+            while True:
+                header = await reader.readexactly(16)
+                header_size, data_size = struct.unpack_from(">II", header, 4)
+                data = await reader.readexactly(header_size - 16 + data_size)
+                message = data[header_size - 16 :].decode().rstrip("\x1a\r\n")  # noqa: E203
+                self.stats["frames"] += 1
+                if self.loss and self.random.random() < self.loss:
+                    self.stats["dropped"] += 1
+                    continue
+                asyncio.ensure_future(self._reply(writer, self.respond(message)))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description="Local eISCP device emulator")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=ISCP_PORT)
+    parser.add_argument("--discovery-port", type=int, default=ISCP_PORT)
+    parser.add_argument("--identifier", default="0009B0E3A001")
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--loss", type=float, default=0.0)
+    parser.add_argument("--push-interval-ms", type=int, default=0)
+    args = parser.parse_args()
+    emulator = await ISCPEmulator(
+        identifier=args.identifier,
+        host=args.host,
+        port=args.port,
+        discovery_port=args.discovery_port,
+        latency_ms=args.latency_ms,
+        loss=args.loss,
+        push_interval_ms=args.push_interval_ms,
+    ).start()
+    print(
+        "Emulating {} on {}:{} (discovery on {})".format(args.identifier, args.host, emulator.port, args.discovery_port)
+    )
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
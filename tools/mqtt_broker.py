@@ -0,0 +1,233 @@
+# Minimal MQTT 3.1.1 broker for running the firmware on the host: QoS 0 and 1, retained messages and the
+# + and # wildcards. No authentication, persistent sessions or last will.
+#
+# Usage: python tools/mqtt_broker.py [--port 1883]
+import argparse
+import asyncio
+import struct
+
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+
+def topic_matches(topic_filter: str, topic: str) -> bool:
+    filter_parts = topic_filter.split("/")
+    topic_parts = topic.split("/")
+    for index, part in enumerate(filter_parts):
+        if part == "#":
+            return True
+        if index >= len(topic_parts):
+            return False
+        if part != "+" and part != topic_parts[index]:
+            return False
+    return len(filter_parts) == len(topic_parts)
+
+
+def encode_length(length: int) -> bytes:
+    encoded = bytearray()
+    while True:
+        byte = length & 0x7F
+        length >>= 7
+        encoded.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(encoded)
+
+
+def encode_packet(packet_type: int, flags: int, body: bytes) -> bytes:
+    return bytes(((packet_type << 4) | flags,)) + encode_length(len(body)) + body
+
+
+def encode_string(value: bytes) -> bytes:
+    return struct.pack("!H", len(value)) + value
+
+
+def encode_publish(topic: str, payload: bytes, qos: int, retain: bool, pid: int = 0) -> bytes:
+    body = encode_string(topic.encode())
+    if qos:
+        body += struct.pack("!H", pid)
+    return encode_packet(PUBLISH, (qos << 1) | int(retain), body + payload)
+
+
+class Session:
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.client_id = None
+        self.subscriptions = {}
+        self.next_pid = 0
+
+    def pid(self) -> int:
+        self.next_pid = self.next_pid % 0xFFFF + 1
+        return self.next_pid
+
+    def qos_for(self, topic: str) -> "Optional[int]":
+        matching = [qos for topic_filter, qos in self.subscriptions.items() if topic_matches(topic_filter, topic)]
+        return max(matching) if matching else None
+
+
+class MQTTBroker:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        self.host = host
+        self.port = port
+        self.server = None
+        self.sessions = []
+        self.retained = {}
+        self.listeners = []
+        self.stats = {"connects": 0, "received": 0, "delivered": 0}
+
+    async def start(self) -> "MQTTBroker":
+        self.server = await asyncio.start_server(self._serve, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self) -> None:
+        self.drop_connections()
+        self.server.close()
+        await self.server.wait_closed()
+
+    def drop_connections(self) -> None:
+        for session in list(self.sessions):
+            session.writer.close()
+        self.sessions = []
+
+    def subscribe(self, topic_filter: str, callback) -> None:
+        # In-process subscriber. callback(topic, payload, retained) is called for every matching message.
+        self.listeners.append((topic_filter, callback))
+        for topic, payload in list(self.retained.items()):
+            if topic_matches(topic_filter, topic):
+                callback(topic, payload, True)
+
+    def publish(self, topic: str, payload: bytes, qos: int = 0, retain: bool = False) -> None:
+        if isinstance(payload, str):
+            payload = payload.encode()
+        if retain:
+            if payload:
+                self.retained[topic] = payload
+            else:
+                self.retained.pop(topic, None)
+        for topic_filter, callback in list(self.listeners):
+            if topic_matches(topic_filter, topic):
+                callback(topic, payload, False)
+        for session in self.sessions:
+            subscribed_qos = session.qos_for(topic)
+            if subscribed_qos is None:
+                continue
+            delivered_qos = min(qos, subscribed_qos)
+            pid = session.pid() if delivered_qos else 0
+            session.writer.write(encode_publish(topic, payload, delivered_qos, False, pid))
+            self.stats["delivered"] += 1
+
+    async def _read_packet(self, reader: asyncio.StreamReader) -> "Tuple[int, int, bytes]":
+        first = (await reader.readexactly(1))[0]
+        length = 0
+        shift = 0
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            length |= (byte & 0x7F) << shift
+            if not byte & 0x80:
+                break
+            shift += 7
+        return first >> 4, first & 0x0F, await reader.readexactly(length)
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        session = Session(reader, writer)
+        try:
+            packet_type, _, body = await self._read_packet(reader)
+            if packet_type != CONNECT:
+                return
+            client_id_offset = 10
+            client_id_length = struct.unpack_from("!H", body, client_id_offset)[0]
+            session.client_id = body[client_id_offset + 2 : client_id_offset + 2 + client_id_length]  # noqa: E203
+            self.stats["connects"] += 1
+            writer.write(encode_packet(CONNACK, 0, b"\x00\x00"))
+            self.sessions.append(session)
+            while True:
+                packet_type, flags, body = await self._read_packet(reader)
+                if packet_type == PUBLISH:
+                    self._on_publish(session, flags, body)
+                elif packet_type == SUBSCRIBE:
+                    self._on_subscribe(session, body)
+                elif packet_type == UNSUBSCRIBE:
+                    self._on_unsubscribe(session, body)
+                elif packet_type == PINGREQ:
+                    writer.write(encode_packet(PINGRESP, 0, b""))
+                elif packet_type == DISCONNECT:
+                    return
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            if session in self.sessions:
+                self.sessions.remove(session)
+            writer.close()
+
+    def _on_publish(self, session: Session, flags: int, body: bytes) -> None:
+        qos = (flags >> 1) & 0x03
+        topic_length = struct.unpack_from("!H", body)[0]
+        topic = body[2 : 2 + topic_length].decode()  # noqa: E203
+        offset = 2 + topic_length
+        if qos:
+            pid = body[offset : offset + 2]  # noqa: E203
+            offset += 2
+            session.writer.write(encode_packet(PUBACK, 0, pid))
+        self.stats["received"] += 1
+        self.publish(topic, body[offset:], qos, bool(flags & 0x01))
+
+    def _on_subscribe(self, session: Session, body: bytes) -> None:
+        pid = body[0:2]
+        offset = 2
+        granted = bytearray()
+        new_filters = []
+        while offset < len(body):
+            length = struct.unpack_from("!H", body, offset)[0]
+            topic_filter = body[offset + 2 : offset + 2 + length].decode()  # noqa: E203
+            qos = min(body[offset + 2 + length], 1)
+            offset += 3 + length
+            session.subscriptions[topic_filter] = qos
+            new_filters.append((topic_filter, qos))
+            granted.append(qos)
+        session.writer.write(encode_packet(SUBACK, 0, pid + bytes(granted)))
+        for topic, payload in self.retained.items():
+            for topic_filter, qos in new_filters:
+                if topic_matches(topic_filter, topic):
+                    pid = session.pid() if qos else 0
+                    session.writer.write(encode_publish(topic, payload, qos, True, pid))
+                    break
+
+    def _on_unsubscribe(self, session: Session, body: bytes) -> None:
+        offset = 2
+        while offset < len(body):
+            length = struct.unpack_from("!H", body, offset)[0]
+            session.subscriptions.pop(body[offset + 2 : offset + 2 + length].decode(), None)  # noqa: E203
+            offset += 2 + length
+        session.writer.write(encode_packet(UNSUBACK, 0, body[0:2]))
+
+
+async def serve(args) -> None:
+    broker = await MQTTBroker(args.host, args.port).start()
+    print("MQTT broker listening on {}:{}".format(broker.host, broker.port))
+    await asyncio.Event().wait()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Minimal local MQTT 3.1.1 broker")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=1883)
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+# Minimal SNTP server answering with the host clock, optionally shifted, for running the firmware on the host.
+#
+# Usage: python tools/ntp_server.py [--port 1123] [--offset-ms 0]
+import argparse
+import asyncio
+import struct
+import time
+
+NTP_TO_UNIX_S = 2208988800
+
+
+def ntp_timestamp(unix_s: float) -> bytes:
+    seconds = int(unix_s)
+    return struct.pack("!II", seconds + NTP_TO_UNIX_S, int((unix_s - seconds) * (1 << 32)))
+
+
+class NTPServer(asyncio.DatagramProtocol):
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, offset_ms: float = 0, latency_ms: float = 0):
+        self.host = host
+        self.port = port
+        self.offset_ms = offset_ms
+        self.latency_ms = latency_ms
+        self.transport = None
+        self.requests = 0
+
+    async def start(self) -> "NTPServer":
+        loop = asyncio.get_running_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(lambda: self, local_addr=(self.host, self.port))
+        self.port = self.transport.get_extra_info("sockname")[1]
+        return self
+
+    def stop(self) -> None:
+        self.transport.close()
+
+    def now(self) -> float:
+        return time.time() + self.offset_ms / 1000
+
+    def datagram_received(self, data: bytes, address) -> None:
+        if len(data) < 48:
+            return
+        self.requests += 1
+        received = self.now()
+        if self.latency_ms:
+            asyncio.get_running_loop().call_later(self.latency_ms / 1000, self._respond, data, address, received)
+        else:
+            self._respond(data, address, received)
+
+    def _respond(self, data: bytes, address, received: float) -> None:
+        # Leap indicator 0, version 3, server mode, stratum 1.
+        response = bytearray(48)
+        response[0] = 0x1C
+        response[1] = 1
+        response[24:32] = data[40:48]  # Originate timestamp: the client's transmit timestamp
+        response[32:40] = ntp_timestamp(received)
+        response[40:48] = ntp_timestamp(self.now())
+        self.transport.sendto(bytes(response), address)
+
+
+async def serve(args) -> None:
+    server = await NTPServer(args.host, args.port, args.offset_ms).start()
+    print("NTP server listening on {}:{}".format(server.host, server.port))
+    await asyncio.Event().wait()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Minimal local SNTP server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=1123)
+    parser.add_argument("--offset-ms", type=float, default=0)
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+# CPython stand-in for the eiscp-micropython discovery. Speaks the eISCP discovery protocol over UDP,
+# so it finds real receivers as well as tools/iscp_emulator.py.
+import asyncio
+import socket
+import struct
+
+# Where discovery requests are sent to. Point this to the emulator for local runs.
+BROADCAST_ADDRESS = ("255.255.255.255", 60128)
+DISCOVERY_TIMEOUT = 1.0
+
+
+class eISCP:
+    def __init__(self, host, port=60128, info=None):
+        self.host = host
+        self.port = port
+        self.info = info or {}
+        self.identifier = self.info.get("identifier", None)
+
+
+def _frame(message):
+    data = message.encode() + b"\r"
+    return b"ISCP" + struct.pack(">IIB3x", 16, len(data), 1) + data
+
+
+def _parse_response(data, host):
+    header_size, data_size = struct.unpack_from(">II", data, 4)
+    message = data[header_size : header_size + data_size].decode().rstrip("\x19\x1a\r\n")  # noqa: E203
+    if message[2:5] != "ECN":
+        return None
+    model_name, iscp_port, area_code, identifier = message[5:].split("/")
+    info = {
+        "model_name": model_name,
+        "iscp_port": int(iscp_port),
+        "area_code": area_code,
+        "device_category": message[1],
+        "identifier": identifier,
+    }
+    return eISCP(host, int(iscp_port), info)
+
+
+async def discover(timeout=None):
+    timeout = DISCOVERY_TIMEOUT if timeout is None else timeout
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    sock.setblocking(False)
+    found = {}
+    try:
+        sock.sendto(_frame("!xECNQSTN"), BROADCAST_ADDRESS)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                data, (host, _) = await asyncio.wait_for(loop.sock_recvfrom(sock, 1024), remaining)
+            except asyncio.TimeoutError:
+                break
+            device = _parse_response(data, host)
+            if device is not None:
+                found[device.identifier] = device
+    finally:
+        sock.close()
+    return list(found.values())
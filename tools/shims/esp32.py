@@ -0,0 +1,34 @@
+# CPython stand-in for MicroPython's esp32 module. RMT records every pulse train with timestamps.
+import time
+
+# Called with (rmt, channel, write timestamp in s, done timestamp in s, pulses) for every transmitted frame.
+listeners = []
+
+
+class RMT:
+    def __init__(self, channel, pin=None, clock_div=8, carrier_freq=0, **kwargs):
+        self.channel = channel
+        self.pin = pin
+        self.clock_div = clock_div
+        self.carrier_freq = carrier_freq
+        self._done_at = 0
+
+    def write_pulses(self, pulses, start=1):
+        # Like on the device, a new frame waits for the previous one. The frame is then sent in the background.
+        self.wait_done(timeout=-1)
+        written = time.perf_counter()
+        duration = sum(pulses) * self.clock_div / 80 / 1000000
+        self._done_at = written + duration
+        record = (self, self.channel, written, self._done_at, tuple(pulses))
+        for listener in listeners:
+            listener(record)
+
+    def wait_done(self, timeout=0):
+        # True once the frame is on air. Blocks for up to timeout ms, forever with a negative timeout.
+        remaining = self._done_at - time.perf_counter()
+        if remaining > 0 and timeout:
+            time.sleep(remaining if timeout < 0 else min(remaining, timeout / 1000))
+        return time.perf_counter() >= self._done_at
+
+    def deinit(self):
+        pass
@@ -0,0 +1,116 @@
+# CPython stand-in for MicroPython's machine module.
+import asyncio
+import time
+
+import utime
+
+_rtc_offset = 0
+
+
+def unique_id():
+    return b"\x24\x0a\xc4\x00\x00\x01"
+
+
+def reset():
+    raise SystemExit("machine.reset() called")
+
+
+def disable_irq():
+    # IRQ handlers only run from simulate_edges() on the event loop thread, so there is nothing to mask.
+    return 0
+
+
+def enable_irq(state=0):
+    pass
+
+
+def reset_cause():
+    return PWRON_RESET
+
+
+PWRON_RESET = 1
+HARD_RESET = 2
+WDT_RESET = 3
+DEEPSLEEP_RESET = 4
+SOFT_RESET = 5
+
+
+class Pin:
+    IN = 1
+    OUT = 3
+    IRQ_RISING = 1
+    IRQ_FALLING = 2
+
+    def __init__(self, pin_id, mode=-1, *args, **kwargs):
+        self.id = pin_id
+        self.mode = mode
+        self._value = 0
+        self._handler = None
+
+    def __repr__(self):
+        return "Pin({})".format(self.id)
+
+    def value(self, value=None):
+        if value is None:
+            return self._value
+        self._value = int(bool(value))
+
+    def irq(self, handler=None, trigger=IRQ_FALLING | IRQ_RISING):
+        self._handler = handler
+
+    def deinit(self):
+        self._handler = None
+
+    def simulate_edges(self, timings_us):
+        # Fire the IRQ handler for a train of edges. The handler's ticks_us() calls see the simulated
+        # time as it is frozen to the edge time while the handler runs.
+        if self._handler is None:
+            return
+        now = utime.ticks_us()
+        for timing in timings_us:
+            now = utime.ticks_add(now, timing)
+            utime.freeze_us(now)
+            try:
+                self._value ^= 1
+                self._handler(self)
+            finally:
+                utime.freeze_us(None)
+
+
+class Timer:
+    ONE_SHOT = 0
+    PERIODIC = 1
+
+    def __init__(self, timer_id=-1):
+        self.id = timer_id
+        self._handle = None
+
+    def init(self, mode=PERIODIC, period=-1, callback=None, **kwargs):
+        self.deinit()
+        loop = asyncio.get_event_loop()
+
+        def fire():
+            self._handle = None
+            if mode == Timer.PERIODIC:
+                self._handle = loop.call_later(period / 1000, fire)
+            callback(self)
+
+        self._handle = loop.call_later(period / 1000, fire)
+
+    def deinit(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+
+class RTC:
+    def datetime(self, value=None):
+        global _rtc_offset
+        if value is None:
+            tm = time.gmtime(time.time() + _rtc_offset)
+            return (tm[0], tm[1], tm[2], tm[6], tm[3], tm[4], tm[5], 0)
+        year, month, day, _, hour, minute, second, _ = value
+        _rtc_offset = time.mktime((year, month, day, hour, minute, second, 0, 0, 0)) - time.timezone - time.time()
+
+    def memory(self, data=None):
+        return b""
@@ -0,0 +1,15 @@
+# CPython stand-in for the MicroPython micropython module.
+
+
+def const(value):
+    return value
+
+
+def schedule(function, argument):
+    import asyncio
+
+    asyncio.get_event_loop().call_soon(function, argument)
+
+
+def alloc_emergency_exception_buf(size):
+    pass
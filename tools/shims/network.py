@@ -0,0 +1,52 @@
+# CPython stand-in for MicroPython's network module with an always available access point.
+STA_IF = 0
+AP_IF = 1
+STAT_IDLE = 1000
+STAT_CONNECTING = 1001
+STAT_WRONG_PASSWORD = 202
+STAT_NO_AP_FOUND = 201
+STAT_GOT_IP = 1010
+
+# Set to False to simulate losing the access point.
+link_up = True
+
+
+class WLAN:
+    def __init__(self, interface=STA_IF):
+        self.interface = interface
+        self._active = False
+        self._connected = False
+
+    def active(self, state=None):
+        if state is None:
+            return self._active
+        self._active = bool(state)
+        if not self._active:
+            self._connected = False
+
+    def connect(self, ssid=None, key=None, bssid=None):
+        self._connected = link_up
+
+    def disconnect(self):
+        self._connected = False
+
+    def isconnected(self):
+        return self._connected and link_up
+
+    def status(self, param=None):
+        if param == "rssi":
+            return -40
+        return STAT_GOT_IP if self.isconnected() else STAT_IDLE
+
+    def scan(self):
+        return [(b"simulation", b"\x02\x00\x00\x00\x00\x01", 6, -40, 3, False)]
+
+    def config(self, *args, **kwargs):
+        if args == ("channel",):
+            return 6
+        if args == ("mac",):
+            return b"\x24\x0a\xc4\x00\x00\x01"
+        return None
+
+    def ifconfig(self, *args):
+        return ("127.0.0.1", "255.0.0.0", "127.0.0.1", "127.0.0.1")
@@ -0,0 +1,25 @@
+# CPython stand-in for MicroPython's uasyncio on top of asyncio.
+import asyncio
+from asyncio import *  # noqa: F401,F403
+from asyncio import TimeoutError  # noqa: F401
+
+
+async def sleep_ms(ms):
+    await asyncio.sleep(ms / 1000)
+
+
+async def wait_for_ms(awaitable, timeout_ms):
+    return await asyncio.wait_for(awaitable, timeout_ms / 1000)
+
+
+def get_event_loop():
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        pass
+    try:
+        return asyncio.get_event_loop_policy().get_event_loop()
+    except RuntimeError:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        return loop
@@ -0,0 +1,20 @@
+# CPython stand-in for MicroPython's usocket. Sockets get the stream read/write methods of MicroPython,
+# returning None instead of raising while a non-blocking socket has no data.
+import socket as _socket
+from socket import *  # noqa: F401,F403
+
+
+class socket(_socket.socket):
+    def read(self, size=-1):
+        try:
+            return self.recv(size if size > 0 else 4096)
+        except BlockingIOError:
+            return None
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        try:
+            return self.send(data)
+        except BlockingIOError:
+            return None
@@ -0,0 +1,2 @@
+# CPython stand-in for MicroPython's ustruct.
+from struct import *  # noqa: F401,F403
@@ -0,0 +1,42 @@
+# CPython stand-in for MicroPython's utime. The ticks functions wrap like on the device.
+import time as _time
+from time import *  # noqa: F401,F403
+
+TICKS_PERIOD = 1 << 30
+TICKS_MAX = TICKS_PERIOD - 1
+TICKS_HALF = TICKS_PERIOD // 2
+
+
+_frozen_us = None
+
+
+def freeze_us(ticks):
+    # Used by the machine.Pin stand-in to present simulated edge times to IRQ handlers.
+    global _frozen_us
+    _frozen_us = ticks
+
+
+def ticks_ms():
+    return int(_time.monotonic() * 1000) & TICKS_MAX
+
+
+def ticks_us():
+    if _frozen_us is not None:
+        return _frozen_us
+    return int(_time.monotonic() * 1000000) & TICKS_MAX
+
+
+def ticks_add(ticks, delta):
+    return (ticks + delta) & TICKS_MAX
+
+
+def ticks_diff(ticks1, ticks2):
+    return ((ticks1 - ticks2 + TICKS_HALF) & TICKS_MAX) - TICKS_HALF
+
+
+def sleep_ms(ms):
+    _time.sleep(ms / 1000)
+
+
+def sleep_us(us):
+    _time.sleep(us / 1000000)
@@ -0,0 +1,124 @@
+# Runs the complete firmware (Handler, IRHandler, ISCPHandler and mqtt_as) under CPython against the
+# local broker in tools/mqtt_broker.py. The hardware is replaced by the stand-ins in tools/shims; every
+# pulse train written to the RMT is recorded with its timestamps.
+import asyncio
+import json
+import os
+import time
+from collections import namedtuple
+
+from host import setup_path
+
+setup_path()
+
+import esp32  # noqa: E402
+from mqtt_broker import MQTTBroker  # noqa: E402
+
+Transmission = namedtuple("Transmission", ["channel", "written", "done", "pulses", "emitter"])
+
+
+class SimulatedNode:
+    def __init__(self, broker: MQTTBroker, work_dir: str, topic_prefix: str = "sim/node", ntp_server=None, **config):
+        self.broker = broker
+        self.ntp_server = ntp_server
+        self.work_dir = work_dir
+        self.topic_prefix = topic_prefix
+        self.overrides = config
+        self.handler = None
+        self.task = None
+        self.transmissions = asyncio.Queue()
+        self.livesign = asyncio.Event()
+        self.waiters: "Dict[str, List[asyncio.Future]]" = {}
+
+    @property
+    def config_path(self) -> str:
+        return os.path.join(self.work_dir, "{}.json".format(self.topic_prefix.replace("/", "_")))
+
+    def topic(self, name: str) -> str:
+        return "{}/{}".format(self.topic_prefix, name)
+
+    def _write_config(self) -> None:
+        data = {
+            "topic_prefix": self.topic_prefix,
+            "client_id": self.topic_prefix,
+            "server": self.broker.host,
+            "port": self.broker.port,
+            "user": None,
+            "password": None,
+            "ssl": False,
+            "ssid": "simulation",
+            "wifi_pw": "",
+            "no_run": True,
+            "net_cache": None,
+            "iscp_cache": None,
+            "schedule_path": None,
+            "trigger_path": None,
+        }
+        if self.ntp_server is not None:
+            data["ntp_host"] = self.ntp_server.host
+            data["ntp_port"] = self.ntp_server.port
+        data.update(self.overrides)
+        with open(self.config_path, "w") as handle:
+            json.dump(data, handle)
+
+    def _on_rmt(self, record: tuple) -> None:
+        rmt, channel, written, done, pulses = record
+        for emitter in self.handler.ir_handler.emitters.values():
+            if rmt.pin is emitter.pin:
+                self.transmissions.put_nowait(Transmission(channel, written, done, pulses, emitter.name))
+
+    async def start(self, timeout_s: float = 30) -> "SimulatedNode":
+        from esp32_remote import Handler, get_config
+
+        self._write_config()
+        # get_config() fills the module level config of mqtt_as. Every node needs its own copy.
+        config = dict(get_config(with_ssl=False, config_path=self.config_path))
+        self.broker.subscribe(self.topic("livesign"), lambda *args: self.livesign.set())
+        self.broker.subscribe(self.topic("#"), self._on_message)
+        self.handler = Handler(config)
+        esp32.listeners.append(self._on_rmt)
+        self.task = asyncio.ensure_future(self.handler.start())
+        await asyncio.wait_for(self.livesign.wait(), timeout_s)
+        return self
+
+    async def stop(self) -> None:
+        if self._on_rmt in esp32.listeners:
+            esp32.listeners.remove(self._on_rmt)
+        self.handler.stop()
+        self.handler.client.close()
+        self.task.cancel()
+        try:
+            await self.task
+        except (asyncio.CancelledError, Exception):
+            pass
+
+    def _on_message(self, topic: str, payload: bytes, retained: bool) -> None:
+        for waiter in self.waiters.pop(topic, ()):
+            if not waiter.done():
+                waiter.set_result(payload)
+
+    def _waiter(self, name: str) -> asyncio.Future:
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(self.topic(name), []).append(waiter)
+        return waiter
+
+    async def next_message(self, name: str, timeout_s: float = 5) -> bytes:
+        return await asyncio.wait_for(self._waiter(name), timeout_s)
+
+    async def request(
+        self, name: str, payload: "Union[bytes, str, dict]", result_name: str, timeout_s: float = 5
+    ) -> bytes:
+        waiter = self._waiter(result_name)
+        self.publish(name, payload)
+        return await asyncio.wait_for(waiter, timeout_s)
+
+    def publish(self, name: str, payload: "Union[bytes, str, dict]", qos: int = 1) -> float:
+        # Returns the time the message was handed to the device's socket.
+        if isinstance(payload, dict):
+            payload = json.dumps(payload)
+        sent = time.perf_counter()
+        self.broker.publish(self.topic(name), payload, qos)
+        return sent
+
+    async def next_transmission(self, timeout_s: float = 5) -> Transmission:
+        return await asyncio.wait_for(self.transmissions.get(), timeout_s)